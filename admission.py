@@ -0,0 +1,48 @@
+'''
+what a server does with new connections before they become sessions
+
+the accept loops take connections at a bounded rate so a reconnect storm
+waits in the listen backlog instead of starting thousands of sessions at
+once, and every accepted socket gets the same options
+'''
+import socket
+import time
+
+class AcceptLimiter:
+    '''
+    token bucket of accepts, rate per second with bursts of up to burst,
+    rate 0 for no limit. not thread safe, one accept loop uses it
+    '''
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+
+    #take one accept, return the seconds to wait before it, 0 to go ahead now
+    def take(self):
+        if not self.rate:
+            return 0
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        # a token taken ahead is paid back by waiting
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+#send small frames right away and let the kernel find peers that vanished, keepalive_s 0 leaves keepalive off
+def configure_socket(sock, keepalive_s):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if keepalive_s:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # idle time, probe interval and probes before the connection is dropped, where the platform has them
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(keepalive_s)))
+            if hasattr(socket, 'TCP_KEEPINTVL'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(keepalive_s) // 4))
+            if hasattr(socket, 'TCP_KEEPCNT'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+    except OSError:
+        pass # the peer may already be gone
@@ -0,0 +1,238 @@
+import asyncio
+import socket
+import threading
+import time
+import logging
+
+from admission import configure_socket
+from protocol import HEADER, COMPRESSED_FLAG, SIZE_MASK, FrameDecompressor, decode_message, encode_message
+from session import SessionException, OutputQueue
+from server import Server
+
+class AsyncSession:
+    '''
+    Session driven by asyncio streams instead of a read and a write thread
+    '''
+
+    def __str__(self):
+        return f'AsyncSession {self.remote_address}'
+
+    def __init__(self, server, reader, writer, handle_message, output_queue):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.remote_address = writer.get_extra_info('peername')
+        # codec negotiated at login, None for json
+        self.codec = None
+        # FrameCompressor once compression is negotiated, and the reader of the client's compressed frames
+        self.compressor = None
+        self.decompressor = None
+        self.output_messages = output_queue
+        self.output_ready = asyncio.Event()
+        self.handle_message = handle_message
+        self.is_active = True
+        self.write_task = asyncio.create_task(self._write())
+
+    #encode and send queued messages, all of them in one write per wakeup
+    async def _write(self):
+        try:
+            while self.is_active:
+                await self.output_ready.wait()
+                self.output_ready.clear()
+                frames = self.output_messages.take()
+                if self.compressor is not None:
+                    frames = [self.compressor.compress(frame) for frame in frames]
+                if frames:
+                    self.writer.write(b''.join(frames))
+                    await self.writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except:
+            pass # logging.warning(f'{self} disconnected with exception in write')
+            self.close()
+
+    def write_message(self, message, key=None):
+        self.write_frame(encode_message(message, self.codec), key)
+
+    #may be called from any thread, the frame is queued on the event loop
+    def write_frame(self, frame, key=None):
+        if not self.is_active:
+            raise SessionException(f'{self} is closed')
+        self.server.call_in_loop(self._push, frame, key)
+
+    #True once after the output queue dropped frames, frames pushed from another thread are seen on a later write
+    def frames_lost(self):
+        lost, self.output_messages.lost = self.output_messages.lost, False
+        return lost
+
+    def _push(self, frame, key):
+        if not self.is_active:
+            return
+        if not self.output_messages.push(frame, key):
+            # too slow, the server drops the session when its read ends
+            self.close()
+            return
+        self.output_ready.set()
+
+    #read framed messages until the peer disconnects
+    async def read(self):
+        try:
+            while self.is_active:
+                size = HEADER.unpack(await self.reader.readexactly(HEADER.size))[0]
+                body = await self.reader.readexactly(size & SIZE_MASK)
+                if size & COMPRESSED_FLAG:
+                    if self.decompressor is None:
+                        self.decompressor = FrameDecompressor()
+                    body = self.decompressor.decompress(body)
+                message = decode_message(body)
+                try:
+                    self.handle_message(self, message)
+                except:
+                    pass # logging.exception(f'exception raised when caller is handling {message} from {self}')
+        except:
+            pass # logging.warning(f'{self} disconnected with exception in read')
+        finally:
+            self.close()
+
+    def close(self):
+        if threading.get_ident() != self.server.loop_thread_id:
+            self.server.call_in_loop(self.close)
+            return
+        if self.is_active:
+            self.is_active = False
+            self.write_task.cancel()
+            self.writer.close()
+
+
+class AsyncServer(Server):
+    '''
+    Server accepting clients on an asyncio event loop
+
+    the event loop is the game loop, client messages and bubble deadlines
+    run on it with the same Server methods, other threads reach it through
+    post() and call_in_loop()
+    '''
+    #initialize the server, the loop is created by serve_forever()
+    def __init__(self, port, **options):
+        super().__init__(port, **options)
+        self.loop = None
+        self.loop_thread_id = None
+        self.ready = threading.Event()
+        # timer running the earliest bubble deadline and when it fires
+        self._deadline_timer = None
+        self._timer_deadline = None
+        # False to leave out the status line
+        self.print_status = True
+
+    #run fn on the event loop, directly if we are already on it
+    def call_in_loop(self, fn, *args):
+        if threading.get_ident() == self.loop_thread_id:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def post(self, fn, *args):
+        self.call_in_loop(fn, *args)
+
+    #keep one timer armed for the earliest deadline, always called on the loop
+    def deadline_added(self, deadline):
+        if self.tick_s:
+            # _tick() runs the deadlines
+            return
+        if self._deadline_timer is not None:
+            if self._timer_deadline <= deadline:
+                return
+            self._deadline_timer.cancel()
+        self._timer_deadline = deadline
+        self._deadline_timer = self.loop.call_later(max(0, deadline - self.clock()), self._run_due)
+
+    def _run_due(self):
+        self._deadline_timer = None
+        deadline = self.bubble_manager.run_due()
+        if deadline is not None:
+            self.deadline_added(deadline)
+
+    #run the due deadlines and send the batched broadcasts at the tick rate
+    async def _tick(self):
+        tick = self.clock()
+        while True:
+            tick += self.tick_s
+            await asyncio.sleep(max(0, tick - self.clock()))
+            self.bubble_manager.run_due(tick)
+            self.flush_broadcasts()
+            if self.clock() - tick > self.tick_s:
+                tick = self.clock()
+
+    #run the event loop in a background thread and wait until it listens, status as in Server.start()
+    def start(self, status=True):
+        self.print_status = status
+        threading.Thread(target=self.serve_forever, args=(), daemon=True).start()
+        self.ready.wait()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.close_event_log()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.listen_socket = socket.socket()
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(('0.0.0.0', self.port))
+        self.listen_socket.listen(self.backlog)
+        self.listen_socket.setblocking(False)
+        # the real port when started on port 0
+        self.port = self.listen_socket.getsockname()[1]
+
+        self.start_bubbles()
+        if self.udp_port is not None:
+            self.start_datagrams()
+        if self.tick_s:
+            self._tick_task = asyncio.create_task(self._tick())
+        if self.print_status:
+            self._status_thread = threading.Thread(target=self._status, args=(), daemon=True)
+            self._status_thread.start()
+        self.register_gauges()
+
+        self.ready.set()
+        await self._accept_clients()
+
+    #accept at the limiter's rate, connections over it wait in the listen backlog
+    async def _accept_clients(self):
+        # the tasks of the connected clients, the loop only keeps weak references
+        clients = set()
+        while True:
+            delay = self.accept_limiter.take()
+            if delay:
+                await asyncio.sleep(delay)
+            sock, client_address = await self.loop.sock_accept(self.listen_socket)
+            if self.is_full():
+                self.refuse(sock)
+                continue
+            configure_socket(sock, self.keepalive_s)
+            task = asyncio.create_task(self._accept_client(sock))
+            clients.add(task)
+            task.add_done_callback(clients.discard)
+
+    async def _accept_client(self, sock):
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock)
+        except:
+            sock.close()
+            return # the peer is already gone
+        session = AsyncSession(self, reader, writer, self.handle_client_message, self.create_output_queue())
+        self.register_session(session)
+        if self.event_log is not None:
+            self.event_log.open(session.remote_address)
+        self.start_login_timer(session)
+        pass # logging.info(f'{session.remote_address} connected')
+        await session.read()
+        # unlike the threaded server, drop the session as soon as the peer goes away
+        if self.sessions.get(session.remote_address) is session:
+            self.remove_session(session)
+
+    #hop onto the loop once per broadcast instead of once per session
+    def send_to_all(self, message):
+        self.call_in_loop(super().send_to_all, message)
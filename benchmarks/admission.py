@@ -0,0 +1,195 @@
+'''
+stress check of the accept path: clients connect and disconnect as fast
+as they can while the server's threads, sessions and memory are sampled
+
+a third of the connections close right away, a third log in and then
+close, and a third connect and never say anything, they stay open until
+the end like clients that hung. with admission on, the sessions must stay
+under --max-sessions, the thread count under two per session, and every
+silent connection must be gone a little after --login-timeout, while the
+--players clients that logged in before the storm are still answered.
+with it off nothing bounds them
+
+run from the repository root:
+    python -m benchmarks.admission
+    python -m benchmarks.admission --asyncio --duration 10
+'''
+import argparse
+import os
+import resource
+import socket
+import threading
+import time
+
+from protocol import encode_message, read_message
+from server import Server
+
+LOGIN = encode_message({'action': 'login'})
+PING = encode_message({'action': 'ping', 'timestamp': 0})
+
+
+#resident memory of this process in MiB
+def rss_mib():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+#True if the server still answers on the connection, the ping comes back after whatever was sent before it
+def answers_ping(sock):
+    def read(n):
+        data = sock.recv(n)
+        if not data:
+            raise ConnectionError('closed by the server')
+        return data
+    try:
+        sock.sendall(PING)
+        while read_message(read)['action'] != 'ping':
+            pass
+        return True
+    except OSError:
+        return False
+
+
+class Storm:
+    '''
+    client threads opening connections in a loop, and a sampler
+    '''
+    def __init__(self, address, clients):
+        self.address = address
+        self.running = True
+        self.connects = 0
+        self.failed = 0
+        # connections of clients that never log in, closed by the server or at the end
+        self.silent = []
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._connect, args=(i,), daemon=True) for i in range(clients)]
+
+    def _connect(self, index):
+        kind = index
+        while self.running:
+            kind += 1
+            try:
+                sock = socket.create_connection(self.address, timeout=2)
+            except OSError:
+                self.failed += 1
+                continue
+            self.connects += 1
+            try:
+                if kind % 3 == 1:
+                    sock.sendall(LOGIN)
+                    sock.recv(256)
+                elif kind % 3 == 2:
+                    with self.lock:
+                        self.silent.append(sock)
+                    continue
+            except OSError:
+                pass # refused by the server
+            sock.close()
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+
+    def close_silent(self):
+        with self.lock:
+            for sock in self.silent:
+                sock.close()
+            self.silent = []
+
+
+def run(asyncio, admission, clients, players, duration, max_sessions, accept_rate, login_timeout_s):
+    options = dict(max_sessions=max_sessions, accept_rate=accept_rate, login_timeout_s=login_timeout_s)
+    if not admission:
+        options = dict(max_sessions=0, accept_rate=0, login_timeout_s=0)
+    if asyncio:
+        from async_server import AsyncServer
+        server = AsyncServer(0, **options)
+    else:
+        server = Server(0, **options)
+    # without the status line, which would garble the table
+    if asyncio:
+        server.start(status=False)
+    else:
+        server.start(daemon=True, status=False)
+    address = ('127.0.0.1', server.port)
+    time.sleep(0.2)
+
+    # players who log in and stay, the login timeout must leave them alone
+    kept = []
+    for _ in range(players):
+        sock = socket.create_connection(address, timeout=2)
+        sock.sendall(LOGIN)
+        kept.append(sock)
+
+    threads_before, rss_before = threading.active_count(), rss_mib()
+    storm = Storm(address, clients)
+    peak_threads, peak_sessions, peak_rss = 0, 0, 0
+    started = time.perf_counter()
+    storm.start()
+    while time.perf_counter() - started < duration:
+        time.sleep(0.05)
+        peak_threads = max(peak_threads, threading.active_count() - threads_before - clients)
+        peak_sessions = max(peak_sessions, len(server.sessions))
+        peak_rss = max(peak_rss, rss_mib() - rss_before)
+    storm.stop()
+    rate = storm.connects / (time.perf_counter() - started)
+
+    # the silent connections are still open, the login timeout has to clear them
+    time.sleep(login_timeout_s + 1)
+    left_sessions = len(server.sessions)
+    left_threads = threading.active_count() - threads_before
+    storm.close_silent()
+    connected = sum(answers_ping(sock) for sock in kept)
+    for sock in kept:
+        sock.close()
+    # unbounded sessions already bound memory to the storm, whatever happens next
+    bounded = (peak_sessions <= max_sessions and peak_threads <= 2 * max_sessions + 10
+        and left_sessions == players and connected == players)
+    return {
+        'connects_per_s': rate,
+        'failed': storm.failed,
+        'peak_sessions': peak_sessions,
+        'peak_threads': peak_threads,
+        'peak_rss': peak_rss,
+        'left_sessions': left_sessions,
+        'left_threads': left_threads,
+        'connected': connected,
+        'bounded': bounded,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--asyncio', action='store_true', help='storm an AsyncServer instead of the threaded one')
+    parser.add_argument('--clients', type=int, default=8, help='threads connecting in a loop')
+    parser.add_argument('--players', type=int, default=5, help='clients logged in through the storm, they must stay connected')
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--max-sessions', type=int, default=500)
+    parser.add_argument('--accept-rate', type=float, default=500)
+    parser.add_argument('--login-timeout', type=float, default=2)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print(f'{"admission":>9} {"connects/s":>10} {"failed":>7} {"peak sessions":>14} {"peak threads":>13} '
+        f'{"peak rss":>9} {"sessions left":>14} {"threads left":>13} {"players kept":>13} {"bounded":>8}')
+    failed = False
+    for admission in (False, True):
+        result = run(args.asyncio, admission, args.clients, args.players, args.duration,
+            args.max_sessions, args.accept_rate, args.login_timeout)
+        print(f'{"on" if admission else "off":>9} {result["connects_per_s"]:>10.0f} {result["failed"]:>7} '
+            f'{result["peak_sessions"]:>14} {result["peak_threads"]:>13} {result["peak_rss"]:>6.1f}MiB '
+            f'{result["left_sessions"]:>14} {result["left_threads"]:>13} {result["connected"]:>9}/{args.players:<3} '
+            f'{"yes" if result["bounded"] else "no":>8}')
+        failed = failed or (admission and not result['bounded'])
+    if failed:
+        raise SystemExit('admission did not keep the server bounded')
@@ -0,0 +1,89 @@
+'''
+hold thousands of simulated clients on one AsyncServer process
+
+run from the repository root:
+    python -m benchmarks.async_load --clients 5000
+'''
+import argparse
+import asyncio
+import resource
+import statistics
+import threading
+import time
+
+from async_server import AsyncServer
+from protocol import HEADER, decode_message, encode_message
+
+
+#log in, then ping every interval seconds until stop is set
+async def simulated_client(port, interval, stop, latencies, connected):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(encode_message({'action': 'login'}))
+    connected.append(writer)
+
+    async def read():
+        while True:
+            size = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+            message = decode_message(await reader.readexactly(size))
+            if message.get('action') == 'ping':
+                latencies.append(time.time() - message['timestamp'])
+
+    read_task = asyncio.create_task(read())
+    while not stop.is_set():
+        writer.write(encode_message({'action': 'ping', 'timestamp': time.time()}))
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+    read_task.cancel()
+    writer.close()
+
+
+async def run(server, n, interval, duration, connect_batch):
+    stop = asyncio.Event()
+    latencies, connected = [], []
+    tasks = []
+    started = time.perf_counter()
+    for i in range(0, n, connect_batch):
+        for _ in range(min(connect_batch, n - i)):
+            tasks.append(asyncio.create_task(
+                simulated_client(server.port, interval, stop, latencies, connected)))
+        # let this batch finish connecting before opening the next one
+        while len(connected) < len(tasks):
+            await asyncio.sleep(0.01)
+    connect_time = time.perf_counter() - started
+
+    # only measure once every client holds its connection
+    latencies.clear()
+    await asyncio.sleep(duration)
+    held = len(server.sessions)
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return connect_time, held, latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=5000)
+    parser.add_argument('--interval', type=float, default=1, help='seconds between pings of one client')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to hold all clients')
+    parser.add_argument('--connect-batch', type=int, default=250)
+    args = parser.parse_args()
+
+    # every client costs two file descriptors in this process
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.clients * 2 + 100)), hard))
+
+    # every client connects at once, the admission limits would only stretch the connect phase
+    server = AsyncServer(0, max_sessions=0, accept_rate=0)
+    server.start()
+    connect_time, held, latencies = asyncio.run(
+        run(server, args.clients, args.interval, args.duration, args.connect_batch))
+
+    latencies.sort()
+    print()
+    print(f'clients connected: {args.clients} in {connect_time:.1f}s, sessions held: {held}')
+    print(f'threads: {threading.active_count()}, max rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MiB')
+    if latencies:
+        print(f'pings: {len(latencies)}, p50: {statistics.median(latencies) * 1000:.1f}ms, '
+              f'p99: {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms')
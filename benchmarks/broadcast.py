@@ -0,0 +1,95 @@
+'''
+broadcast throughput with frames encoded once and shared between sessions,
+against encoding the message again for every session, and how many frames
+and bytes the sessions send per syscall
+
+run from the repository root:
+    python -m benchmarks.broadcast --sessions 10 100 1000
+'''
+import argparse
+import selectors
+import socket
+import threading
+import time
+
+from protocol import BINARY_CODEC, encode_message
+from server import Server
+
+
+#read and discard everything the server sends so no socket buffer fills up
+def drain(clients):
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client, selectors.EVENT_READ)
+    while True:
+        for key, _ in selector.select():
+            try:
+                if not key.fileobj.recv(1 << 16):
+                    selector.unregister(key.fileobj)
+            except OSError:
+                selector.unregister(key.fileobj)
+
+
+#the broadcast before frames were shared
+def broadcast_per_session(server, message):
+    for session in list(server.sessions.values()):
+        server.write_message(session, message)
+
+
+def run(n, messages, codec, flush_window_ms):
+    server = Server(0, flush_window_ms)
+    clients = []
+    for i in range(n):
+        client_socket, server_socket = socket.socketpair()
+        server.add_session(server_socket, ('bench', i)).codec = codec
+        clients.append(client_socket)
+    threading.Thread(target=drain, args=(clients,), daemon=True).start()
+
+    message = {
+        'action': 'bubble_added',
+        'id': 1,
+        'position': (400, 300),
+        'radius': 15.5,
+        'color': (10, 20, 30),
+        'expire_time_s': time.time(),
+        'locked_by': None,
+        'hold_time_ms': 500,
+        'lock_time': None,
+        'value': 10,
+    }
+    results = []
+    for broadcast in (broadcast_per_session, Server.broadcast):
+        elapsed = 0
+        for _ in range(messages):
+            started = time.perf_counter()
+            broadcast(server, message)
+            elapsed += time.perf_counter() - started
+        results.append(messages / elapsed)
+
+    # let the write threads finish before reading their counters
+    time.sleep(0.5)
+    sessions = list(server.sessions.values())
+    send_calls = sum(session.send_calls for session in sessions) or 1
+    results.append(sum(session.frames_sent for session in sessions) / send_calls)
+    results.append(sum(session.bytes_sent for session in sessions) / send_calls)
+
+    for session in sessions:
+        session.close()
+    for client in clients:
+        client.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--messages', type=int, default=200, help='broadcasts per run')
+    parser.add_argument('--codec', choices=['json', BINARY_CODEC], default='json')
+    parser.add_argument('--flush-window-ms', type=float, default=0)
+    args = parser.parse_args()
+    codec = None if args.codec == 'json' else args.codec
+
+    print(f'{"sessions":>8} {"per-session encode msg/s":>25} {"shared frame msg/s":>19} {"frames/send":>12} {"bytes/send":>11}')
+    for n in args.sessions:
+        per_session, shared, frames_per_send, bytes_per_send = run(n, args.messages, codec, args.flush_window_ms)
+        print(f'{n:>8} {per_session:>25.0f} {shared:>19.0f} {frames_per_send:>12.1f} {bytes_per_send:>11.0f}')
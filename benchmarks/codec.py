@@ -0,0 +1,150 @@
+'''
+compare the binary codec with json, after a randomized round-trip check
+of every message the server and the client handle
+
+run from the repository root:
+    python -m benchmarks.codec
+'''
+import argparse
+import json
+import random
+import string
+import timeit
+
+from protocol import BINARY_CODEC, HEADER, LOCK_ACCEPTED, LOCK_TAKEN, LOCK_GONE, decode_message, encode_message
+
+
+def random_player_id():
+    return f'{random.randint(0, 255)}.{random.randint(0, 255)}.0.1:{random.randint(1024, 65535)}'
+
+def random_text():
+    return ''.join(random.choice(string.printable + 'éü漢') for _ in range(random.randint(0, 20)))
+
+#a bubble as BubbleStore.config() has it, bubble_added adds the action
+def random_bubble_config():
+    locked_by = random.choice([None, random_player_id()])
+    return {
+        'id': random.randint(0, 2 ** 31 - 1),
+        'position': (random.randint(0, 800), random.randint(0, 600)),
+        'radius': random.uniform(10, 20),
+        'color': (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)),
+        'expire_time_s': random.uniform(0, 2e9),
+        'locked_by': locked_by,
+        'hold_time_ms': random.randint(100, 2000),
+        'lock_time': random.uniform(0, 2e9) if locked_by else None,
+        'value': random.randint(1, 20),
+    }
+
+def random_bubble():
+    return {'action': 'bubble_added', **random_bubble_config()}
+
+def random_status():
+    return {
+        'action': 'status',
+        'players': {random_player_id(): {'score': random.randint(0, 200)} for _ in range(random.randint(0, 30))},
+    }
+
+#every action of Server._handle_message and Client.handle_message
+MESSAGES = {
+    'ping': lambda: {'action': 'ping', 'timestamp': random.uniform(0, 2e9)},
+    'login request': lambda: {'action': 'login', 'codecs': [BINARY_CODEC]},
+    'login': lambda: {'action': 'login', 'player_id': random_player_id(), 'codec': BINARY_CODEC},
+    'lock': lambda: {'action': 'lock', 'bubble_id': random.randint(0, 2 ** 31 - 1), 'player_id': random_player_id()},
+    'numbered lock': lambda: {'action': 'lock', 'bubble_id': random.randint(0, 2 ** 31 - 1), 'player_id': random_player_id(), 'seq': random.randint(0, 2 ** 31 - 1)},
+    'lock_result': lambda: {
+        'action': 'lock_result',
+        'seq': random.randint(0, 2 ** 31 - 1),
+        'bubble_id': random.randint(0, 2 ** 31 - 1),
+        'result': random.choice([LOCK_ACCEPTED, LOCK_TAKEN, LOCK_GONE]),
+    },
+    'status request': lambda: {'action': 'status'},
+    'status': random_status,
+    'datagram status': lambda: {'action': 'status', 'seq': random.randint(0, 2 ** 31 - 1), 'players': random_status()['players']},
+    'bubble_added': random_bubble,
+    'bubble_expired': lambda: {'action': 'bubble_expired', 'bubble_id': random.randint(0, 2 ** 31 - 1)},
+    'bubble_locked': lambda: {'action': 'bubble_locked', 'bubble_id': random.randint(0, 2 ** 31 - 1), 'player_id': random_player_id()},
+    'bubble_consumed': lambda: {'action': 'bubble_consumed', 'bubble_id': random.randint(0, 2 ** 31 - 1), 'player_id': random_text()},
+    'game_over': lambda: {'action': 'game_over', 'winner': random_text()},
+    'status_delta': lambda: {
+        'action': 'status_delta',
+        'seq': random.randint(0, 2 ** 31 - 1),
+        'players': random_status()['players'],
+        'removed': [random_player_id() for _ in range(random.randint(0, 3))],
+    },
+    'snapshot request': lambda: {'action': 'snapshot'},
+    'snapshot': lambda: {
+        'action': 'snapshot',
+        'seq': random.randint(0, 2 ** 31 - 1),
+        'bubbles': [random_bubble_config() for _ in range(random.randint(0, 10))],
+        'players': random_status()['players'],
+    },
+}
+# a tick's events, mixing shapes a spec fits with ones sent as json
+MESSAGES['batch'] = lambda: {
+    'action': 'batch',
+    'messages': [random.choice([random_odd_message] + list(MESSAGES.values()))() for _ in range(random.randint(0, 10))],
+}
+
+# a tick's events as the server sends them, every one fits a spec
+TICK_EVENTS = ['bubble_added', 'bubble_expired', 'bubble_locked', 'bubble_consumed', 'status_delta']
+MESSAGES['tick batch'] = lambda: {
+    'action': 'batch',
+    'messages': [MESSAGES[random.choice(TICK_EVENTS)]() for _ in range(random.randint(2, 20))],
+}
+
+#shapes no binary spec fits, they must fall back to json and still round trip
+def random_odd_message():
+    message = random.choice(list(MESSAGES.values()))()
+    mutation = random.randrange(4)
+    if mutation == 0:
+        message['extra'] = random_text()
+    elif mutation == 1 and len(message) > 1:
+        del message[random.choice([key for key in message if key != 'action'])]
+    elif mutation == 2:
+        key = random.choice(list(message))
+        if key != 'action':
+            message[key] = random.choice([None, True, 1.5, 2 ** 40, random_text(), [1, 2, 3]])
+    else:
+        message['action'] = random_text()
+    return message
+
+
+def round_trip(message):
+    frame = encode_message(message, BINARY_CODEC)
+    assert HEADER.unpack_from(frame)[0] == len(frame) - HEADER.size
+    # json is the reference, it turns tuples into lists
+    expected = json.loads(json.dumps(message))
+    decoded = decode_message(frame[HEADER.size:])
+    assert decoded == expected, (message, decoded)
+    assert all(type(decoded[key]) is type(expected[key]) for key in expected), (message, decoded)
+
+
+def fuzz(iterations):
+    for _ in range(iterations):
+        for make in MESSAGES.values():
+            round_trip(make())
+        round_trip(random_odd_message())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fuzz', type=int, default=2000, help='round-trip iterations over every message')
+    parser.add_argument('--number', type=int, default=20000, help='encodes and decodes to time per message')
+    args = parser.parse_args()
+
+    fuzz(args.fuzz)
+    print(f'round trip ok: {args.fuzz * (len(MESSAGES) + 1)} messages')
+
+    print(f'{"message":>15} {"json B":>7} {"binary B":>9} {"json enc us":>12} {"bin enc us":>11} {"json dec us":>12} {"bin dec us":>11}')
+    for name, make in MESSAGES.items():
+        message = make()
+        json_frame, binary_frame = encode_message(message), encode_message(message, BINARY_CODEC)
+        json_body, binary_body = json_frame[HEADER.size:], binary_frame[HEADER.size:]
+        timings = [
+            timeit.timeit(lambda: encode_message(message), number=args.number),
+            timeit.timeit(lambda: encode_message(message, BINARY_CODEC), number=args.number),
+            timeit.timeit(lambda: decode_message(json_body), number=args.number),
+            timeit.timeit(lambda: decode_message(binary_body), number=args.number),
+        ]
+        print(f'{name:>15} {len(json_frame):>7} {len(binary_frame):>9} ' +
+              ' '.join(f'{t / args.number * 1e6:>{w}.2f}' for t, w in zip(timings, (12, 11, 12, 11))))
@@ -0,0 +1,128 @@
+'''
+bandwidth saved by session compression against the CPU it costs, over the
+frames one client receives during a game, with the binary codec
+
+a variant is a size threshold, a zlib level and whether the stream starts from
+the preset dictionary, which matters most for the first frames of a session,
+measured on their own as join. every variant is checked to decode back to the same
+messages before it is timed
+
+run from the repository root:
+    python -m benchmarks.compression --players 10 100
+'''
+import argparse
+import random
+import time
+
+from bubble_store import random_bubbles
+from protocol import (
+    BINARY_CODEC, COMPRESSED_FLAG, COMPRESSION_DICTIONARY, HEADER,
+    FrameCompressor, FrameDecompressor, decode_message, encode_message)
+
+VARIANTS = [
+    # name, min bytes, level, dictionary
+    ('off', 0, 0, None),
+    ('all l6', 1, 6, COMPRESSION_DICTIONARY),
+    ('64 l1', 64, 1, COMPRESSION_DICTIONARY),
+    ('256 l1', 256, 1, COMPRESSION_DICTIONARY),
+    ('256 l6', 256, 6, COMPRESSION_DICTIONARY),
+    ('256 l6 nodict', 256, 6, b''),
+    ('256 l9', 256, 9, COMPRESSION_DICTIONARY),
+]
+
+
+def bubble_message(bubble_id, fields):
+    position, radius, color, lifetime_s, hold_time_ms, value = fields
+    return {
+        'action': 'bubble_added',
+        'id': bubble_id,
+        'position': position,
+        'radius': radius,
+        'color': color,
+        'expire_time_s': time.time() + lifetime_s,
+        'locked_by': None,
+        'hold_time_ms': hold_time_ms,
+        'lock_time': None,
+        'value': value,
+    }
+
+
+#what the server sends one client: a snapshot, then events one by one or a batch per tick,
+#and now and then the answer to a status request
+def game_messages(players, events, events_per_tick, seed=1):
+    random.seed(seed)
+    player_ids = [f'192.168.{i // 250}.{i % 250 + 1}:{50000 + i}' for i in range(players)]
+    scores = {player_id: random.randint(0, 50) for player_id in player_ids}
+    bubbles = {bubble_id: bubble_message(bubble_id, fields) for bubble_id, fields in enumerate(random_bubbles(100, False))}
+    next_id = len(bubbles)
+    seq = 1
+    messages = [{
+        'action': 'snapshot',
+        'seq': seq,
+        'bubbles': list(bubbles.values()),
+        'players': {player_id: {'score': score} for player_id, score in scores.items()},
+    }]
+    tick = []
+    for event in range(events):
+        kind = random.random()
+        if kind < 0.4 or not bubbles:
+            bubbles[next_id] = bubble_message(next_id, random_bubbles(1, False)[0])
+            tick.append(bubbles[next_id])
+            next_id += 1
+        elif kind < 0.65:
+            tick.append({'action': 'bubble_locked', 'bubble_id': random.choice(list(bubbles)), 'player_id': random.choice(player_ids)})
+        elif kind < 0.85:
+            bubble_id = random.choice(list(bubbles))
+            player_id = random.choice(player_ids)
+            scores[player_id] += bubbles.pop(bubble_id)['value']
+            seq += 1
+            tick.append({'action': 'bubble_consumed', 'bubble_id': bubble_id, 'player_id': player_id})
+            tick.append({'action': 'status_delta', 'seq': seq, 'players': {player_id: {'score': scores[player_id]}}, 'removed': []})
+        else:
+            tick.append({'action': 'bubble_expired', 'bubble_id': bubbles.popitem()[0]})
+        if len(tick) >= events_per_tick:
+            messages.append(tick[0] if len(tick) == 1 else {'action': 'batch', 'messages': tick})
+            tick = []
+        if event % 50 == 49:
+            messages.append({'action': 'status', 'players': {player_id: {'score': score} for player_id, score in scores.items()}})
+    return messages
+
+
+def run(frames, min_bytes, level, dictionary):
+    if not min_bytes:
+        return sum(map(len, frames)), 0, 0
+    compressor = FrameCompressor(min_bytes, level, dictionary)
+    started = time.perf_counter()
+    sent = [compressor.compress(frame) for frame in frames]
+    compress_s = time.perf_counter() - started
+    decompressor = FrameDecompressor(dictionary)
+    started = time.perf_counter()
+    bodies = []
+    for frame in sent:
+        size = HEADER.unpack_from(frame)[0]
+        body = memoryview(frame)[HEADER.size:]
+        bodies.append(decompressor.decompress(body) if size & COMPRESSED_FLAG else body)
+    decompress_s = time.perf_counter() - started
+    for frame, body in zip(frames, bodies):
+        assert decode_message(body) == decode_message(frame[HEADER.size:])
+    return sum(map(len, sent)), compress_s, decompress_s
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--players', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--events', type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f'{"players":>7} {"sending":>9} {"variant":>14} {"frames":>7} {"KiB":>8} {"saved":>6} '
+        f'{"comp us/frame":>14} {"decomp us/frame":>16} {"us/KiB saved":>13}')
+    for players in args.players:
+        for sending, events_per_tick, count in (('join', 1, 20), ('events', 1, None), ('20hz tick', 10, None)):
+            frames = [encode_message(message, BINARY_CODEC) for message in game_messages(players, args.events, events_per_tick)][:count]
+            original = sum(map(len, frames))
+            for name, min_bytes, level, dictionary in VARIANTS:
+                size, compress_s, decompress_s = run(frames, min_bytes, level, dictionary)
+                saved = original - size
+                cost = (compress_s + decompress_s) * 1e6 / (saved / 1024) if saved > 0 else 0
+                print(f'{players:>7} {sending:>9} {name:>14} {len(frames):>7} {size / 1024:>8.1f} {saved / original:>6.1%} '
+                    f'{compress_s * 1e6 / len(frames):>14.2f} {decompress_s * 1e6 / len(frames):>16.2f} {cost:>13.1f}')
@@ -0,0 +1,263 @@
+'''
+latency of pings and score updates over the stream alone against the
+datagram channel, through a lossy link stand-in on loopback
+
+the link delays every packet by --delay-ms each way and loses --loss of them.
+a lost datagram is gone. a lost stream segment is resent --rto-ms later and
+holds back everything sent after it, like a TCP retransmission does.
+an update's latency runs from publish_scores() on the server to the client
+having those scores, over either path
+
+run from the repository root:
+    python -m benchmarks.datagram --loss 0 0.01 0.03 0.05
+'''
+import argparse
+import heapq
+import itertools
+import math
+import random
+import socket
+import threading
+import time
+
+from bot import percentile
+from client_state import BubbleSet, ClientState
+from server import Server
+
+# payload of one TCP segment on loopback-like links
+SEGMENT_SIZE = 1448
+
+
+class Delayer:
+    '''
+    runs fn(*args) at its due time from one thread, in due order
+    '''
+    def __init__(self):
+        self.heap = []
+        self.order = itertools.count()
+        self.ready = threading.Condition()
+        threading.Thread(target=self._run, args=(), daemon=True).start()
+
+    def schedule(self, due, fn, *args):
+        with self.ready:
+            heapq.heappush(self.heap, (due, next(self.order), fn, args))
+            self.ready.notify()
+
+    def _run(self):
+        while True:
+            with self.ready:
+                while not self.heap or self.heap[0][0] > time.perf_counter():
+                    self.ready.wait(None if not self.heap else self.heap[0][0] - time.perf_counter())
+                _, _, fn, args = heapq.heappop(self.heap)
+            try:
+                fn(*args)
+            except OSError:
+                pass # the other side is gone
+
+
+class StreamLink:
+    '''
+    TCP proxy to the server, every chunk read is delayed, and when one of its
+    segments is lost it waits the retransmission time with everything behind it
+    '''
+    def __init__(self, server_addr, loss, delay_s, rto_s, delayer):
+        self.server_addr = server_addr
+        self.loss = loss
+        self.delay_s = delay_s
+        self.rto_s = rto_s
+        self.delayer = delayer
+        self.listen_socket = socket.socket()
+        self.listen_socket.bind(('127.0.0.1', 0))
+        self.listen_socket.listen(1024)
+        self.address = self.listen_socket.getsockname()
+        threading.Thread(target=self._accept, args=(), daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, _ = self.listen_socket.accept()
+            upstream = socket.create_connection(self.server_addr)
+            # the link adds its own delays only, Nagle's algorithm on its sockets would add more
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for source, target in ((client, upstream), (upstream, client)):
+                threading.Thread(target=self._pump, args=(source, target), daemon=True).start()
+
+    def _pump(self, source, target):
+        due = 0
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                self.delayer.schedule(due, target.close)
+                return
+            segments = math.ceil(len(data) / SEGMENT_SIZE)
+            lost = random.random() < 1 - (1 - self.loss) ** segments
+            # a stream delivers in order, nothing overtakes a chunk waiting for its retransmission
+            due = max(due, time.perf_counter() + self.delay_s + (self.rto_s if lost else 0))
+            self.delayer.schedule(due, target.sendall, data)
+
+
+class DatagramLink:
+    '''
+    UDP relay to the server, every datagram is delayed or lost, one upstream socket per client
+    '''
+    def __init__(self, server_addr, loss, delay_s, delayer):
+        self.server_addr = server_addr
+        self.loss = loss
+        self.delay_s = delay_s
+        self.delayer = delayer
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.address = self.socket.getsockname()
+        self.upstreams = {}
+        threading.Thread(target=self._relay_up, args=(), daemon=True).start()
+
+    def _forward(self, fn, *args):
+        if random.random() >= self.loss:
+            self.delayer.schedule(time.perf_counter() + self.delay_s, fn, *args)
+
+    def _relay_up(self):
+        while True:
+            data, client_address = self.socket.recvfrom(65536)
+            upstream = self.upstreams.get(client_address)
+            if upstream is None:
+                upstream = self.upstreams[client_address] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                upstream.connect(self.server_addr)
+                threading.Thread(target=self._relay_down, args=(upstream, client_address), daemon=True).start()
+            self._forward(upstream.send, data)
+
+    def _relay_down(self, upstream, client_address):
+        while True:
+            try:
+                data = upstream.recv(65536)
+            except OSError:
+                continue
+            self._forward(self.socket.sendto, data, client_address)
+
+
+class Probe(ClientState):
+    '''
+    client recording its ping round trips and how late score updates reach it
+    '''
+    def __init__(self, server_addr, datagram_link, published):
+        self.datagram_link = datagram_link
+        self.published = published
+        # the stream and the datagram threads both deliver messages
+        self.lock = threading.Lock()
+        # pings sent from since on count
+        self.since = time.time()
+        self.pings_sent = 0
+        self.ping_rtts = []
+        self.update_latencies = []
+        super().__init__(server_addr, BubbleSet(), datagram_link is not None)
+        self.login()
+
+    def datagram_address(self, port):
+        return self.datagram_link.address
+
+    def ping(self):
+        self.pings_sent += 1
+        super().ping()
+
+    def handle_message(self, session, message):
+        with self.lock:
+            now = time.perf_counter()
+            if message.get('action') == 'ping' and message['timestamp'] >= self.since:
+                self.ping_rtts.append(time.time() - message['timestamp'])
+            before = self.status_seq
+            super().handle_message(session, message)
+            if before is not None and self.status_seq is not None:
+                # a status skipping seqs brings the skipped updates too
+                for seq in range(before + 1, self.status_seq + 1):
+                    if seq in self.published:
+                        self.update_latencies.append(now - self.published[seq])
+
+
+#the game loop changes one score, like a consumed bubble does
+def change_score(server):
+    if server.players:
+        player_id = random.choice(list(server.players))
+        server.players[player_id]['score'] += 1
+        server.publish_scores({player_id: server.players[player_id]['score']})
+
+
+def run(clients, datagram, loss, delay_s, rto_s, update_rate, ping_rate, duration):
+    server = Server(0, udp_port=0)
+    # without the status line, which would garble the table
+    server.start(daemon=True, status=False)
+
+    # status_seq -> when the server published it
+    published = {}
+    publish_scores = server.publish_scores
+    def publish_and_record(players, removed=()):
+        publish_scores(players, removed)
+        published[server.status_seq] = time.perf_counter()
+    server.publish_scores = publish_and_record
+
+    delayer = Delayer()
+    stream_link = StreamLink(('127.0.0.1', server.port), loss, delay_s, rto_s, delayer)
+    datagram_link = DatagramLink(('127.0.0.1', server.udp_port), loss, delay_s, delayer) if datagram else None
+    probes = [Probe(stream_link.address, datagram_link, published) for _ in range(clients)]
+
+    running = True
+    def drive():
+        next_ping = next_update = time.perf_counter()
+        while running:
+            now = time.perf_counter()
+            if now >= next_update:
+                next_update += 1 / update_rate
+                server.post(change_score, server)
+            if now >= next_ping:
+                next_ping += 1 / ping_rate
+                for probe in probes:
+                    probe.ping()
+            time.sleep(0.001)
+    threading.Thread(target=drive, args=(), daemon=True).start()
+
+    # count from here, the logins and snapshots are behind us
+    time.sleep(1)
+    for probe in probes:
+        with probe.lock:
+            probe.since, probe.pings_sent, probe.ping_rtts, probe.update_latencies = time.time(), 0, [], []
+    time.sleep(duration)
+    running = False
+    # answers to the last pings are still on their way
+    time.sleep(2 * delay_s + rto_s + 0.1)
+
+    pings_sent = sum(probe.pings_sent for probe in probes)
+    rtts = [rtt for probe in probes for rtt in probe.ping_rtts]
+    latencies = [latency for probe in probes for latency in probe.update_latencies]
+    for probe in probes:
+        probe.session.close()
+        if probe.datagram_peer is not None:
+            probe.datagram_peer.socket.close()
+    return {
+        'answered': len(rtts) / max(1, pings_sent),
+        'ping_p50': percentile(rtts, 0.5),
+        'ping_p99': percentile(rtts, 0.99),
+        'update_p50': percentile(latencies, 0.5),
+        'update_p99': percentile(latencies, 0.99),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loss', type=float, nargs='+', default=[0, 0.01, 0.03, 0.05])
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--delay-ms', type=float, default=20, help='one way delay of the link')
+    parser.add_argument('--rto-ms', type=float, default=200, help='how late a lost stream segment arrives')
+    parser.add_argument('--update-rate', type=float, default=20, help='score changes per second')
+    parser.add_argument('--ping-rate', type=float, default=10, help='pings per second per client')
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    print(f'{"loss":>5} {"path":>9} {"answered":>9} {"ping p50":>9} {"ping p99":>9} {"update p50":>11} {"update p99":>11}')
+    for loss in args.loss:
+        for name, datagram in (('stream', False), ('datagram', True)):
+            result = run(args.clients, datagram, loss, args.delay_ms / 1000, args.rto_ms / 1000,
+                args.update_rate, args.ping_rate, args.duration)
+            print(f'{loss:>5.0%} {name:>9} {result["answered"]:>9.1%} '
+                f'{result["ping_p50"] * 1000:>7.1f}ms {result["ping_p99"] * 1000:>7.1f}ms '
+                f'{result["update_p50"] * 1000:>9.1f}ms {result["update_p99"] * 1000:>9.1f}ms')
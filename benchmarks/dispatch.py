@@ -0,0 +1,86 @@
+'''
+measure server CPU use and ping latency with idle and active sessions
+
+run from the repository root:
+    python -m benchmarks.dispatch --sessions 1 100 1000
+'''
+import argparse
+import socket
+import statistics
+import threading
+import time
+
+from protocol import read_message, write_message
+from server import Server
+
+
+#measure the share of one core used by this process over duration seconds
+def cpu_usage(duration):
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    time.sleep(duration)
+    return (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+
+
+#connect n clients to the server through socket pairs
+def connect_clients(server, n):
+    clients = []
+    for i in range(n):
+        client_socket, server_socket = socket.socketpair()
+        server.add_session(server_socket, ('bench', i))
+        clients.append(client_socket)
+    return clients
+
+
+#send one ping per client, then wait for every echo and return the round trip times
+def ping_round(clients):
+    for client in clients:
+        write_message(client.sendall, {'action': 'ping', 'timestamp': time.time()})
+    latencies = []
+    for client in clients:
+        message = read_message(client.recv)
+        latencies.append(time.time() - message['timestamp'])
+    return latencies
+
+
+def run(n, duration, rounds):
+    # the clients only ping and never log in
+    server = Server(0, login_timeout_s=0)
+    threading.Thread(target=server._run_game, daemon=True).start()
+    clients = connect_clients(server, n)
+    time.sleep(0.2) # let the session threads settle
+
+    idle_cpu = cpu_usage(duration)
+
+    latencies = []
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for _ in range(rounds):
+        latencies += ping_round(clients)
+    active_cpu = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+
+    for session in list(server.sessions.values()):
+        session.close()
+    for client in clients:
+        client.close()
+
+    latencies.sort()
+    return {
+        'sessions': n,
+        'idle_cpu_percent': idle_cpu * 100,
+        'active_cpu_percent': active_cpu * 100,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 100, 1000])
+    parser.add_argument('--duration', type=float, default=2, help='seconds to sample idle CPU')
+    parser.add_argument('--rounds', type=int, default=20, help='ping rounds per client when active')
+    args = parser.parse_args()
+
+    print(f'{"sessions":>8} {"idle cpu %":>11} {"active cpu %":>13} {"p50 ms":>8} {"p99 ms":>8}')
+    for n in args.sessions:
+        result = run(n, args.duration, args.rounds)
+        print(f'{result["sessions"]:>8} {result["idle_cpu_percent"]:>11.1f} {result["active_cpu_percent"]:>13.1f} '
+              f'{result["p50_ms"]:>8.2f} {result["p99_ms"]:>8.2f}')
@@ -0,0 +1,55 @@
+'''
+end to end latency and throughput of a Server under headless bots,
+the numbers to compare before and after a performance change
+
+every bot logs in, pings, polls the status and clicks bubbles, see bot.py
+
+run from the repository root:
+    python -m benchmarks.end_to_end --bots 10 100 1000
+    python -m benchmarks.end_to_end --bots 10 100 1000 --tick-hz 20
+'''
+import argparse
+import resource
+import time
+
+from bot import run_bots
+from metrics import METRICS
+from server import Server
+
+
+def handled():
+    return sum(counter.value for name, counter in METRICS.counters.items() if name.startswith('server.messages_in.'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bots', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--ping-rate', type=float, default=1, help='pings per second per bot')
+    parser.add_argument('--status-rate', type=float, default=0.5, help='status requests per second per bot')
+    parser.add_argument('--click-rate', type=float, default=1, help='bubble clicks per second per bot')
+    parser.add_argument('--tick-hz', type=float, default=0, help='server tick rate, 0 to send every event right away')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, max(args.bots) * 2 + 100)), hard))
+
+    print(f'{"bots":>6} {"handled/s":>10} {"received/s":>11} {"ping p50":>9} {"ping p99":>9} '
+        f'{"lock p50":>9} {"lock p99":>9} {"over p50":>9} {"over p99":>9} {"closed":>7}')
+    for bots in args.bots:
+        # a fresh game each time so earlier bots and bubbles do not weigh on the next run
+        # steady state numbers, the bots all connect at once and are not meant to be rate limited
+        server = Server(0, tick_hz=args.tick_hz, max_sessions=0, accept_rate=0)
+        # without the status line, which would garble the table
+        server.start(daemon=True, status=False)
+        port = server.port
+        before, started = handled(), time.perf_counter()
+        report = run_bots(('127.0.0.1', port), bots, args.duration,
+            args.ping_rate, args.status_rate, args.click_rate)
+        # handled/s also covers connecting and the warmup, the bots count only the measured window
+        rate = (handled() - before) / (time.perf_counter() - started)
+        print(f'{bots:>6} {rate:>10.0f} {report["received_per_s"]:>11.0f} '
+            f'{report["ping_rtt"]["p50"] * 1000:>7.1f}ms {report["ping_rtt"]["p99"] * 1000:>7.1f}ms '
+            f'{report["lock_to_consumed"]["p50"] * 1000:>7.1f}ms {report["lock_to_consumed"]["p99"] * 1000:>7.1f}ms '
+            f'{report["lock_overhead"]["p50"] * 1000:>7.1f}ms {report["lock_overhead"]["p99"] * 1000:>7.1f}ms '
+            f'{report["disconnected"]:>7}')
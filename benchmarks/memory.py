@@ -0,0 +1,118 @@
+'''
+memory per bubble of the server's BubbleStore against one dict per bubble,
+and of the client's BubbleState with __slots__ against a plain class,
+with the time of one expiry sweep over each server layout
+
+run from the repository root:
+    python -m benchmarks.memory --bubbles 100000
+'''
+import argparse
+import random
+import time
+import tracemalloc
+
+from bubble_store import BubbleStore
+from client_state import BubbleState
+from config import (
+    POOL_WIDTH, POOL_HEIGHT,
+    BUBBLE_MIN_RADIUS, BUBBLE_MAX_RADIUS, BUBBLE_MIN_VALUE, BUBBLE_MAX_VALUE)
+
+
+#the same bubbles for every layout, made inside the measurement so the values count too
+def random_fields(n, seed):
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield random_bubble(rng)
+
+
+def random_bubble(random):
+    return (
+        (random.randint(0, POOL_WIDTH), random.randint(0, POOL_HEIGHT)),
+        random.uniform(BUBBLE_MIN_RADIUS, BUBBLE_MAX_RADIUS),
+        (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)),
+        1e9 + random.uniform(3, 6),
+        random.randint(100, 2000),
+        random.randint(BUBBLE_MIN_VALUE, BUBBLE_MAX_VALUE))
+
+
+#the bubbles of BubbleManager before the store
+def make_dicts(n, seed):
+    bubbles = {}
+    for id, (position, radius, color, expire_time_s, hold_time_ms, value) in enumerate(random_fields(n, seed)):
+        bubbles[id] = {
+            'id': id,
+            'position': position,
+            'radius': radius,
+            'color': color,
+            'expire_time_s': expire_time_s,
+            'locked_by': None,
+            'hold_time_ms': hold_time_ms,
+            'lock_time': None,
+            'value': value,
+        }
+    return bubbles
+
+
+def make_store(n, seed):
+    store = BubbleStore()
+    for fields in random_fields(n, seed):
+        store.add(*fields)
+    return store
+
+
+#the client bubble before __slots__
+class PlainBubble:
+    def __init__(self, config):
+        self.id = config['id']
+        self.position = config['position']
+        self.radius = config['radius']
+        self.color = config['color']
+        self.hold_time_ms = config['hold_time_ms']
+        self.locked = False
+        self.locked_by_others = False
+        self.locked_by = None
+
+
+def make_client(cls, configs):
+    return {config['id']: cls(config) for config in configs}
+
+
+#bytes allocated by make(*args) and still held by what it returns
+def measure(make, *args):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = make(*args)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bubbles', type=int, default=100000)
+    args = parser.parse_args()
+
+    n = args.bubbles
+    dict_size, dicts = measure(make_dicts, n, 1)
+    store_size, store = measure(make_store, n, 1)
+    configs = store.configs()
+
+    # about one tick's worth of bubbles is due, as in a running game
+    now = 1e9 + 3.03
+    started = time.perf_counter()
+    expired_dicts = [id for id, bubble in dicts.items() if bubble['expire_time_s'] <= now]
+    dict_sweep = time.perf_counter() - started
+    started = time.perf_counter()
+    expired_store = store.expired(now)
+    store_sweep = time.perf_counter() - started
+    assert len(expired_dicts) == len(expired_store)
+
+    plain_size, _ = measure(make_client, PlainBubble, configs)
+    slots_size, _ = measure(make_client, BubbleState, configs)
+
+    print(f'{n} bubbles')
+    print(f'{"layout":>22} {"MiB":>8} {"B/bubble":>9} {"sweep ms":>9}')
+    print(f'{"server dicts":>22} {dict_size / 2 ** 20:>8.1f} {dict_size / n:>9.0f} {dict_sweep * 1000:>9.1f}')
+    print(f'{"server BubbleStore":>22} {store_size / 2 ** 20:>8.1f} {store_size / n:>9.0f} {store_sweep * 1000:>9.1f}')
+    print(f'{"client plain class":>22} {plain_size / 2 ** 20:>8.1f} {plain_size / n:>9.0f}')
+    print(f'{"client __slots__":>22} {slots_size / 2 ** 20:>8.1f} {slots_size / n:>9.0f}')
@@ -0,0 +1,62 @@
+'''
+frames per second read by FrameReader against read_message() over read_n_bytes()
+
+run from the repository root:
+    python -m benchmarks.reader
+'''
+import argparse
+import socket
+import threading
+import time
+
+from protocol import FrameReader, decode_message, encode_message, read_message
+
+
+def send_all(sock, data):
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+
+#frames per second decoded from a socket fed with count copies of message
+def run(message, count, use_reader):
+    data = encode_message(message) * count
+    receiver, sender = socket.socketpair()
+    writer = threading.Thread(target=send_all, args=(sender, data))
+    started = time.perf_counter()
+    writer.start()
+    received = 0
+    if use_reader:
+        reader = FrameReader(receiver.recv_into)
+        try:
+            while True:
+                for body in reader.read_frames():
+                    decode_message(body)
+                    received += 1
+        except ConnectionError:
+            pass
+    else:
+        while received < count:
+            read_message(receiver.recv)
+            received += 1
+    elapsed = time.perf_counter() - started
+    writer.join()
+    receiver.close()
+    sender.close()
+    assert received == count
+    return count / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000, help='small frames per run, large runs use a tenth')
+    args = parser.parse_args()
+
+    messages = {
+        'small': ({'action': 'ping', 'timestamp': time.time()}, args.count),
+        'large': ({'action': 'status', 'players': {f'10.0.{i // 256}.{i % 256}:5000': {'score': i} for i in range(300)}}, args.count // 10),
+    }
+    print(f'{"message":>8} {"bytes":>6} {"read_n_bytes frames/s":>22} {"FrameReader frames/s":>21}')
+    for name, (message, count) in messages.items():
+        old = run(message, count, False)
+        new = run(message, count, True)
+        print(f'{name:>8} {len(encode_message(message)):>6} {old:>22.0f} {new:>21.0f}')
@@ -0,0 +1,120 @@
+'''
+frame time of the client's dirty-rect renderer against redrawing the whole
+screen every frame, offscreen with the dummy video driver
+
+every frame a bubble is added, one is removed and one is locked, and the
+scores change every few frames like in a running game
+
+run from the repository root:
+    python -m benchmarks.render --bubbles 10 100 1000 --players 10 100
+'''
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+try:
+    import pygame
+    from client import Bubble, BubblePanel, StatusPanel, STATUS_PANEL_WIDTH, WIDTH, HEIGHT
+except ImportError:
+    pygame = None
+
+from config import POOL_WIDTH, POOL_HEIGHT, BUBBLE_MIN_RADIUS, BUBBLE_MAX_RADIUS
+
+
+class FakeClient:
+    def __init__(self, players):
+        self.scores = {f'10.0.0.{i}:5000': 0 for i in range(players)}
+        self.delay = 0
+
+    def get_status(self):
+        return list(self.scores.items())
+
+    def get_delay(self):
+        return self.delay
+
+
+def random_config(id):
+    return {
+        'id': id,
+        'position': (random.randint(0, POOL_WIDTH), random.randint(0, POOL_HEIGHT)),
+        'radius': random.uniform(BUBBLE_MIN_RADIUS, BUBBLE_MAX_RADIUS),
+        'color': (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)),
+        'hold_time_ms': 500,
+    }
+
+
+#one frame of the game: a bubble comes, a bubble goes, a bubble gets locked, sometimes a score moves
+def step(panel, client, frame, next_id):
+    panel.remove(random.choice(list(panel.bubbles)))
+    panel.add(Bubble(random_config(next_id)))
+    panel.lock(random.choice(list(panel.bubbles)), 'player', False)
+    if frame % 10 == 0:
+        player_id = random.choice(list(client.scores))
+        client.scores[player_id] += 1
+    if frame % 60 == 0:
+        client.delay = random.randint(0, 50)
+
+
+#the renderer before dirty rects: clear, draw every circle and render every line each frame
+def draw_everything(screen, panel, status, client, font):
+    screen.fill('black')
+    status.surface.fill(status.color)
+    position = (10, 10)
+    for player_id, player_score in client.get_status():
+        status.surface.blit(font.render(f'{player_id}: {player_score}', True, 'white'), position)
+        position = (position[0], position[1] + 30)
+    status.surface.blit(font.render(f'delay: {client.get_delay()}ms', True, 'white'), (10, status.surface.get_height() - 30))
+    for b in panel.bubbles.values():
+        pygame.draw.circle(panel.surface, b.color, b.position, b.radius)
+        if b.locked:
+            pygame.draw.circle(panel.surface, 'red' if b.locked_by_others else 'green', b.position, b.radius, 2)
+
+
+def run(bubbles, players, frames):
+    screen = pygame.display.get_surface()
+    panel = BubblePanel(screen.subsurface((0, 0, POOL_WIDTH, POOL_HEIGHT)))
+    client = FakeClient(players)
+    status = StatusPanel(client, screen.subsurface((POOL_WIDTH, 0, STATUS_PANEL_WIDTH, HEIGHT)))
+    font = pygame.font.Font(None, 30)
+    for id in range(bubbles):
+        panel.add(Bubble(random_config(id)))
+    next_id = bubbles
+
+    results = []
+    for name in ('full', 'dirty'):
+        panel.draw_all()
+        status.draw(force=True)
+        started = time.perf_counter()
+        for frame in range(frames):
+            step(panel, client, frame, next_id)
+            next_id += 1
+            if name == 'full':
+                draw_everything(screen, panel, status, client, font)
+                pygame.display.update()
+            else:
+                pygame.display.update(status.draw() + panel.draw())
+        results.append((time.perf_counter() - started) / frames)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bubbles', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--players', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--frames', type=int, default=300)
+    args = parser.parse_args()
+
+    if pygame is None:
+        raise SystemExit('pygame is not installed')
+    pygame.init()
+    pygame.display.set_mode((WIDTH, HEIGHT))
+
+    print(f'{"bubbles":>8} {"players":>8} {"full ms":>8} {"dirty ms":>9}')
+    for bubbles in args.bubbles:
+        for players in args.players:
+            full, dirty = run(bubbles, players, args.frames)
+            print(f'{bubbles:>8} {players:>8} {full * 1000:>8.2f} {dirty * 1000:>9.2f}')
+    pygame.quit()
@@ -0,0 +1,70 @@
+'''
+aggregate messages per second through ShardedServer as the worker count grows
+
+every client logs into one of several rooms and keeps a few status requests
+in flight, each reply is counted
+
+run from the repository root:
+    python -m benchmarks.rooms --workers 1 2 4
+'''
+import argparse
+import asyncio
+import resource
+import time
+
+from protocol import HEADER, decode_message, encode_message
+from rooms import ShardedServer
+
+
+async def client(port, room, in_flight, stop, counts):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(encode_message({'action': 'login', 'room': room}))
+    request = encode_message({'action': 'status'})
+    writer.write(request * in_flight)
+    try:
+        while not stop.is_set():
+            size = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+            message = decode_message(await reader.readexactly(size))
+            if message.get('action') == 'status':
+                counts[0] += 1
+                writer.write(request)
+    finally:
+        writer.close()
+
+
+async def run(port, clients, rooms, in_flight, duration):
+    stop = asyncio.Event()
+    counts = [0]
+    tasks = [asyncio.create_task(client(port, f'room-{i % rooms}', in_flight, stop, counts)) for i in range(clients)]
+    # warm up, then count
+    await asyncio.sleep(1)
+    counts[0] = 0
+    started = time.perf_counter()
+    await asyncio.sleep(duration)
+    rate = counts[0] / (time.perf_counter() - started)
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=16)
+    parser.add_argument('--in-flight', type=int, default=4, help='status requests each client keeps pending')
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.clients * 2 * len(args.workers) + 100)), hard))
+
+    print(f'{"workers":>7} {"messages/s":>11}')
+    for workers in args.workers:
+        server = ShardedServer(0, workers, max_sessions=0, accept_rate=0)
+        server.start()
+        port = server.listen_socket.getsockname()[1]
+        rate = asyncio.run(run(port, args.clients, args.rooms, args.in_flight, args.duration))
+        print(f'{workers:>7} {rate:>11.0f}')
@@ -0,0 +1,131 @@
+'''
+login, disconnect and broadcast cost with the session and player indexes
+against the scans they replace, over sessions that drop what is sent to them
+
+a relogin is a player reconnecting from the same address, the server closes
+its previous session. a disconnect removes the player and tells the others.
+both include the broadcast announcing them, like in a running game. alloc is
+what tracemalloc sees allocated by one broadcast
+
+run from the repository root:
+    python -m benchmarks.sessions --players 100 1000 5000
+'''
+import argparse
+import random
+import time
+import tracemalloc
+
+from server import Server
+
+
+class NullSession:
+    '''
+    session whose frames go nowhere
+    '''
+    def __init__(self, remote_address):
+        self.remote_address = remote_address
+        self.codec = None
+        self.compressor = None
+        self.is_active = True
+
+    def write_message(self, message, key=None):
+        pass
+
+    def write_frame(self, frame, key=None):
+        pass
+
+    def frames_lost(self):
+        return False
+
+    def close(self):
+        self.is_active = False
+
+
+class ScanServer(Server):
+    '''
+    Server with the scans of before the indexes
+    '''
+    def session_tuple(self):
+        return list(self.sessions.values())
+
+    def unregister_session(self, session):
+        for client_address in list(self.sessions):
+            if self.sessions[client_address] == session:
+                del self.sessions[client_address]
+                break
+
+    def remove_session(self, session):
+        self.unregister_session(session)
+        removed = []
+        for player_id in list(self.players):
+            if self.players[player_id]['session'] == session:
+                self.players.pop(player_id, None)
+                self.bubble_manager.unlock(player_id)
+                removed.append(player_id)
+        if removed:
+            self.publish_scores({}, removed)
+
+
+def address(i):
+    return (f'10.{i // 65536}.{i // 256 % 256}.{i % 256}', 50000)
+
+
+def login(server, i):
+    session = NullSession(address(i))
+    server.register_session(session)
+    server._handle_message(session, {'action': 'login'})
+    # without a game loop the join window never ends, announce the player now
+    server.publish_joins()
+    return session
+
+
+#seconds per relogin, disconnect and broadcast, and bytes allocated by one broadcast
+def run(server_class, players, operations):
+    server = server_class(None, login_timeout_s=0)
+    sessions = [login(server, i) for i in range(players)]
+    picks = [random.randrange(players) for _ in range(operations)]
+
+    started = time.perf_counter()
+    for i in picks:
+        sessions[i] = login(server, i)
+    relogin = (time.perf_counter() - started) / operations
+
+    disconnect = 0
+    for i in picks:
+        started = time.perf_counter()
+        server.remove_session(sessions[i])
+        disconnect += time.perf_counter() - started
+        sessions[i] = login(server, i)
+    disconnect /= operations
+
+    message = {'action': 'bubble_expired', 'bubble_id': 1}
+    started = time.perf_counter()
+    for _ in range(operations):
+        server.send_to_all(message)
+    broadcast = (time.perf_counter() - started) / operations
+
+    tracemalloc.start()
+    server.send_to_all(message)
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    server.send_to_all(message)
+    alloc = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    assert len(server.sessions) == len(server.players) == players
+    return relogin, disconnect, broadcast, alloc
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--players', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--operations', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f'{"players":>7} {"server":>8} {"relogin us":>11} {"disconnect us":>14} {"broadcast us":>13} {"alloc B":>8}')
+    for players in args.players:
+        for name, server_class in (('scan', ScanServer), ('indexed', Server)):
+            random.seed(players)
+            relogin, disconnect, broadcast, alloc = run(server_class, players, args.operations)
+            print(f'{players:>7} {name:>8} {relogin * 1e6:>11.1f} {disconnect * 1e6:>14.1f} '
+                f'{broadcast * 1e6:>13.1f} {alloc:>8}')
@@ -0,0 +1,96 @@
+'''
+compare the spatial index and lock map with the linear scans they replace
+
+run from the repository root:
+    python -m benchmarks.spatial --bubbles 100 1000 10000
+'''
+import argparse
+import random
+import timeit
+from types import SimpleNamespace
+
+from config import POOL_WIDTH, POOL_HEIGHT, BUBBLE_MIN_RADIUS, BUBBLE_MAX_RADIUS
+from server import BubbleManager
+from spatial import BubbleGrid, in_bubble
+
+
+#the client lookup before the grid
+def scan_bubble_at(bubbles, position):
+    for b in bubbles.values():
+        if in_bubble(position, b):
+            return b
+    return None
+
+
+#the previous lock lookup in BubbleManager.try_lock
+def scan_locked_by(bubbles, player_id):
+    for id in list(bubbles):
+        if bubbles[id]['locked_by'] == player_id:
+            return id
+    return None
+
+
+class NullServer:
+    tick_s = 0
+
+    def lock_bubble(self, bubble_id, player_id):
+        pass
+
+    def deadline_added(self, deadline):
+        pass
+
+
+def bench_click(n, clicks):
+    bubbles, grid = {}, BubbleGrid()
+    for id in range(n):
+        bubble = SimpleNamespace(
+            id=id,
+            position=(random.randint(0, POOL_WIDTH), random.randint(0, POOL_HEIGHT)),
+            radius=random.uniform(BUBBLE_MIN_RADIUS, BUBBLE_MAX_RADIUS))
+        bubbles[id] = bubble
+        grid.insert(bubble)
+    positions = [(random.randint(0, POOL_WIDTH), random.randint(0, POOL_HEIGHT)) for _ in range(clicks)]
+    for position in positions:
+        assert scan_bubble_at(bubbles, position) is grid.at(position)
+    scan = timeit.timeit(lambda: [scan_bubble_at(bubbles, p) for p in positions], number=1)
+    indexed = timeit.timeit(lambda: [grid.at(p) for p in positions], number=1)
+    return scan / clicks, indexed / clicks
+
+
+def bench_lock(n, locks):
+    manager = BubbleManager(NullServer())
+    ids = [manager.bubbles.add((0, 0), BUBBLE_MIN_RADIUS, (0, 0, 0), 0.0, 1000, 1) for _ in range(n)]
+    player_id = 'player'
+    # move the lock of one player across random bubbles, never twice onto the same one
+    targets = [ids[0]]
+    while len(targets) < locks:
+        bubble_id = random.choice(ids)
+        if bubble_id != targets[-1]:
+            targets.append(bubble_id)
+
+    def indexed():
+        for bubble_id in targets:
+            manager.try_lock(bubble_id, player_id)
+
+    def scan():
+        bubbles = {id: {'id': id, 'locked_by': None} for id in ids}
+        for bubble_id in targets:
+            previous = scan_locked_by(bubbles, player_id)
+            if previous is not None:
+                bubbles[previous]['locked_by'] = None
+            bubbles[bubble_id]['locked_by'] = player_id
+
+    return timeit.timeit(scan, number=1) / locks, timeit.timeit(indexed, number=1) / locks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bubbles', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--ops', type=int, default=1000, help='clicks and lock transfers per run')
+    args = parser.parse_args()
+
+    print(f'{"bubbles":>8} {"click scan us":>14} {"click grid us":>14} {"lock scan us":>13} {"lock map us":>11}')
+    for n in args.bubbles:
+        click_scan, click_grid = bench_click(n, args.ops)
+        lock_scan, lock_map = bench_lock(n, args.ops)
+        print(f'{n:>8} {click_scan * 1e6:>14.2f} {click_grid * 1e6:>14.2f} {lock_scan * 1e6:>13.2f} {lock_map * 1e6:>11.2f}')
@@ -0,0 +1,57 @@
+'''
+bubble spawning and expiry sweeps over a large pool with numpy
+against the pure python path, after checking both give the same answers
+
+run from the repository root:
+    python -m benchmarks.vectorized --bubbles 1000 10000 100000
+'''
+import argparse
+import timeit
+
+from bubble_store import BubbleStore, numpy, random_bubbles
+from config import BUBBLE_BATCH_SIZE
+
+
+def fill(store, fields):
+    for position, radius, color, lifetime_s, hold_time_ms, value in fields:
+        store.add(position, radius, color, lifetime_s, hold_time_ms, value)
+    # holes like the ones left by consumed bubbles
+    for bubble_id in store.ids()[::7]:
+        store.remove(bubble_id)
+
+
+def run(n):
+    fields = random_bubbles(n, use_numpy=False)
+    # lifetimes are whole seconds, half of them are due
+    now = 4.5
+    stores = {}
+    for name, use_numpy in (('python', False), ('numpy', True)):
+        if use_numpy and numpy is None:
+            continue
+        store = stores[name] = BubbleStore(use_numpy=use_numpy)
+        fill(store, fields)
+    reference = stores['python']
+    for store in stores.values():
+        assert store.expired(now) == reference.expired(now)
+
+    results = {}
+    for name, store in stores.items():
+        use_numpy = store.use_numpy
+        batch = BUBBLE_BATCH_SIZE if use_numpy else 1
+        spawn = timeit.timeit(lambda: random_bubbles(batch, use_numpy), number=max(1, 10000 // batch)) / (max(1, 10000 // batch) * batch)
+        sweep = timeit.timeit(lambda: store.expired(now), number=5) / 5
+        results[name] = (spawn, sweep)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bubbles', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    if numpy is None:
+        print('numpy is not installed, only the python path is measured')
+    print(f'{"bubbles":>8} {"path":>7} {"spawn us":>9} {"sweep ms":>9}')
+    for n in args.bubbles:
+        for name, (spawn, sweep) in run(n).items():
+            print(f'{n:>8} {name:>7} {spawn * 1e6:>9.2f} {sweep * 1e3:>9.2f}')
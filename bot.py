@@ -0,0 +1,187 @@
+'''
+headless players for load testing a server, no pygame or display needed
+
+every bot is a ClientState with its own Session, one driver thread makes
+them ping, poll the status and click bubbles at the given rates
+
+    python bot.py localhost -p 8000 --bots 1000 --duration 30
+'''
+import random
+import threading
+import time
+
+from client_state import BubbleSet, ClientState
+
+#value at the q quantile of the samples, 0 without samples
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+class BotClient(ClientState):
+    '''
+    simulated player recording what it measures
+    '''
+    # the driver thread clicks while the session thread applies messages, so nothing is shown ahead of the server
+    predict_locks = False
+
+    def __init__(self, server_addr):
+        super().__init__(server_addr, BubbleSet())
+        # round trip of every ping answered
+        self.ping_rtts = []
+        # bubble_id -> when our lock was sent, until the bubble is consumed or gone
+        self.locks_sent = {}
+        # lock sent to bubble_consumed, and the same minus the hold time the server waits on purpose
+        self.lock_latencies = []
+        self.lock_overheads = []
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.login()
+
+    def handle_message(self, session, message):
+        action = message.get('action')
+        if action != 'batch':
+            # count the events of a batch, not the batch
+            self.messages_received += 1
+        if action == 'ping':
+            self.ping_rtts.append(time.time() - message['timestamp'])
+        elif action == 'bubble_consumed' or action == 'bubble_expired':
+            sent = self.locks_sent.pop(message['bubble_id'], None)
+            if sent is not None and action == 'bubble_consumed' and message['player_id'] == self.player_id:
+                latency = time.time() - sent[0]
+                self.lock_latencies.append(latency)
+                self.lock_overheads.append(latency - sent[1] / 1000)
+        super().handle_message(session, message)
+
+    def write_message(self, message):
+        self.messages_sent += 1
+        super().write_message(message)
+
+    def ping(self):
+        self.write_message({
+            'action': 'ping',
+            'timestamp': time.time()
+        })
+
+    def poll_status(self):
+        self.write_message({
+            'action': 'status'
+        })
+
+    #click a random bubble that nobody locks, False if there is none or we are not logged in yet
+    def click(self):
+        if self.player_id is None:
+            return False
+        try:
+            bubble = random.choice(list(self.bubble_set.bubbles.values()))
+        except IndexError:
+            return False
+        if bubble.locked:
+            return False
+        self.locks_sent[bubble.id] = (time.time(), bubble.hold_time_ms)
+        self.lock_bubble(bubble)
+        return True
+
+    def close(self):
+        self.session.close()
+
+class BotDriver:
+    '''
+    drives every bot from one thread, actions are spread randomly so the bots do not act in lockstep
+    '''
+    def __init__(self, bots, ping_rate=1, status_rate=0.5, click_rate=1, tick_s=0.01):
+        self.bots = bots
+        # actions per second per bot
+        self.actions = [(rate, action) for rate, action in (
+            (ping_rate, BotClient.ping),
+            (status_rate, BotClient.poll_status),
+            (click_rate, BotClient.click)) if rate > 0]
+        self.tick_s = tick_s
+        self.running = False
+
+    def _run(self):
+        now = time.perf_counter()
+        # per bot, the time each action is due next
+        due = [[now + random.expovariate(rate) for rate, _ in self.actions] for _ in self.bots]
+        while self.running:
+            now = time.perf_counter()
+            for bot, deadlines in zip(self.bots, due):
+                for index, (rate, action) in enumerate(self.actions):
+                    if deadlines[index] <= now:
+                        deadlines[index] = now + random.expovariate(rate)
+                        try:
+                            action(bot)
+                        except:
+                            pass # logging.warning(f'{bot.session} failed to send')
+            time.sleep(self.tick_s)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, args=(), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+#connect the bots, let them play for duration seconds and report what they measured
+def run_bots(server_addr, count, duration, ping_rate=1, status_rate=0.5, click_rate=1, warmup=1):
+    bots = [BotClient(server_addr) for _ in range(count)]
+    driver = BotDriver(bots, ping_rate, status_rate, click_rate)
+    driver.start()
+    time.sleep(warmup)
+    # count from here, the logins and snapshots are behind us
+    for bot in bots:
+        bot.ping_rtts, bot.lock_latencies, bot.lock_overheads = [], [], []
+        bot.messages_received = bot.messages_sent = 0
+    started = time.perf_counter()
+    time.sleep(duration)
+    elapsed = time.perf_counter() - started
+    driver.stop()
+    report = {
+        'bots': count,
+        'logged_in': sum(bot.player_id is not None for bot in bots),
+        'disconnected': sum(not bot.session.is_active for bot in bots),
+        'sent_per_s': sum(bot.messages_sent for bot in bots) / elapsed,
+        'received_per_s': sum(bot.messages_received for bot in bots) / elapsed,
+    }
+    for name, attribute in (('ping_rtt', 'ping_rtts'), ('lock_to_consumed', 'lock_latencies'),
+            ('lock_overhead', 'lock_overheads')):
+        samples = [sample for bot in bots for sample in getattr(bot, attribute)]
+        report[name] = {
+            'count': len(samples),
+            'p50': percentile(samples, 0.5),
+            'p99': percentile(samples, 0.99),
+        }
+    for bot in bots:
+        bot.close()
+    return report
+
+def print_report(report):
+    print(f'{report["bots"]} bots, {report["logged_in"]} logged in, {report["disconnected"]} disconnected')
+    print(f'sent {report["sent_per_s"]:.0f} messages/s, received {report["received_per_s"]:.0f} messages/s')
+    for name in ('ping_rtt', 'lock_to_consumed', 'lock_overhead'):
+        samples = report[name]
+        print(f'{name}: {samples["count"]} samples, '
+            f'p50 {samples["p50"] * 1000:.1f}ms, p99 {samples["p99"] * 1000:.1f}ms')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('server', nargs='?', default='localhost')
+    parser.add_argument('-p', '--port', default=80, type=int)
+    parser.add_argument('-s', '--self-host', action='store_true')
+    parser.add_argument('--bots', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10, help='seconds to measure')
+    parser.add_argument('--ping-rate', type=float, default=1, help='pings per second per bot')
+    parser.add_argument('--status-rate', type=float, default=0.5, help='status requests per second per bot')
+    parser.add_argument('--click-rate', type=float, default=1, help='bubble clicks per second per bot')
+    args = parser.parse_args()
+
+    if args.self_host:
+        from server import Server
+        Server(args.port).start(daemon=True)
+
+    print_report(run_bots((args.server, args.port), args.bots, args.duration,
+        args.ping_rate, args.status_rate, args.click_rate))
@@ -0,0 +1,198 @@
+import math
+import random
+from array import array
+from collections import deque
+from itertools import compress
+
+from config import (
+    USE_NUMPY,
+    POOL_WIDTH, POOL_HEIGHT,
+    BUBBLE_MIN_LIFETIME_SEC, BUBBLE_MAX_LIFETIME_SEC,
+    BUBBLE_MIN_VALUE, BUBBLE_MAX_VALUE,
+    BUBBLE_MAX_RADIUS, BUBBLE_MIN_RADIUS)
+
+try:
+    import numpy
+except ImportError:
+    # optional, the arrays are scanned in python without it
+    numpy = None
+
+# a bubble id is its slot in the low bits and the slot's generation above them,
+# so reusing a slot still gives a new id and a stale id never finds the new bubble
+SLOT_BITS = 20
+SLOT_MASK = (1 << SLOT_BITS) - 1
+# ids stay below 2 ** 31 to fit the binary codec's int
+GENERATION_MASK = (1 << (31 - SLOT_BITS)) - 1
+
+class BubbleStore:
+    '''
+    bubbles of the server as one array per field instead of one dict per bubble
+
+    slots are preallocated and doubled when full, the slots of removed bubbles
+    are reused oldest first. the fields of the bubble with id are read as
+    store.<field>[store.slot(id)], config() builds the dict sent to clients.
+    not thread safe, only the game loop uses it
+
+    with numpy the sweeps and hit tests run over views of the arrays,
+    the views are dropped before returning so the arrays can still grow
+    '''
+    def __init__(self, capacity=64, use_numpy=USE_NUMPY):
+        self.use_numpy = use_numpy and numpy is not None
+        self.capacity = 0
+        self.generation = array('H')
+        self.live = bytearray()
+        # pool coordinates, hold times and values are small and never negative
+        self.x = array('H')
+        self.y = array('H')
+        self.radius = array('f')
+        # 0xRRGGBB
+        self.color = array('I')
+        self.expire_time_s = array('d')
+        self.hold_time_ms = array('H')
+        # nan while the bubble was never locked
+        self.lock_time = array('d')
+        self.value = array('H')
+        # player ids are strings, the only field kept as objects
+        self.locked_by = []
+        # slots freed by removed bubbles, slots from next_slot on were never used
+        self.free = deque()
+        self.next_slot = 0
+        self.count = 0
+        self._grow(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, bubble_id):
+        return self.slot(bubble_id) is not None
+
+    def _grow(self, capacity):
+        capacity = min(capacity, SLOT_MASK + 1)
+        added = capacity - self.capacity
+        if added <= 0:
+            raise MemoryError('bubble store is full')
+        for field in (self.generation, self.x, self.y, self.color, self.hold_time_ms, self.value):
+            field.extend([0] * added)
+        for field in (self.radius, self.expire_time_s, self.lock_time):
+            field.extend([0.0] * added)
+        self.live.extend(bytes(added))
+        self.locked_by.extend([None] * added)
+        self.capacity = capacity
+
+    #slot of the live bubble with this id, None if it is gone
+    def slot(self, bubble_id):
+        slot = bubble_id & SLOT_MASK
+        if (slot < self.capacity and self.live[slot]
+                and self.generation[slot] == bubble_id >> SLOT_BITS):
+            return slot
+        return None
+
+    def id_of(self, slot):
+        return self.generation[slot] << SLOT_BITS | slot
+
+    #store a new bubble and return its id
+    def add(self, position, radius, color, expire_time_s, hold_time_ms, value):
+        if self.free:
+            slot = self.free.popleft()
+        else:
+            if self.next_slot == self.capacity:
+                self._grow(self.capacity * 2)
+            slot = self.next_slot
+            self.next_slot += 1
+        self.generation[slot] = (self.generation[slot] + 1) & GENERATION_MASK
+        self.live[slot] = 1
+        self.x[slot], self.y[slot] = position
+        self.radius[slot] = radius
+        self.color[slot] = color[0] << 16 | color[1] << 8 | color[2]
+        self.expire_time_s[slot] = expire_time_s
+        self.hold_time_ms[slot] = hold_time_ms
+        self.lock_time[slot] = math.nan
+        self.value[slot] = value
+        self.locked_by[slot] = None
+        self.count += 1
+        return self.id_of(slot)
+
+    def remove(self, bubble_id):
+        slot = self.slot(bubble_id)
+        if slot is None:
+            return False
+        self.live[slot] = 0
+        self.locked_by[slot] = None
+        self.free.append(slot)
+        self.count -= 1
+        return True
+
+    #the bubble as sent to clients, with the keys of the former bubble dicts
+    def config(self, bubble_id):
+        slot = self.slot(bubble_id)
+        color = self.color[slot]
+        lock_time = self.lock_time[slot]
+        return {
+            'id': bubble_id,
+            'position': (self.x[slot], self.y[slot]),
+            'radius': self.radius[slot],
+            'color': (color >> 16, color >> 8 & 0xFF, color & 0xFF),
+            'expire_time_s': self.expire_time_s[slot],
+            'locked_by': self.locked_by[slot],
+            'hold_time_ms': self.hold_time_ms[slot],
+            'lock_time': None if math.isnan(lock_time) else lock_time,
+            'value': self.value[slot],
+        }
+
+    #ids of the live bubbles in slot order
+    def ids(self):
+        live, generation = self.live, self.generation
+        return [generation[slot] << SLOT_BITS | slot for slot in range(self.next_slot) if live[slot]]
+
+    def configs(self):
+        return [self.config(bubble_id) for bubble_id in self.ids()]
+
+    #ids of the live bubbles whose expiry time is at or before now, one pass over two arrays
+    def expired(self, now):
+        if self.use_numpy:
+            return self._expired_numpy(now)
+        live, generation = self.live, self.generation
+        # the comparison runs in C over the whole array, only due slots reach python code
+        due = compress(range(self.next_slot), map(float(now).__ge__, self.expire_time_s))
+        return [generation[slot] << SLOT_BITS | slot for slot in due if live[slot]]
+
+    def _expired_numpy(self, now):
+        n = self.next_slot
+        if not n:
+            return []
+        due = numpy.frombuffer(self.expire_time_s, numpy.float64, n) <= now
+        due &= numpy.frombuffer(self.live, numpy.uint8, n) != 0
+        return self._ids_numpy(numpy.flatnonzero(due))
+
+    def _ids_numpy(self, slots):
+        generation = numpy.frombuffer(self.generation, numpy.uint16, self.next_slot)[slots].astype(numpy.int64)
+        return ((generation << SLOT_BITS) | slots).tolist()
+
+#fields of count new bubbles as (position, radius, color, lifetime_s, hold_time_ms, value),
+#with numpy one call per field generates the whole batch.
+#rng is the random module or a random.Random, the same rng state gives the same bubbles
+def random_bubbles(count, use_numpy=USE_NUMPY, rng=random):
+    if use_numpy and numpy is not None:
+        # seeded from rng so a seeded rng makes the batch reproducible too
+        rng = numpy.random.default_rng(rng.getrandbits(64))
+        value = rng.integers(BUBBLE_MIN_VALUE, BUBBLE_MAX_VALUE, count, endpoint=True)
+        radius = BUBBLE_MIN_RADIUS + ((value - BUBBLE_MIN_VALUE) / (BUBBLE_MAX_VALUE - BUBBLE_MIN_VALUE) * (BUBBLE_MAX_RADIUS - BUBBLE_MIN_RADIUS))
+        # tolist() gives python ints and floats, which the binary codec expects
+        return list(zip(
+            zip(rng.integers(0, POOL_WIDTH, count, endpoint=True).tolist(),
+                rng.integers(0, POOL_HEIGHT, count, endpoint=True).tolist()),
+            radius.tolist(),
+            map(tuple, rng.integers(0, 255, (count, 3), endpoint=True).tolist()),
+            rng.integers(BUBBLE_MIN_LIFETIME_SEC, BUBBLE_MAX_LIFETIME_SEC, count, endpoint=True).tolist(),
+            rng.integers(100, 2000, count, endpoint=True).tolist(),
+            value.tolist()))
+    bubbles = []
+    for _ in range(count):
+        position = rng.randint(0, POOL_WIDTH), rng.randint(0, POOL_HEIGHT)
+        value = rng.randint(BUBBLE_MIN_VALUE, BUBBLE_MAX_VALUE)
+        radius = BUBBLE_MIN_RADIUS + ((value - BUBBLE_MIN_VALUE) / (BUBBLE_MAX_VALUE - BUBBLE_MIN_VALUE) * (BUBBLE_MAX_RADIUS - BUBBLE_MIN_RADIUS))
+        lifetime_s = rng.randint(BUBBLE_MIN_LIFETIME_SEC, BUBBLE_MAX_LIFETIME_SEC)
+        color = rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)
+        hold_time_ms = rng.randint(100, 2000)
+        bubbles.append((position, radius, color, lifetime_s, hold_time_ms, value))
+    return bubbles
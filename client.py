@@ -1,72 +1,101 @@
+import functools
 import pygame
-import socket
 import time
+from collections import deque
 
 from config import POOL_WIDTH, POOL_HEIGHT
-from session import Session
+from client_state import BubbleState, BubbleSet, ClientState
 
 STATUS_PANEL_WIDTH = 400
 WIDTH, HEIGHT = POOL_WIDTH + STATUS_PANEL_WIDTH, POOL_HEIGHT
-
-class Bubble:
-
-    def __str__(self):
-        #client player id, position, radius, color, locked, locked_by, locked_by_others
-        return str({
-            'id': self.id,
-            'position': self.position,
-            'radius': self.radius,
-            'color': self.color,
-            'locked': self.locked,
-            'locked_by': self.locked_by,
-            'locked_by_others': self.locked_by_others,
-        })
-    #Client initialize player id, position, radius, color, locked, locked_by, locked_by_others
-    def __init__(self, config):
-        self.id = config['id']
-        self.position = config['position']
-        self.radius = config['radius']
-        self.color = config['color']
-        self.locked = False
-        self.locked_by_others = False
-        self.locked_by = None
-    #Client draw bubbles on screen with pygame.draw.circle
+# most bubble sprites and text surfaces kept rendered, least recently used ones are dropped
+SPRITE_CACHE_SIZE = 1024
+TEXT_CACHE_SIZE = 256
+
+#circle of the bubble with its lock ring on a transparent surface, drawn once per look
+@functools.lru_cache(maxsize=SPRITE_CACHE_SIZE)
+def bubble_sprite(radius, color, ring):
+    size = int(radius) * 2 + 2
+    sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+    center = (size / 2, size / 2)
+    pygame.draw.circle(sprite, color, center, radius)
+    if ring is not None:
+        pygame.draw.circle(sprite, ring, center, radius, 2)
+    return sprite
+
+class Bubble(BubbleState):
+    __slots__ = ()
+    #the screen area the bubble covers
+    def rect(self):
+        size = int(self.radius) * 2 + 2
+        return pygame.Rect(self.position[0] - size // 2, self.position[1] - size // 2, size, size)
+    #Client blits the cached sprite of the bubble on screen
 
     def draw(self, screen):
-        pygame.draw.circle(
-            screen,
-            self.color,
-            self.position,
-            self.radius)
+        ring = None
         if self.locked:
-            pygame.draw.circle(
-                screen,
-                'red' if self.locked_by_others else 'green',
-                self.position,
-                self.radius,
-                2)
+            ring = 'red' if self.locked_by_others else 'green'
+        screen.blit(bubble_sprite(self.radius, tuple(self.color), ring), self.rect())
     
-class BubblePanel:
+class BubblePanel(BubbleSet):
     '''
     Manage bubbles
     '''
      #Client initialize bubbles with config.py file
     def __init__(self, surface):
-        self.bubbles = {}
+        super().__init__()
         self.surface = surface
+        self.offset = surface.get_abs_offset()
+        # areas changed since the last draw
+        self.dirty = deque()
+    def add(self, bubble):
+        super().add(bubble)
+        self.dirty.append(bubble.rect())
+    def clear(self):
+        super().clear()
+        self.dirty.append(self.surface.get_rect())
+    def remove(self, bubble_id):
+        bubble = self.bubbles.get(bubble_id)
+        super().remove(bubble_id)
+        if bubble is not None:
+            self.dirty.append(bubble.rect())
+    #the bubble the player locked loses its ring
+    def unlock(self, player_id):
+        bubble = self.bubbles.get(self.locked_bubbles.get(player_id))
+        super().unlock(player_id)
+        if bubble is not None:
+            self.dirty.append(bubble.rect())
+    #the previous bubble of the player loses its ring in unlock()
+    def lock(self, bubble_id, player_id, locked_by_others):
+        super().lock(bubble_id, player_id, locked_by_others)
+        bubble = self.bubbles.get(bubble_id)
+        if bubble is not None:
+            self.dirty.append(bubble.rect())
     #draw all bubbles on screen
-    def draw(self):
+    def draw_all(self):
         '''
         draw all bubbles
         '''
-        for b in self.bubbles.values():
+        self.dirty.clear()
+        self.surface.fill('black')
+        # always in id order so overlapping bubbles stack the same way when redrawn
+        for b in sorted(list(self.bubbles.values()), key=lambda b: b.id):
             b.draw(self.surface)
+    #redraw the areas that changed, return them in screen coordinates
+    def draw(self):
+        rects = []
+        while self.dirty:
+            rect = self.dirty.popleft().clip(self.surface.get_rect())
+            if not rect:
+                continue
+            self.surface.set_clip(rect)
+            self.surface.fill('black', rect)
+            for b in sorted(self.grid.overlapping(rect.left, rect.top, rect.right, rect.bottom).values(), key=lambda b: b.id):
+                b.draw(self.surface)
+            rects.append(rect.move(self.offset))
+        self.surface.set_clip(None)
+        return rects
 
-def in_bubble(position, bubble):
-    pos1 = position
-    pos2 = bubble.position
-    radius = bubble.radius
-    return (pos1[0] - pos2[0]) ** 2 + (pos1[1] - pos2[1]) ** 2 <= radius ** 2
 #Centering the selected windows in the centered of the screen.
 def centered(parent, target):
     x = (parent.get_width() - target.get_width()) / 2
@@ -81,147 +110,91 @@ class StatusPanel:
         self.surface = surface
         self.color = (50, 50, 50)
         self.font = pygame.font.Font(None, 30)
-#render player_id (ip address) and player_score (score) and delay (delay)
-    def draw(self):
+        # the lines on screen, the panel is redrawn only when they change
+        self.lines = None
+    #rendered text surface, cached by content
+    @functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+    def render(self, text):
+        return self.font.render(text, True, 'white')
+#render player_id (ip address) and player_score (score) and delay (delay), return the screen area redrawn
+    def draw(self, force=False):
+        lines = [f'{player_id}: {player_score}' for player_id, player_score in self.client.get_status()]
+        lines.append(f'delay: {self.client.get_delay()}ms')
+        if lines == self.lines and not force:
+            return []
+        self.lines = lines
         self.surface.fill(self.color)
         position = (10, 10)
-        for player_id, player_score in self.client.get_status():
-            text = self.font.render(f'{player_id}: {player_score}', True, 'white')
-            self.surface.blit(text, position)
+        for text in lines[:-1]:
+            self.surface.blit(self.render(text), position)
             position = (position[0], position[1] + 30)
-        delay_text = self.font.render(f'delay: {self.client.get_delay()}ms', True, 'white')
-        self.surface.blit(delay_text, (10, self.surface.get_height() - 30))
+        self.surface.blit(self.render(lines[-1]), (10, self.surface.get_height() - 30))
+        return [self.surface.get_rect(topleft=self.surface.get_abs_offset())]
 
-#Client initialize client with server_address and screen
-class Client:
-    def __init__(self, server_addr, screen):
-        self.socket = socket.socket()
-        self.socket.connect(server_addr)
-        self.input_messages = []
-        self.session = Session(self.socket, server_addr, self.handle_message)
-        self.player_id = None
-        self.player_score = 0
-        self.players = {}
-        self.delay = 0
+#Client initialize client with server_address and screen, the game state lives in ClientState
+class Client(ClientState):
+    # the session thread queues messages and the main loop applies them, so only the main thread touches the panels
+    queue_messages = True
 
+    def __init__(self, server_addr, screen, datagram=False):
         self.screen = screen
-        # for game over
-        self.winner = 'Nobody'
-        self.game_over = False
         self.font = pygame.font.Font(None, 30)
-        
-        self.login()
 
         self.bubble_panel = BubblePanel(self.screen.subsurface((0, 0, POOL_WIDTH, POOL_HEIGHT)))
         self.status_panel = StatusPanel(self, self.screen.subsurface((POOL_WIDTH, 0, STATUS_PANEL_WIDTH, HEIGHT)))
 
         self.sync_delay = 0
-#get delay function from session class
-    def get_delay(self):
-        return int(self.delay * 1000)
-#Client login
-    def login(self):
-        self.session.write_message({
-            'action': 'login'
-        })
-#Handle message fucntion by reading message from socket using jason
-    def handle_message(self, session, message):
-        action = message.get('action', None)
-         #delay message which is passed from server to client
-        if action == 'ping':
-            self.delay = time.time() - message['timestamp']
-            #player_id message which is passed from server to client
-        elif action == 'login':
-            self.player_id = message['player_id']
-            #bubble message which is passed from server to client
-        elif action == 'bubble_added':
-            bubble = Bubble(message)
-            self.bubble_panel.bubbles[bubble.id] = bubble
-            #bubble expired message which is passed from server to client
-        elif action == 'bubble_expired':
-            bubble_id = message['bubble_id']
-            if bubble_id in self.bubble_panel.bubbles:
-                del self.bubble_panel.bubbles[message['bubble_id']]
-                #bubble locked message which is passed from server to client
-        elif action == 'bubble_locked':
-            for bubble_id in self.bubble_panel.bubbles:
-                bubble = self.bubble_panel.bubbles[bubble_id]
-                if bubble_id == message['bubble_id']:
-                    bubble.locked = True
-                    bubble.locked_by_others = message['player_id'] != self.player_id
-                    bubble.locked_by = message['player_id']
-                elif bubble.locked_by == message['player_id']:
-                    bubble.locked = False
-                    bubble.locked_by_others = False
-                    bubble.locked_by = None
-        #bubble consumed message which is passed from server to client
-        elif action == 'bubble_consumed':
-            bubble_id = message['bubble_id']
-            del self.bubble_panel.bubbles[bubble_id]
-        #player status message which is passed from server to client
-        elif action == 'status':
-            self.players = message['players']
-            #game over message which is passed from server to client
-        elif action == 'game_over':
-            self.game_over = True
-            self.winner = message['winner']
-            self.game_over_text = self.font.render(f'{self.winner} wins!', True, 'red')
-            self.game_over_position = centered(self.screen, self.game_over_text)
-        else:
-            print('unknown message:', message)
-    #Client send message to server for server to handle
-    def write_message(self, message):
-        self.session.write_message(message)
+        # the first frame and the game over screen redraw everything
+        self.full_redraw = True
+
+        super().__init__(server_addr, self.bubble_panel, datagram)
+
+        # log in once the panels exist, the snapshot fills them
+        self.login()
+
+    def create_bubble(self, config):
+        return Bubble(config)
+
+    def on_game_over(self):
+        self.game_over_text = self.font.render(f'{self.winner} wins!', True, 'red')
+        self.game_over_position = centered(self.screen, self.game_over_text)
+        self.full_redraw = True
      #update function to keep server updated
     def update(self, tick_in_ms):
         self.sync_delay += tick_in_ms
+        # scores arrive as deltas, only the ping is polled
         if self.sync_delay >= 1000:
             self.sync_delay = 0
-            self.write_message({
-                'action': 'status'
-            })
-            self.write_message({
-                'action': 'ping',
-                'timestamp': time.time()
-            })
+            self.ping()
 
- #draw function to initialize status panel and bubble panel and set the background to black
+ #draw function to initialize status panel and bubble panel and set the background to black,
+ #return the screen areas that changed for pygame.display.update()
     def draw(self):
-        self.screen.fill('black')
+        if self.full_redraw:
+            self.full_redraw = False
+            self.screen.fill('black')
+            if self.game_over:
+                self.screen.blit(self.game_over_text, self.game_over_position)
+            else:
+                self.status_panel.draw(force=True)
+                self.bubble_panel.draw_all()
+            return [self.screen.get_rect()]
         if self.game_over:
-            self.screen.blit(self.game_over_text, self.game_over_position)
-        else:
-            self.status_panel.draw()
-            self.bubble_panel.draw()
-    #get bubble function to get bubble from bubble panel
-    def get_bubble_at(self, pos):
-        for b in self.bubble_panel.bubbles.values():
-            if in_bubble(pos, b):
-                return b
-        return None
+            return []
+        return self.status_panel.draw() + self.bubble_panel.draw()
     #locking bubble function to lock bubble from bubble panel
     def lock_bubble(self, bubble):
         print(f'lock bubble: {bubble.id}')
-        self.write_message({
-            'action': 'lock',
-            'bubble_id': bubble.id,
-            'player_id': self.player_id,
-        })
-    #get status to show player id and the player score.
-    def get_status(self):
-        status = []
-        for player_id in self.players:
-            status.append((player_id, self.players[player_id]['score']))
-        return status
+        super().lock_bubble(bubble)
 #main function to initialize client and run the game
-def main(server_address):
+def main(server_address, datagram=False):
     pygame.init()
 
     pygame.display.set_mode((WIDTH, HEIGHT))
     pygame.display.set_caption("Client")
 
     screen = pygame.display.get_surface()
-    client = Client(server_address, screen)
+    client = Client(server_address, screen, datagram)
     #setting up FPS for each frame the client will be updated
     FPS = 60
     clock = pygame.time.Clock()
@@ -238,9 +211,9 @@ def main(server_address):
                     client.lock_bubble(bubble)
 
         tick_in_ms = clock.tick(FPS)
+        client.apply_messages()
         client.update(tick_in_ms)
-        client.draw()
-        pygame.display.update()
+        pygame.display.update(client.draw())
     
 
     pygame.quit()
@@ -254,15 +227,17 @@ if __name__ == '__main__':
     parser.add_argument('server', nargs='?', default='localhost')
     parser.add_argument('-p', '--port', default=80, type=int)
     parser.add_argument('-s', '--self-host', action='store_true')
+    parser.add_argument('--udp', action='store_true', help='ping and get scores over a datagram channel when the server offers one')
     args = parser.parse_args()
 
     # if client wants to run server on its own
     if args.self_host:
         import threading
         from server import Server
-        server_thread = threading.Thread(target=Server, args=(args.port,), daemon=True)
+        server = Server(args.port, udp_port=args.port if args.udp else None)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
         server_thread.start()
         time.sleep(1) # wait for server to start
 
-    main((args.server, args.port))
+    main((args.server, args.port), args.udp)
     
\ No newline at end of file
@@ -0,0 +1,332 @@
+import socket
+import threading
+import time
+from queue import Empty, SimpleQueue
+
+from session import Session
+from protocol import BINARY_CODEC, COMPRESSION, LOCK_ACCEPTED, LOCK_GONE, FrameCompressor
+from datagram import DatagramPeer, decode_datagram
+from spatial import BubbleGrid
+from config import CLIENT_MESSAGE_BUDGET_MS, SESSION_COMPRESS_MIN_BYTES
+
+class BubbleState:
+    '''
+    a bubble as the client knows it, without anything to draw it
+    '''
+    __slots__ = ('id', 'position', 'radius', 'color', 'hold_time_ms', 'locked', 'locked_by', 'locked_by_others')
+
+    def __str__(self):
+        #client player id, position, radius, color, locked, locked_by, locked_by_others
+        return str({
+            'id': self.id,
+            'position': self.position,
+            'radius': self.radius,
+            'color': self.color,
+            'locked': self.locked,
+            'locked_by': self.locked_by,
+            'locked_by_others': self.locked_by_others,
+        })
+    #Client initialize player id, position, radius, color, locked, locked_by, locked_by_others
+    def __init__(self, config):
+        self.id = config['id']
+        self.position = config['position']
+        self.radius = config['radius']
+        self.color = config['color']
+        self.hold_time_ms = config['hold_time_ms']
+        self.locked = False
+        self.locked_by_others = False
+        self.locked_by = None
+
+class BubbleSet:
+    '''
+    bubbles known to the client with their indexes
+    '''
+    def __init__(self):
+        self.bubbles = {}
+        # spatial index for hit-testing and player_id -> bubble_id of the bubble the player locks
+        self.grid = BubbleGrid()
+        self.locked_bubbles = {}
+    #add a bubble and index it
+    def add(self, bubble):
+        self.bubbles[bubble.id] = bubble
+        self.grid.insert(bubble)
+    #drop every bubble, used before applying a snapshot
+    def clear(self):
+        self.bubbles = {}
+        self.grid = BubbleGrid()
+        self.locked_bubbles = {}
+    #remove a bubble and drop it from the indexes
+    def remove(self, bubble_id):
+        bubble = self.bubbles.pop(bubble_id, None)
+        if bubble is None:
+            return
+        self.grid.remove(bubble)
+        if bubble.locked_by is not None and self.locked_bubbles.get(bubble.locked_by) == bubble_id:
+            del self.locked_bubbles[bubble.locked_by]
+    #release the bubble the player locks, unless another player holds it by now
+    def unlock(self, player_id):
+        bubble = self.bubbles.get(self.locked_bubbles.pop(player_id, None))
+        if bubble is not None and bubble.locked_by == player_id:
+            bubble.locked = False
+            bubble.locked_by_others = False
+            bubble.locked_by = None
+    #mark the bubble locked by the player and release the one the player locked before
+    def lock(self, bubble_id, player_id, locked_by_others):
+        if self.locked_bubbles.get(player_id) != bubble_id:
+            self.unlock(player_id)
+        bubble = self.bubbles.get(bubble_id)
+        if bubble is not None:
+            bubble.locked = True
+            bubble.locked_by_others = locked_by_others
+            bubble.locked_by = player_id
+            self.locked_bubbles[player_id] = bubble_id
+
+class ClientState:
+    '''
+    connection to the server and the game state it sends, shared by the
+    pygame client and the headless bots
+
+    with queue_messages the session thread only queues what arrives and the
+    thread owning the state applies it with apply_messages(), otherwise
+    messages are applied on the session thread as they arrive
+
+    with predict_locks a click shows the lock at once, the lock_result
+    answering it confirms it or puts back the lock the server knows of
+
+    with datagram the client asks for a datagram channel at login, pings
+    go over it once it works and scores come over it too, see datagram.py
+    '''
+    queue_messages = False
+    predict_locks = True
+
+    def __init__(self, server_addr, bubble_set, datagram=False):
+        self.server_addr = server_addr
+        self.datagram = datagram
+        # DatagramPeer once the server offered a channel
+        self.datagram_peer = None
+        self.input_messages = []
+        self.player_id = None
+        self.player_score = 0
+        self.players = {}
+        # sequence number of the last status delta applied, None until the snapshot arrives
+        self.status_seq = None
+        self.resyncing = False
+        self.delay = 0
+        self.bubble_set = bubble_set
+        # for game over
+        self.winner = 'Nobody'
+        self.game_over = False
+        # seq of the last lock sent, seq -> bubble_id of our locks shown before the server answered them
+        self.lock_seq = 0
+        self.predicted_locks = {}
+        # the bubble the server last told us we lock
+        self.confirmed_lock = None
+        # messages received and not applied yet, when queue_messages is set
+        self.inbox = SimpleQueue()
+
+        self.socket = socket.socket()
+        self.socket.connect(server_addr)
+        self.session = Session(self.socket, server_addr, self.receive)
+#get delay function from session class
+    def get_delay(self):
+        return int(self.delay * 1000)
+#Client login
+    def login(self):
+        message = {
+            'action': 'login',
+            'codecs': [BINARY_CODEC],
+            'compression': [COMPRESSION],
+        }
+        if self.datagram:
+            message['datagram'] = True
+        self.session.write_message(message)
+    #where datagrams to the server's port go
+    def datagram_address(self, port):
+        return (self.server_addr[0], port)
+    #open the datagram channel the server offered, the first ping tells the server where we are
+    def open_datagrams(self, port, token):
+        datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        datagram_socket.connect(self.datagram_address(port))
+        self.datagram_peer = DatagramPeer(datagram_socket, None, token, self.session.codec)
+        threading.Thread(target=self._read_datagrams, args=(self.datagram_peer,), daemon=True).start()
+        self.ping()
+    #datagrams go through receive() like the messages of the stream
+    def _read_datagrams(self, peer):
+        while True:
+            try:
+                data = peer.socket.recv(65536)
+            except OSError:
+                # an earlier datagram was refused, or the socket is closed
+                if peer.socket.fileno() < 0:
+                    return
+                continue
+            try:
+                _, seq, message = decode_datagram(data)
+            except:
+                continue
+            if peer.accept(seq):
+                self.receive(None, message)
+    #ping over the datagram channel once a datagram came back on it, over the stream until then
+    def ping(self):
+        message = {
+            'action': 'ping',
+            'timestamp': time.time()
+        }
+        if self.datagram_peer is not None:
+            self.datagram_peer.send(message)
+            if self.datagram_peer.up:
+                return
+        self.write_message(message)
+    #called on the session thread for every message
+    def receive(self, session, message):
+        # a ping only sets the delay, applied at once so the delay does not include the wait in the queue
+        if not self.queue_messages or message.get('action') == 'ping':
+            self.handle_message(session, message)
+        else:
+            self.inbox.put(message)
+    #apply queued messages in order until none is left or budget_ms is spent, return how many were applied
+    def apply_messages(self, budget_ms=CLIENT_MESSAGE_BUDGET_MS):
+        deadline = time.perf_counter() + budget_ms / 1000
+        applied = 0
+        while True:
+            try:
+                message = self.inbox.get_nowait()
+            except Empty:
+                break
+            try:
+                self.handle_message(self.session, message)
+            except:
+                pass # logging.exception(f'exception raised when handling {message}')
+            applied += 1
+            if time.perf_counter() >= deadline:
+                # the rest waits for the next frame
+                break
+        return applied
+    #bubble object for a bubble_added message or a snapshot entry
+    def create_bubble(self, config):
+        return BubbleState(config)
+    #called once the game is over, winner is set
+    def on_game_over(self):
+        pass
+#Handle message fucntion by reading message from socket using jason
+    def handle_message(self, session, message):
+        action = message.get('action', None)
+         #delay message which is passed from server to client
+        if action == 'ping':
+            self.delay = time.time() - message['timestamp']
+            #player_id message which is passed from server to client
+        elif action == 'login':
+            self.player_id = message['player_id']
+            self.session.codec = message.get('codec')
+            if 'compression' in message:
+                self.session.compressor = FrameCompressor(SESSION_COMPRESS_MIN_BYTES)
+            if 'udp_port' in message:
+                self.open_datagrams(message['udp_port'], message['udp_token'])
+            #bubble message which is passed from server to client
+        elif action == 'bubble_added':
+            self.bubble_set.add(self.create_bubble(message))
+            #bubble expired message which is passed from server to client
+        elif action == 'bubble_expired':
+            self.bubble_set.remove(message['bubble_id'])
+                #bubble locked message which is passed from server to client
+        elif action == 'bubble_locked':
+            if message['player_id'] == self.player_id:
+                self.confirmed_lock = message['bubble_id']
+                if self.predicted_locks:
+                    # a newer lock of ours is on screen already, its lock_result settles it
+                    return
+            self.bubble_set.lock(
+                message['bubble_id'],
+                message['player_id'],
+                message['player_id'] != self.player_id)
+        #the answer to one of our locks, answers come in the order the locks were sent
+        elif action == 'lock_result':
+            bubble_id = self.predicted_locks.pop(message['seq'], None)
+            if message['result'] == LOCK_GONE:
+                # consumed or expired on the server, the event saying so may never have reached us
+                self.bubble_set.remove(message['bubble_id'])
+            if message['result'] == LOCK_ACCEPTED:
+                self.confirmed_lock = message['bubble_id']
+            elif bubble_id is not None and not self.predicted_locks:
+                # our newest lock was refused, show the lock the server has instead
+                if self.confirmed_lock in self.bubble_set.bubbles:
+                    self.bubble_set.lock(self.confirmed_lock, self.player_id, False)
+                else:
+                    self.bubble_set.unlock(self.player_id)
+        #bubble consumed message which is passed from server to client
+        elif action == 'bubble_consumed':
+            self.bubble_set.remove(message['bubble_id'])
+        #full state sent on login and on resync
+        elif action == 'snapshot':
+            self.bubble_set.clear()
+            # the snapshot is what the server has, predictions still waiting are dropped
+            self.predicted_locks.clear()
+            self.confirmed_lock = None
+            for config in message['bubbles']:
+                self.bubble_set.add(self.create_bubble(config))
+                if config['locked_by'] is not None:
+                    self.bubble_set.lock(config['id'], config['locked_by'], config['locked_by'] != self.player_id)
+                    if config['locked_by'] == self.player_id:
+                        self.confirmed_lock = config['id']
+            self.players = message['players']
+            self.status_seq = message['seq']
+            self.resyncing = False
+        #score changes numbered by seq, a gap means we missed one and need a new snapshot
+        elif action == 'status_delta':
+            if self.status_seq is None or message['seq'] <= self.status_seq:
+                return
+            if message['seq'] != self.status_seq + 1:
+                if not self.resyncing:
+                    self.resyncing = True
+                    self.write_message({
+                        'action': 'snapshot'
+                    })
+                return
+            self.players.update(message['players'])
+            for player_id in message['removed']:
+                self.players.pop(player_id, None)
+            self.status_seq = message['seq']
+        #the events of one server tick, in order
+        elif action == 'batch':
+            for event in message['messages']:
+                self.handle_message(session, event)
+        #player status message which is passed from server to client,
+        #with a seq it is every score as of that delta and replaces the older ones
+        elif action == 'status':
+            if 'seq' in message:
+                if self.status_seq is None or message['seq'] <= self.status_seq:
+                    return
+                self.status_seq = message['seq']
+            self.players = message['players']
+            #game over message which is passed from server to client
+        elif action == 'game_over':
+            self.game_over = True
+            self.winner = message['winner']
+            self.on_game_over()
+        else:
+            print('unknown message:', message)
+    #Client send message to server for server to handle
+    def write_message(self, message):
+        self.session.write_message(message)
+    #get bubble function to get bubble from bubble panel
+    def get_bubble_at(self, pos):
+        return self.bubble_set.grid.at(pos)
+    #locking bubble function to lock bubble from bubble panel, numbered so the lock_result can be matched
+    def lock_bubble(self, bubble):
+        self.lock_seq += 1
+        # a bubble another player locks would be refused, do not show it as ours
+        if self.predict_locks and self.player_id is not None and not bubble.locked_by_others:
+            self.predicted_locks[self.lock_seq] = bubble.id
+            self.bubble_set.lock(bubble.id, self.player_id, False)
+        self.write_message({
+            'action': 'lock',
+            'bubble_id': bubble.id,
+            'player_id': self.player_id,
+            'seq': self.lock_seq,
+        })
+    #get status to show player id and the player score.
+    def get_status(self):
+        status = []
+        for player_id in self.players:
+            status.append((player_id, self.players[player_id]['score']))
+        return status
@@ -5,3 +5,42 @@ BUBBLE_MIN_VALUE = 1
 BUBBLE_MAX_VALUE = 20
 BUBBLE_MIN_LIFETIME_SEC, BUBBLE_MAX_LIFETIME_SEC = 3, 6
 WIN_SCORE = 100
+# milliseconds a session waits for more messages before sending, 0 to send right away
+SESSION_FLUSH_WINDOW_MS = 0
+# bound of each session's output queue on the server, 0 for no bound
+SESSION_MAX_QUEUE_MESSAGES = 10000
+SESSION_MAX_QUEUE_BYTES = 4 * 1024 * 1024
+# drop_oldest, coalesce or disconnect, see session.OutputQueue
+SESSION_QUEUE_POLICY = 'coalesce'
+# frames of at least this many bytes are compressed for clients that support it, 0 to never compress
+SESSION_COMPRESS_MIN_BYTES = 64
+# zlib level of the session compressors, 1 is the fastest and 9 the smallest
+SESSION_COMPRESS_LEVEL = 1
+# rate of the server game loop tick, every tick runs due bubble deadlines and sends
+# the tick's broadcasts as one batch message, 0 to run and send every event right away
+SERVER_TICK_HZ = 0
+# scan and generate bubbles with numpy when it is installed
+USE_NUMPY = True
+# bubbles generated per numpy call, handed out one spawn at a time
+BUBBLE_BATCH_SIZE = 256
+# milliseconds per frame the pygame client spends applying queued server messages,
+# what is left is applied on the next frames
+CLIENT_MESSAGE_BUDGET_MS = 4
+# port of the server's datagram channel for pings and scores, None to offer none, 0 for any free port
+SERVER_UDP_PORT = None
+# largest datagram sent, bigger messages only go over the stream
+DATAGRAM_MAX_BYTES = 1200
+# most sessions a server holds, connections beyond it are closed as soon as they are accepted, 0 for no limit
+SERVER_MAX_SESSIONS = 5000
+# connections accepted per second, with bursts of up to SERVER_ACCEPT_BURST, 0 for no limit.
+# connections over the rate wait in the listen backlog
+SERVER_ACCEPT_RATE = 500
+SERVER_ACCEPT_BURST = 100
+# connections the kernel queues for the accept loop, beyond it clients retry their connect
+SERVER_LISTEN_BACKLOG = 1024
+# seconds a connection has to send login before the server closes it, 0 to wait forever
+SESSION_LOGIN_TIMEOUT_S = 10
+# seconds a connection is idle before TCP keepalive probes it, 0 to leave keepalive off
+SESSION_KEEPALIVE_S = 60
+# milliseconds the server collects logins before announcing the new players in one status delta, 0 for one per login
+SERVER_JOIN_WINDOW_MS = 50
@@ -0,0 +1,73 @@
+'''
+datagrams next to the TCP stream of a session, for messages where a lost or
+late one does not matter: pings, and state that the next update replaces
+
+every datagram is a header and one message body encoded like on the stream.
+the header numbers the datagrams of each direction so the receiver drops
+duplicates and datagrams overtaken by a newer one. nothing is resent,
+whatever has to arrive goes over the stream
+'''
+import struct
+
+from config import DATAGRAM_MAX_BYTES
+from protocol import decode_message, encode_body
+
+# token of the sending session (0 from the server) and sequence number
+HEADER = struct.Struct('!II')
+_SEQ_MASK = 0xFFFFFFFF
+
+#token, seq and message of a received datagram
+def decode_datagram(data):
+    token, seq = HEADER.unpack_from(data)
+    return token, seq, decode_message(memoryview(data)[HEADER.size:])
+
+class DatagramPeer:
+    '''
+    one end of a datagram channel, numbers what it sends and tells which
+    received datagrams are newer than every one before them.
+    address is None on a connected socket
+    '''
+    def __init__(self, socket, address, token, codec=None):
+        self.socket = socket
+        self.address = address
+        self.token = token
+        self.codec = codec
+        self.send_seq = 0
+        self.receive_seq = 0
+        # set once a datagram came back, until then the peer may not be reachable
+        self.up = False
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.too_big = 0
+
+    #send the message, False when it does not fit in one datagram and has to go over the stream
+    def send(self, message):
+        return self.send_body(encode_body(message, self.codec))
+
+    #send a body encoded with encode_body(), lets a broadcast encode once for every peer
+    def send_body(self, body):
+        if HEADER.size + len(body) > DATAGRAM_MAX_BYTES:
+            self.too_big += 1
+            return False
+        self.send_seq = (self.send_seq + 1) & _SEQ_MASK
+        data = HEADER.pack(self.token, self.send_seq) + body
+        try:
+            if self.address is None:
+                self.socket.send(data)
+            else:
+                self.socket.sendto(data, self.address)
+        except OSError:
+            pass # a datagram can be lost anyway
+        self.sent += 1
+        return True
+
+    #True if the datagram numbered seq is newer than the ones received so far, seq wraps around
+    def accept(self, seq):
+        if not 0 < (seq - self.receive_seq) & _SEQ_MASK < 1 << 31:
+            self.dropped += 1
+            return False
+        self.receive_seq = seq
+        self.received += 1
+        self.up = True
+        return True
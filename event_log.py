@@ -0,0 +1,105 @@
+'''
+append-only record of a game: every message the server receives from a
+client and every message it broadcasts, with the time on the server's clock
+
+a record is a header (time, kind, connection, size) and a body. the body of
+a client message or broadcast is the message in the binary codec, json when
+no binary layout fits it. a start record opens every game with the settings
+replay.py needs to rebuild it, like the bubble manager's seed
+'''
+import json
+import struct
+import threading
+
+from protocol import BINARY_CODEC, decode_message, encode_body
+
+# time, kind, connection id and body size
+RECORD = struct.Struct('!dBII')
+
+# kinds of records
+START = 0
+OPEN = 1
+MESSAGE = 2
+CLOSE = 3
+BROADCAST = 4
+
+class EventLog:
+    '''
+    writes the records of one server to the end of a file, from any thread.
+    connections are numbered in the order they open, the open record has
+    the remote address
+    '''
+    def __init__(self, path, clock):
+        self.file = open(path, 'ab')
+        self.clock = clock
+        # remote address -> connection id of the open connections
+        self.ids = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def _write(self, kind, conn_id, body):
+        with self.lock:
+            if self.file is None:
+                return # closed while the server still runs
+            self.file.write(RECORD.pack(self.clock(), kind, conn_id, len(body)) + body)
+
+    #a game starts with these settings
+    def start(self, settings):
+        self._write(START, 0, json.dumps(settings).encode())
+
+    def open(self, remote_address):
+        with self.lock:
+            conn_id = self.ids[remote_address] = self.next_id
+            self.next_id += 1
+        self._write(OPEN, conn_id, json.dumps(remote_address).encode())
+
+    #the client at remote_address sent message
+    def message(self, remote_address, message):
+        conn_id = self.ids.get(remote_address)
+        if conn_id is not None:
+            self._write(MESSAGE, conn_id, encode_body(message, BINARY_CODEC))
+
+    #a connection is only closed once, later calls for it are ignored
+    def close_connection(self, remote_address):
+        with self.lock:
+            conn_id = self.ids.pop(remote_address, None)
+        if conn_id is not None:
+            self._write(CLOSE, conn_id, b'')
+
+    def broadcast(self, message):
+        self._write(BROADCAST, 0, encode_body(message, BINARY_CODEC))
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+#(time, kind, connection id, body) of every record in the log at path, the body decoded:
+#settings for start, the remote address for open, a message for message and broadcast, None for close
+def read_events(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    # a server killed mid write leaves a partial record at the end
+    while offset + RECORD.size <= len(data):
+        time, kind, conn_id, size = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + size > len(data):
+            break
+        body = data[offset:offset + size]
+        offset += size
+        if kind == START or kind == OPEN:
+            body = json.loads(body)
+            if kind == OPEN:
+                body = tuple(body)
+        elif kind == CLOSE:
+            body = None
+        else:
+            body = decode_message(body)
+        yield time, kind, conn_id, body
@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Counter:
+    '''
+    monotonically increasing count, increments are not locked so a rare
+    concurrent increment can be lost, which keeps the hot path cheap
+    '''
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+class Histogram:
+    '''
+    latency histogram with power-of-two microsecond buckets,
+    bucket i counts the observations in [2 ** (i - 1), 2 ** i) microseconds
+    '''
+    BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = int(seconds * 1e6).bit_length()
+        self.buckets[index if index < self.BUCKETS else self.BUCKETS - 1] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    #upper bound of the bucket holding the q quantile, in seconds
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min((1 << index) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+class Metrics:
+    '''
+    registry of named counters, histograms and gauges, gauges are read from a callback
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters.setdefault(name, Counter())
+        return counter
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception:
+                gauges[name] = None
+        return {
+            'time': time.time(),
+            'counters': {name: c.snapshot() for name, c in sorted(self.counters.items())},
+            'gauges': dict(sorted(gauges.items())),
+            'histograms': {name: h.snapshot() for name, h in sorted(self.histograms.items())},
+        }
+
+    #one 'name value' line per number, histograms are flattened to name.field
+    def to_text(self):
+        snapshot = self.snapshot()
+        lines = []
+        for group in ('counters', 'gauges'):
+            for name, value in snapshot[group].items():
+                lines.append(f'{name} {value}')
+        for name, fields in snapshot['histograms'].items():
+            for field, value in fields.items():
+                lines.append(f'{name}.{field} {value}')
+        return '\n'.join(lines) + '\n'
+
+    #serve /metrics as text and /metrics.json on a local port from a daemon thread
+    def serve_http(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+                elif self.path == '/metrics':
+                    body, content_type = metrics.to_text().encode(), 'text/plain'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        http_server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=http_server.serve_forever, args=(), daemon=True).start()
+        return http_server
+
+    #append a json snapshot to path every interval seconds from a daemon thread
+    def dump_periodically(self, path, interval=10):
+        def dump():
+            while True:
+                time.sleep(interval)
+                try:
+                    with open(path, 'a') as f:
+                        f.write(json.dumps(self.snapshot()) + '\n')
+                except OSError:
+                    pass # logging.exception(f'cannot dump metrics to {path}')
+        threading.Thread(target=dump, args=(), daemon=True).start()
+
+# registry shared by the whole process
+METRICS = Metrics()
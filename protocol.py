@@ -1,6 +1,311 @@
 import json
 import struct
+import time
 import logging
+import zlib
+
+from metrics import METRICS
+
+# every message is prefixed with its size as a four-byte integer value in network order
+HEADER = struct.Struct('!I')
+# the high bit of the size marks a body compressed with the sender's FrameCompressor
+COMPRESSED_FLAG = 1 << 31
+SIZE_MASK = COMPRESSED_FLAG - 1
+
+# name of the binary codec negotiated at login, json is used when it is not
+BINARY_CODEC = 'binary/2'
+# result of a lock request in lock_result: the player now locks the bubble,
+# another player locks it, or it was consumed or expired
+LOCK_ACCEPTED = 'accepted'
+LOCK_TAKEN = 'taken'
+LOCK_GONE = 'gone'
+# name of the frame compression negotiated at login: one raw deflate stream per
+# direction of a session, starting from COMPRESSION_DICTIONARY
+COMPRESSION = 'deflate/1'
+# window of the compressors, 4 KiB keeps a session's compressor near 32 KiB,
+# readers use the largest window so they read any sender
+COMPRESSION_WINDOW_BITS = 12
+COMPRESSION_MEM_LEVEL = 5
+# every flushed deflate block ends with these bytes, they are left out of the frame
+_SYNC_TAIL = b'\x00\x00\xff\xff'
+# first byte of a binary body, json bodies always start with '{'
+BINARY_MAGIC = 1
+
+# field types of the binary codec, fixed size ones are packed together in one struct
+FIXED_FIELDS = {
+    'int': 'i',
+    'float': 'd',
+    'pos': 'ii',
+    'rgb': 'BBB',
+}
+# the type a fixed size field must have exactly, pos and rgb are sequences of ints
+_FIXED_TYPES = {'int': int, 'float': float}
+_U16 = struct.Struct('!H')
+_NONE_STR = 0xFFFF
+_OPT_FLOAT = struct.Struct('!?d')
+_SIZE = struct.Struct('!I')
+# count of the items of a str_list or scores and the size of their joined strings
+_JOINED = struct.Struct('!HI')
+
+class Layout:
+    '''
+    binary layout of a dict with exactly the given fields: the head bytes,
+    then the fixed size fields in one struct, then the variable size fields
+    in order. encode(record) and decode(data, offset) are generated once for
+    the layout, straight line code without a loop over the fields. encode
+    raises KeyError, TypeError or struct.error on a dict of another shape
+    '''
+    def __init__(self, fields, head=(), constant=None):
+        # decoded records start with constant, the fields the head stands for
+        self.constant = constant or {}
+        self.keys = set(self.constant) | {name for name, _ in fields}
+        self.fixed = [(name, kind) for name, kind in fields if kind in FIXED_FIELDS]
+        self.variable = [(name, kind) for name, kind in fields if kind not in FIXED_FIELDS]
+        self.head = tuple(head)
+        self.struct = struct.Struct('!' + 'B' * len(self.head) + ''.join(FIXED_FIELDS[kind] for _, kind in self.fixed))
+        self.encode, self.decode = self._compile()
+
+    def _compile(self):
+        namespace = {'struct': self.struct, 'TypeError': TypeError}
+        head = [repr(value) for value in self.head]
+        checks, packed, entries = [], [], []
+        for i, (name, kind) in enumerate(self.fixed):
+            checks.append(f'    v{i} = record[{name!r}]')
+            count = len(FIXED_FIELDS[kind])
+            if count == 1:
+                checks.append(f'    if type(v{i}) is not {_FIXED_TYPES[kind].__name__}: raise TypeError({kind!r})')
+                packed.append(f'v{i}')
+                entries.append(f'{name!r}: v{i}')
+            else:
+                items = [f'v{i}_{j}' for j in range(count)]
+                checks.append(f'    if type(v{i}) is not list and type(v{i}) is not tuple or len(v{i}) != {count}: raise TypeError({kind!r})')
+                checks.append(f'    {", ".join(items)} = v{i}')
+                checks.append(f'    if ' + ' or '.join(f'type({item}) is not int' for item in items) + f': raise TypeError({kind!r})')
+                packed.extend(items)
+                entries.append(f'{name!r}: [{", ".join(items)}]')
+        appended, decoded = [], []
+        for i, (name, kind) in enumerate(self.variable):
+            namespace[f'encode_{i}'], namespace[f'decode_{i}'] = VARIABLE_FIELDS[kind]
+            appended.append(f' + encode_{i}(record[{name!r}])')
+            decoded.append(f'    record[{name!r}], offset = decode_{i}(data, offset)')
+        constant = [f'{name!r}: {value!r}' for name, value in self.constant.items()]
+        unpacked = ['_'] * len(head) + packed
+        source = '\n'.join([
+            'def encode(record):',
+            f'    if len(record) != {len(self.keys)}: raise TypeError("fields")',
+            *checks,
+            f'    return struct.pack({", ".join(head + packed)}){"".join(appended)}',
+            'def decode(data, offset=0):',
+            f'    {"".join(item + ", " for item in unpacked)}= struct.unpack_from(data, offset)' if unpacked else '    pass',
+            f'    offset += {self.struct.size}',
+            f'    record = {{{", ".join(constant + entries)}}}',
+            *decoded,
+            '    return record, offset',
+        ])
+        exec(source, namespace)
+        return namespace['encode'], namespace['decode']
+
+class MessageSpec(Layout):
+    '''
+    binary layout of one message shape: magic and action code, then the fields
+    '''
+    def __init__(self, code, action, fields):
+        self.code = code
+        self.action = action
+        super().__init__(fields, (BINARY_MAGIC, code), {'action': action})
+
+def _encode_str(value):
+    if type(value) is not str:
+        raise TypeError('str')
+    data = value.encode()
+    return _U16.pack(len(data)) + data
+
+def _decode_str(data, offset):
+    size = _U16.unpack_from(data, offset)[0]
+    offset += _U16.size
+    return str(data[offset:offset + size], 'utf-8'), offset + size
+
+def _encode_opt_str(value):
+    if value is None:
+        return _U16.pack(_NONE_STR)
+    return _encode_str(value)
+
+def _decode_opt_str(data, offset):
+    if _U16.unpack_from(data, offset)[0] == _NONE_STR:
+        return None, offset + _U16.size
+    return _decode_str(data, offset)
+
+def _encode_opt_float(value):
+    if value is None:
+        return _OPT_FLOAT.pack(False, 0)
+    if type(value) is not float:
+        raise TypeError('opt_float')
+    return _OPT_FLOAT.pack(True, value)
+
+def _decode_opt_float(data, offset):
+    present, value = _OPT_FLOAT.unpack_from(data, offset)
+    return (value if present else None), offset + _OPT_FLOAT.size
+
+#strings joined by NUL and encoded in one go, the way they decode fastest, TypeError if one holds a NUL
+def _join(strings):
+    text = '\0'.join(strings)
+    if text.count('\0') != max(len(strings) - 1, 0):
+        raise TypeError('NUL in a string')
+    return text.encode()
+
+def _split(data, offset, count, size):
+    if not count:
+        return [], offset + size
+    return str(data[offset:offset + size], 'utf-8').split('\0'), offset + size
+
+def _encode_str_list(value):
+    if type(value) is not list:
+        raise TypeError('str_list')
+    data = _join(value)
+    return _JOINED.pack(len(value), len(data)) + data
+
+def _decode_str_list(data, offset):
+    count, size = _JOINED.unpack_from(data, offset)
+    return _split(data, offset + _JOINED.size, count, size)
+
+#player ids joined and every score in one struct, the decoder builds the dict in one comprehension
+def _encode_scores(value):
+    if type(value) is not dict:
+        raise TypeError('scores')
+    scores = []
+    for player in value.values():
+        if type(player) is not dict or len(player) != 1 or type(player['score']) is not int:
+            raise TypeError('scores')
+        scores.append(player['score'])
+    player_ids = list(value)
+    if set(map(type, player_ids)) - {str}:
+        raise TypeError('scores')
+    data = _join(player_ids)
+    return _JOINED.pack(len(scores), len(data)) + struct.pack(f'!{len(scores)}i', *scores) + data
+
+def _decode_scores(data, offset):
+    count, size = _JOINED.unpack_from(data, offset)
+    offset += _JOINED.size
+    scores = struct.unpack_from(f'!{count}i', data, offset)
+    player_ids, offset = _split(data, offset + 4 * count, count, size)
+    return {player_id: {'score': score} for player_id, score in zip(player_ids, scores)}, offset
+
+def _encode_messages(value):
+    if type(value) is not list:
+        raise TypeError('messages')
+    parts = [_SIZE.pack(len(value))]
+    for item in value:
+        if type(item) is not dict:
+            raise TypeError('messages')
+        data = encode_binary(item)
+        if data is None:
+            data = json.dumps(item).encode()
+        parts.append(_SIZE.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+def _decode_messages(data, offset):
+    count = _SIZE.unpack_from(data, offset)[0]
+    offset += _SIZE.size
+    messages = []
+    for _ in range(count):
+        size = _SIZE.unpack_from(data, offset)[0]
+        offset += _SIZE.size
+        # binary items are decoded where they are, without a copy
+        if data[offset] == BINARY_MAGIC:
+            messages.append(SPECS_BY_CODE[data[offset + 1]].decode(data, offset)[0])
+        else:
+            messages.append(json.loads(str(data[offset:offset + size], 'utf-8')))
+        offset += size
+    return messages, offset
+
+def _encode_bubbles(value):
+    if type(value) is not list:
+        raise TypeError('bubbles')
+    encode = _BUBBLE.encode
+    return _SIZE.pack(len(value)) + b''.join([encode(bubble) for bubble in value])
+
+def _decode_bubbles(data, offset):
+    count = _SIZE.unpack_from(data, offset)[0]
+    offset += _SIZE.size
+    decode = _BUBBLE.decode
+    bubbles = []
+    for _ in range(count):
+        bubble, offset = decode(data, offset)
+        bubbles.append(bubble)
+    return bubbles, offset
+
+# variable size field type -> (encode(value) -> bytes, decode(data, offset) -> (value, offset after it))
+VARIABLE_FIELDS = {
+    'str': (_encode_str, _decode_str),
+    'opt_str': (_encode_opt_str, _decode_opt_str),
+    'opt_float': (_encode_opt_float, _decode_opt_float),
+    'str_list': (_encode_str_list, _decode_str_list),
+    'scores': (_encode_scores, _decode_scores),
+    # the events of one server tick, each one binary when a spec fits it and json otherwise
+    'messages': (_encode_messages, _decode_messages),
+    'bubbles': (_encode_bubbles, _decode_bubbles),
+}
+
+# the fields of a bubble in bubble_added and in a snapshot
+BUBBLE_FIELDS = [
+    ('id', 'int'),
+    ('position', 'pos'),
+    ('radius', 'float'),
+    ('color', 'rgb'),
+    ('expire_time_s', 'float'),
+    ('locked_by', 'opt_str'),
+    ('hold_time_ms', 'int'),
+    ('lock_time', 'opt_float'),
+    ('value', 'int'),
+]
+_BUBBLE = Layout(BUBBLE_FIELDS)
+
+# one spec per message shape sent by the server or the client,
+# messages that fit none of them are sent as json
+MESSAGE_SPECS = [
+    MessageSpec(1, 'ping', [('timestamp', 'float')]),
+    MessageSpec(2, 'lock', [('bubble_id', 'int'), ('player_id', 'str')]),
+    MessageSpec(3, 'status', []),
+    MessageSpec(4, 'status', [('players', 'scores')]),
+    MessageSpec(5, 'bubble_added', BUBBLE_FIELDS),
+    MessageSpec(6, 'bubble_expired', [('bubble_id', 'int')]),
+    MessageSpec(7, 'bubble_locked', [('bubble_id', 'int'), ('player_id', 'str')]),
+    MessageSpec(8, 'bubble_consumed', [('bubble_id', 'int'), ('player_id', 'str')]),
+    MessageSpec(9, 'game_over', [('winner', 'str')]),
+    MessageSpec(10, 'status_delta', [('seq', 'int'), ('players', 'scores'), ('removed', 'str_list')]),
+    MessageSpec(11, 'snapshot', []),
+    MessageSpec(12, 'batch', [('messages', 'messages')]),
+    # a lock numbered by the client, answered with the lock_result of the same seq
+    MessageSpec(13, 'lock', [('bubble_id', 'int'), ('player_id', 'str'), ('seq', 'int')]),
+    MessageSpec(14, 'lock_result', [('seq', 'int'), ('bubble_id', 'int'), ('result', 'str')]),
+    # every score as of status_seq seq, sent as a datagram
+    MessageSpec(15, 'status', [('seq', 'int'), ('players', 'scores')]),
+    MessageSpec(16, 'snapshot', [('seq', 'int'), ('bubbles', 'bubbles'), ('players', 'scores')]),
+]
+SPECS_BY_ACTION = {}
+for _spec in MESSAGE_SPECS:
+    SPECS_BY_ACTION.setdefault(_spec.action, []).append(_spec)
+SPECS_BY_CODE = {spec.code: spec for spec in MESSAGE_SPECS}
+
+# pieces of the frames worth compressing, so the first frames of a stream already
+# find the keys and actions they repeat. the end of the dictionary is the cheapest
+# to refer to, the most common pieces go last. changing it changes COMPRESSION
+_DICTIONARY_MESSAGES = [
+    {'action': 'bubble_expired', 'bubble_id': 1048576},
+    {'action': 'bubble_consumed', 'bubble_id': 1048576, 'player_id': '192.168.1.2:50000'},
+    {'action': 'bubble_locked', 'bubble_id': 1048576, 'player_id': '10.0.0.2:50000'},
+    {'action': 'status_delta', 'seq': 1, 'players': {'127.0.0.1:50000': {'score': 0}}, 'removed': []},
+    {'action': 'status', 'players': {'127.0.0.1:50000': {'score': 0}, '127.0.0.1:50001': {'score': 10}}},
+    {'action': 'snapshot', 'seq': 1, 'bubbles': [], 'players': {'127.0.0.1:50000': {'score': 0}}},
+    {'action': 'batch', 'messages': [{'action': 'bubble_added', 'id': 1048576, 'position': [400, 300], 'radius': 15.0,
+        'color': [128, 128, 128], 'expire_time_s': 1700000000.0, 'locked_by': None, 'hold_time_ms': 1000,
+        'lock_time': None, 'value': 10}]},
+]
+COMPRESSION_DICTIONARY = b''.join(json.dumps(message).encode() for message in _DICTIONARY_MESSAGES)
+
+_ENCODE_SECONDS = METRICS.histogram('protocol.encode_seconds')
+_DECODE_SECONDS = METRICS.histogram('protocol.decode_seconds')
 
 #usign the length of the message to read the message and convert them to data
 def read_n_bytes(read, n):
@@ -10,18 +315,168 @@ def read_n_bytes(read, n):
     assert len(data) == n
     return data
 
-#read message from the socket and convert them to json
-def read_message(read):
+#binary body of the message, None if no spec fits it exactly
+def encode_binary(message):
+    for spec in SPECS_BY_ACTION.get(message.get('action'), ()):
+        try:
+            return spec.encode(message)
+        except (KeyError, TypeError, struct.error):
+            continue
+    return None
+
+def decode_binary(data):
+    return SPECS_BY_CODE[data[1]].decode(data)[0]
+
+def _decode_body(data):
+    if data[0] == BINARY_MAGIC:
+        return decode_binary(data)
+    return json.loads(str(data, 'utf-8'))
+
+#convert the message body back to a message, binary or json,
+#data can be bytes, bytearray or a memoryview from FrameReader
+def decode_message(data):
+    started = time.perf_counter()
+    message = _decode_body(data)
+    _DECODE_SECONDS.observe(time.perf_counter() - started)
+    return message
+
+#message body in the codec (json if None), without the size
+def encode_body(message, codec=None):
+    data = None
+    if codec == BINARY_CODEC:
+        data = encode_binary(message)
+    if data is None:
+        data = json.dumps(message).encode()
+    return data
+
+#convert the message to the codec (json if None) and prefix it with its size
+def encode_message(message, codec=None):
+    started = time.perf_counter()
+    data = encode_body(message, codec)
+    frame = HEADER.pack(len(data)) + data
+    _ENCODE_SECONDS.observe(time.perf_counter() - started)
+    return frame
+
+class FrameReader:
+    '''
+    buffered reader of framed messages
+
+    every recv_into() fills a reusable buffer, then the bodies of all the
+    complete frames in it are handed out as memoryview slices of that buffer.
+    a slice is only valid until the next read, decode it before asking for more.
+    compressed bodies are handed out decompressed, as bytes
+    '''
+    def __init__(self, recv_into, size=1 << 16):
+        self.recv_into = recv_into
+        # made by the first compressed frame, the sender decides whether to compress
+        self.decompressor = None
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # unread data lives in buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    #make room after the unread data, at least enough for the frame being received
+    def _make_room(self):
+        unread = self.end - self.start
+        needed = unread
+        if unread >= HEADER.size:
+            needed = HEADER.size + (HEADER.unpack_from(self.view, self.start)[0] & SIZE_MASK)
+        if needed > len(self.buffer):
+            # the frame does not fit, grow the buffer
+            buffer = bytearray(max(needed, len(self.buffer) * 2))
+            buffer[:unread] = self.view[self.start:self.end]
+            self.buffer, self.view = buffer, memoryview(buffer)
+        elif self.start + needed > len(self.buffer) or self.end == len(self.buffer):
+            # move the partial frame to the front, it is the only copy the reader makes
+            self.buffer[:unread] = bytes(self.view[self.start:self.end])
+        else:
+            return
+        self.start, self.end = 0, unread
+
+    #receive once and yield the body of every complete frame
+    def read_frames(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        self._make_room()
+        n = self.recv_into(self.view[self.end:])
+        if not n:
+            raise ConnectionError('connection closed')
+        self.end += n
+        while self.end - self.start >= HEADER.size:
+            size = HEADER.unpack_from(self.view, self.start)[0]
+            compressed = size & COMPRESSED_FLAG
+            size &= SIZE_MASK
+            if self.end - self.start < HEADER.size + size:
+                break
+            body_start = self.start + HEADER.size
+            self.start = body_start + size
+            if compressed:
+                if self.decompressor is None:
+                    self.decompressor = FrameDecompressor()
+                yield self.decompressor.decompress(self.view[body_start:self.start])
+            else:
+                yield self.view[body_start:self.start]
+
+class FrameCompressor:
+    '''
+    compresses the bodies of frames of at least min_bytes into one deflate
+    stream, so a frame also refers to the ones before it. every compressed
+    frame is flushed to be readable on arrival and flagged in its header,
+    smaller frames are passed through as they are.
+    frames have to be sent in the order they were compressed, not thread safe
+    '''
+    def __init__(self, min_bytes, level=zlib.Z_DEFAULT_COMPRESSION, dictionary=COMPRESSION_DICTIONARY):
+        self.min_bytes = min_bytes
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -COMPRESSION_WINDOW_BITS,
+            COMPRESSION_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        # body bytes before and after compression, of the compressed frames
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    #the frame with its body compressed, or the frame itself when it is too small
+    def compress(self, frame):
+        size = len(frame) - HEADER.size
+        if size < self.min_bytes:
+            return frame
+        body = memoryview(frame)[HEADER.size:]
+        data = self.compressor.compress(body) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        data = data[:-len(_SYNC_TAIL)]
+        self.bytes_in += size
+        self.bytes_out += len(data)
+        return HEADER.pack(len(data) | COMPRESSED_FLAG) + data
+
+class FrameDecompressor:
+    '''
+    reads the deflate stream of a FrameCompressor, one compressed body at a time in order
+    '''
+    def __init__(self, dictionary=COMPRESSION_DICTIONARY):
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=dictionary)
+
+    def decompress(self, body):
+        return self.decompressor.decompress(body) + self.decompressor.decompress(_SYNC_TAIL)
+
+#read message from the socket and convert them to json,
+#compressed messages need the FrameDecompressor kept for the connection
+def read_message(read, decompressor=None):
     # read message size as a four-byte integer value in network order
-    size = struct.unpack('!i', read_n_bytes(read, 4))[0]
+    size = HEADER.unpack(read_n_bytes(read, HEADER.size))[0]
+    body = read_n_bytes(read, size & SIZE_MASK)
+    if size & COMPRESSED_FLAG:
+        if decompressor is None:
+            raise ValueError('compressed message without a decompressor')
+        body = decompressor.decompress(body)
     # read message as json data
-    message = json.loads(read_n_bytes(read, size))
+    message = decode_message(body)
     pass # logging.debug(f'read message: {message}')
     return message
 
-#write message to the socket and convert them to json
-def write_message(write, message):
+#write message to the socket and convert them to json or the given codec,
+#compressed by the FrameCompressor kept for the connection if one is given,
+#write has to send everything it is given, like socket.sendall
+def write_message(write, message, codec=None, compressor=None):
     pass # logging.debug(f'write message: {message}')
-    data = json.dumps(message).encode()
-    write(struct.pack('!i', len(data)) + data)
-
+    frame = encode_message(message, codec)
+    if compressor is not None:
+        frame = compressor.compress(frame)
+    write(frame)
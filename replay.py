@@ -0,0 +1,158 @@
+'''
+replays a game recorded with server.py --event-log as fast as possible,
+for throughput numbers built from real sessions
+
+every game in the log runs on a fresh Server with the logged seed. the
+clock is virtual: before each client message it jumps to the message's
+time, running the bubble deadlines and ticks due on the way, and the
+messages go straight to Server._handle_message without sockets or threads.
+what the server sends to a client is encoded and counted, not sent.
+the broadcasts of the replay are compared with the logged ones, they
+differ where live deadlines ran late and a lock raced a spawn or expiry
+
+    python server.py --seed 1 --event-log game.log
+    python replay.py game.log
+'''
+import time
+from collections import Counter
+
+from event_log import START, OPEN, MESSAGE, CLOSE, BROADCAST, read_events
+from protocol import encode_message
+from server import Server
+
+class VirtualClock:
+    '''
+    the time replay.py says it is
+    '''
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class ReplaySession:
+    '''
+    stands in for the connection of a logged client, counts the frames the server writes to it
+    '''
+    def __init__(self, remote_address):
+        self.remote_address = remote_address
+        self.codec = None
+        self.compressor = None
+        self.frames = 0
+        self.bytes = 0
+
+    def __str__(self):
+        return f'ReplaySession {self.remote_address}'
+
+    def write_message(self, message, key=None):
+        self.write_frame(encode_message(message, self.codec))
+
+    def write_frame(self, frame, key=None):
+        if self.compressor is not None:
+            frame = self.compressor.compress(frame)
+        self.frames += 1
+        self.bytes += len(frame)
+
+    def frames_lost(self):
+        return False
+
+    def close(self):
+        pass
+
+class ReplayServer(Server):
+    '''
+    Server rebuilt from the settings of a logged game, runs on the caller's thread
+    '''
+    def __init__(self, settings, started):
+        self.virtual_clock = VirtualClock(started)
+        super().__init__(None, tick_hz=settings['tick_hz'], udp_port=None,
+            compress_min_bytes=settings['compress_min_bytes'], seed=settings['seed'], clock=self.virtual_clock,
+            login_timeout_s=settings.get('login_timeout_s', 0))
+        self.bubble_manager.batch_size = settings['batch_size']
+        # action -> broadcasts of the replay
+        self.broadcasts = Counter()
+        self.next_tick = started + self.tick_s
+        self.bubble_manager.start()
+
+    def broadcast(self, message):
+        self.broadcasts[message['action']] += 1
+        super().broadcast(message)
+
+    #run the deadlines and ticks due until now, then set the clock to now
+    def advance(self, now):
+        if self.tick_s:
+            while self.next_tick <= now:
+                self.virtual_clock.now = self.next_tick
+                self.bubble_manager.run_due(self.next_tick)
+                self.flush_broadcasts()
+                self.next_tick += self.tick_s
+        else:
+            deadline = self.bubble_manager.scheduler.next_deadline()
+            while deadline is not None and deadline <= now:
+                self.virtual_clock.now = deadline
+                deadline = self.bubble_manager.run_due()
+        self.virtual_clock.now = max(self.virtual_clock.now, now)
+
+#split the records of the log at path into (settings, start time, records) per game
+def read_games(path):
+    games = []
+    for record in read_events(path):
+        if record[1] == START:
+            games.append((record[3], record[0], []))
+        elif games:
+            games[-1][2].append(record)
+    return games
+
+#replay one game, return what it took and what the server did
+def replay(settings, started, records):
+    server = ReplayServer(settings, started)
+    if settings['use_numpy'] != server.bubble_manager.bubbles.use_numpy:
+        print('warning: the game was recorded with numpy ' + ('on' if settings['use_numpy'] else 'off') +
+            ', the bubbles will differ')
+    sessions = {}
+    logged = Counter()
+    messages = 0
+    begin = time.perf_counter()
+    for now, kind, conn_id, body in records:
+        server.advance(now)
+        if kind == OPEN:
+            session = sessions[conn_id] = ReplaySession(body)
+            server.register_session(session)
+            server.start_login_timer(session)
+        elif kind == MESSAGE:
+            messages += 1
+            server._handle_message(sessions[conn_id], body)
+        elif kind == CLOSE:
+            server.remove_session(sessions.pop(conn_id))
+        elif kind == BROADCAST:
+            logged[body['action']] += 1
+    if records:
+        server.advance(records[-1][0])
+    elapsed = time.perf_counter() - begin
+    return {
+        'game_s': (records[-1][0] - started) if records else 0,
+        'replay_s': elapsed,
+        'messages': messages,
+        'logged_broadcasts': logged,
+        'replayed_broadcasts': server.broadcasts,
+    }
+
+def print_report(report):
+    print(f'{report["messages"]} client messages from {report["game_s"]:.1f}s of game replayed in {report["replay_s"]:.3f}s, '
+        f'{report["messages"] / max(report["replay_s"], 1e-9):.0f} messages/s')
+    logged, replayed = report['logged_broadcasts'], report['replayed_broadcasts']
+    print(f'{"broadcast":>16} {"logged":>8} {"replayed":>9}')
+    for action in sorted(set(logged) | set(replayed)):
+        print(f'{action:>16} {logged[action]:>8} {replayed[action]:>9}')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log', help='file written by server.py --event-log')
+    parser.add_argument('--repeat', type=int, default=1, help='replay every game this many times')
+    args = parser.parse_args()
+
+    for settings, started, records in read_games(args.log):
+        print(f'game with seed {settings["seed"]}, tick rate {settings["tick_hz"]:g}Hz, {len(records)} records')
+        for _ in range(args.repeat):
+            print_report(replay(settings, started, records))
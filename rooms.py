@@ -0,0 +1,329 @@
+import functools
+import itertools
+import logging
+import multiprocessing
+import socket
+import threading
+import time
+import zlib
+
+from admission import AcceptLimiter, configure_socket
+from metrics import METRICS
+from protocol import COMPRESSION, FrameCompressor, encode_message
+from scheduler import Scheduler
+from server import Server
+from session import Session, SessionException, OutputQueue
+from config import (
+    SESSION_FLUSH_WINDOW_MS,
+    SESSION_MAX_QUEUE_MESSAGES, SESSION_MAX_QUEUE_BYTES, SESSION_QUEUE_POLICY,
+    SESSION_COMPRESS_MIN_BYTES, SESSION_COMPRESS_LEVEL,
+    SERVER_TICK_HZ, SERVER_MAX_SESSIONS, SERVER_ACCEPT_RATE, SERVER_ACCEPT_BURST, SERVER_LISTEN_BACKLOG,
+    SESSION_LOGIN_TIMEOUT_S, SESSION_KEEPALIVE_S)
+
+# room of clients that do not ask for one
+DEFAULT_ROOM = 'lobby'
+
+#the worker process hosting a room, stable across processes unlike hash()
+def worker_of(room, workers):
+    return zlib.crc32(room.encode()) % workers
+
+
+class RelaySession:
+    '''
+    stands in for a client's Session inside a worker process,
+    frames go back to the front process that owns the socket
+    '''
+
+    def __str__(self):
+        return f'RelaySession {self.remote_address}'
+
+    def __init__(self, worker, conn_id, remote_address):
+        self.worker = worker
+        self.conn_id = conn_id
+        self.remote_address = remote_address
+        self.codec = None
+        # frames leave right away, the front session does the queueing
+        self.output_messages = OutputQueue()
+        self.is_active = True
+
+    def write_message(self, message, key=None):
+        self.write_frame(encode_message(message, self.codec), key)
+
+    def write_frame(self, frame, key=None):
+        if not self.is_active:
+            raise SessionException(f'{self} is closed')
+        # the key goes along, the front session's queue must not drop a login or snapshot
+        self.worker.send(('frame', self.conn_id, frame, key))
+
+    #the front session's queue drops frames, the front asks for the snapshot then, see ShardedServer._write_frame
+    def frames_lost(self):
+        return False
+
+    def close(self):
+        if self.is_active:
+            self.is_active = False
+            self.worker.send(('close', self.conn_id))
+
+
+class Room(Server):
+    '''
+    one game with its own bubble manager and players, run inside a worker process
+    '''
+    def __init__(self, name, worker, tick_hz=SERVER_TICK_HZ):
+        super().__init__(None, tick_hz=tick_hz)
+        self.name = name
+        self.worker = worker
+
+    #send one frame per codec for all the sessions using it instead of one per session
+    def send_to_all(self, message):
+        conn_ids = {}
+        for session in self.session_tuple():
+            if session.is_active:
+                conn_ids.setdefault(session.codec, []).append(session.conn_id)
+        for codec, ids in conn_ids.items():
+            self.worker.send(('broadcast', ids, encode_message(message, codec)))
+
+    #the front session compresses what it relays, see ShardedServer._handle_message
+    def start_compression(self, session):
+        pass
+
+
+class Worker:
+    '''
+    process hosting the rooms mapped to it, talks to the front through a pipe
+    '''
+    def __init__(self, connection, tick_hz=SERVER_TICK_HZ):
+        self.connection = connection
+        self.tick_hz = tick_hz
+        # room threads send concurrently, a pipe connection is not thread safe
+        self.send_lock = threading.Lock()
+        self.rooms = {}
+        self.sessions = {}
+
+    def send(self, command):
+        with self.send_lock:
+            self.connection.send(command)
+
+    def get_room(self, name):
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name, self, self.tick_hz)
+            room.start_game(daemon=True)
+        return room
+
+    #apply the commands of the front until the pipe closes
+    def run(self):
+        while True:
+            try:
+                command = self.connection.recv()
+            except EOFError:
+                return
+            action, conn_id = command[0], command[1]
+            if action == 'message':
+                if conn_id in self.sessions:
+                    room, session = self.sessions[conn_id]
+                    room.post(room.handle_client_message, session, command[2])
+            elif action == 'open':
+                _, _, remote_address, name = command
+                room = self.get_room(name)
+                session = RelaySession(self, conn_id, remote_address)
+                self.sessions[conn_id] = (room, session)
+                room.register_session(session)
+            elif action == 'close':
+                room, session = self.sessions.pop(conn_id, (None, None))
+                if session is not None:
+                    session.is_active = False
+                    # the front lost the client
+                    room.post(room.remove_session, session)
+
+def run_worker(connection, tick_hz=SERVER_TICK_HZ):
+    Worker(connection, tick_hz).run()
+
+
+class FrontSession(Session):
+    '''
+    client session in the front process, tells the front when it closes
+    '''
+    def __init__(self, front, conn_id, *args, **kwargs):
+        self.front = front
+        self.conn_id = conn_id
+        # index of the worker hosting the client's room, None until login
+        self.worker = None
+        # registered before its threads start, a client closing at once is then removed by close()
+        front.sessions[conn_id] = self
+        super().__init__(*args, **kwargs)
+
+    def close(self):
+        was_active = self.is_active
+        super().close()
+        if was_active:
+            self.front.session_closed(self)
+
+
+class ShardedServer:
+    '''
+    front process accepting every client and relaying it to the worker
+    process hosting its room, rooms are spread over the workers by name
+    '''
+    def __init__(self, port, workers=multiprocessing.cpu_count(), flush_window_ms=SESSION_FLUSH_WINDOW_MS,
+            max_queue_messages=SESSION_MAX_QUEUE_MESSAGES, max_queue_bytes=SESSION_MAX_QUEUE_BYTES,
+            queue_policy=SESSION_QUEUE_POLICY, tick_hz=SERVER_TICK_HZ,
+            max_sessions=SERVER_MAX_SESSIONS, accept_rate=SERVER_ACCEPT_RATE, backlog=SERVER_LISTEN_BACKLOG,
+            login_timeout_s=SESSION_LOGIN_TIMEOUT_S):
+        self.port = port
+        # the front admits connections like a Server does, see admission.py
+        self.max_sessions = max_sessions
+        self.accept_limiter = AcceptLimiter(accept_rate, SERVER_ACCEPT_BURST)
+        self.backlog = backlog
+        self.login_timeout_s = login_timeout_s
+        # conn_id -> login deadline of the front sessions, one thread closes the late ones
+        self.login_deadlines = Scheduler()
+        self.login_ready = threading.Condition()
+        self.worker_count = workers
+        self.flush_window_ms = flush_window_ms
+        self.max_queue_messages = max_queue_messages
+        self.max_queue_bytes = max_queue_bytes
+        self.queue_policy = queue_policy
+        self.tick_hz = tick_hz
+        self.sessions = {}
+        self._conn_ids = itertools.count()
+
+    #start the workers, then listen and accept clients
+    def start(self):
+        # workers are started before any thread so forking them is safe
+        self.workers = []
+        self.worker_locks = []
+        for _ in range(self.worker_count):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_worker, args=(worker_connection, self.tick_hz), daemon=True)
+            process.start()
+            self.workers.append(connection)
+            self.worker_locks.append(threading.Lock())
+        for index in range(self.worker_count):
+            threading.Thread(target=self._relay_from_worker, args=(index,), daemon=True).start()
+
+        self.listen_socket = socket.socket()
+        self.listen_socket.bind(('0.0.0.0', self.port))
+        self.listen_socket.listen(self.backlog)
+        self._accept_client_thread = threading.Thread(target=self._accept_client, args=(), daemon=True)
+        self._accept_client_thread.start()
+        if self.login_timeout_s:
+            threading.Thread(target=self._expire_logins, args=(), daemon=True).start()
+
+    def serve_forever(self):
+        self.start()
+        self._accept_client_thread.join()
+
+    #False if the worker is gone, its relay thread closes the sessions it hosted
+    def send_to_worker(self, index, command):
+        try:
+            with self.worker_locks[index]:
+                self.workers[index].send(command)
+        except (OSError, EOFError):
+            return False
+        return True
+
+    def _accept_client(self):
+        while True:
+            delay = self.accept_limiter.take()
+            if delay:
+                time.sleep(delay)
+            socket, client_address = self.listen_socket.accept()
+            if self.max_sessions and len(self.sessions) >= self.max_sessions:
+                METRICS.counter('server.connections_refused').inc()
+                socket.close()
+                continue
+            configure_socket(socket, SESSION_KEEPALIVE_S)
+            session = FrontSession(self, next(self._conn_ids), socket, client_address, self._handle_message,
+                self.flush_window_ms / 1000,
+                self.max_queue_messages, self.max_queue_bytes, self.queue_policy)
+            if self.login_timeout_s:
+                with self.login_ready:
+                    self.login_deadlines.schedule(session.conn_id, time.monotonic() + self.login_timeout_s,
+                        functools.partial(self.login_timed_out, session))
+                    self.login_ready.notify()
+
+    #close the sessions whose login deadline passed, sleeping until the next one
+    def _expire_logins(self):
+        while True:
+            with self.login_ready:
+                deadline = self.login_deadlines.next_deadline()
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is None or timeout > 0:
+                    self.login_ready.wait(timeout)
+                    continue
+                due = self.login_deadlines.pop_due(time.monotonic())
+            for _, callback in due:
+                callback()
+
+    #the deadline is armed after the session starts reading, a login may have been handled before it
+    def login_timed_out(self, session):
+        if session.worker is None:
+            METRICS.counter('server.login_timeouts').inc()
+            session.close()
+
+    #route the client by the room it logs into, then forward everything to that room
+    def _handle_message(self, session, message):
+        action = message.get('action')
+        if action == 'ping':
+            # no game state involved, answer right here
+            session.write_message(message)
+            return
+        if session.worker is None:
+            if action != 'login':
+                return
+            room = message.get('room', DEFAULT_ROOM)
+            session.worker = worker_of(room, self.worker_count)
+            with self.login_ready:
+                self.login_deadlines.cancel(session.conn_id)
+            # the room answers the login the same way, every room runs with the same config
+            if SESSION_COMPRESS_MIN_BYTES and COMPRESSION in message.get('compression', ()):
+                session.compressor = FrameCompressor(SESSION_COMPRESS_MIN_BYTES, SESSION_COMPRESS_LEVEL)
+            self.send_to_worker(session.worker, ('open', session.conn_id, session.remote_address, room))
+        if not self.send_to_worker(session.worker, ('message', session.conn_id, message)):
+            # the room is gone with its worker
+            session.close()
+
+    def session_closed(self, session):
+        with self.login_ready:
+            self.login_deadlines.cancel(session.conn_id)
+        if self.sessions.pop(session.conn_id, None) is not None and session.worker is not None:
+            self.send_to_worker(session.worker, ('close', session.conn_id))
+
+    def _write_frame(self, conn_id, frame, key=None):
+        session = self.sessions.get(conn_id)
+        if session is None:
+            return
+        try:
+            session.write_frame(frame, key)
+        except SessionException:
+            return # the session reported itself closed
+        if session.frames_lost() and key != 'snapshot' and session.worker is not None:
+            # bubble events may be among the dropped frames, ask the room for a snapshot like the client would
+            METRICS.counter('server.lost_frame_snapshots').inc()
+            self.send_to_worker(session.worker, ('message', session.conn_id, {'action': 'snapshot'}))
+
+    #deliver what the rooms of one worker send to their clients
+    def _relay_from_worker(self, index):
+        connection = self.workers[index]
+        while True:
+            try:
+                command = connection.recv()
+            except (OSError, EOFError):
+                pass # logging.error(f'worker {index} exited')
+                # the rooms are gone, their clients must not stay connected to nothing
+                for session in list(self.sessions.values()):
+                    if session.worker == index:
+                        session.close()
+                return
+            action = command[0]
+            if action == 'broadcast':
+                _, conn_ids, frame = command
+                for conn_id in conn_ids:
+                    self._write_frame(conn_id, frame)
+            elif action == 'frame':
+                self._write_frame(command[1], command[2], command[3])
+            elif action == 'close':
+                session = self.sessions.get(command[1])
+                if session is not None:
+                    session.close()
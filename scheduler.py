@@ -0,0 +1,47 @@
+import heapq
+import itertools
+
+class Scheduler:
+    '''
+    min-heap of deadlines keyed by name
+
+    scheduling or cancelling a key marks its previous entry dead instead of
+    searching the heap for it, dead entries are dropped when they reach the top.
+    not thread safe, only the game loop uses it
+    '''
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    #call callback at deadline, replacing whatever was scheduled under key
+    def schedule(self, key, deadline, callback):
+        self.cancel(key)
+        # the counter keeps entries with equal deadlines from comparing keys
+        entry = [deadline, next(self._counter), key, callback]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[3] = None
+
+    #earliest pending deadline, None if nothing is scheduled
+    def next_deadline(self):
+        while self._heap and self._heap[0][3] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    #remove and return (deadline, callback) of every entry due at now, earliest first
+    def pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key, callback = heapq.heappop(self._heap)
+            if callback is not None:
+                del self._entries[key]
+                due.append((deadline, callback))
+        return due
@@ -3,165 +3,375 @@ import threading
 import time
 import random
 import logging
+import queue
+import functools
+import itertools
+import secrets
 from collections import deque
 
-from session import Session, SessionException
+from admission import AcceptLimiter, configure_socket
+from scheduler import Scheduler
+from bubble_store import BubbleStore, random_bubbles
+from metrics import METRICS
+from session import Session, SessionException, OutputQueue, QUEUE_POLICIES
+from protocol import BINARY_CODEC, COMPRESSION, LOCK_ACCEPTED, LOCK_TAKEN, LOCK_GONE, FrameCompressor, encode_body, encode_message
+from datagram import DatagramPeer, decode_datagram
+from event_log import EventLog
 from config import (
     WIN_SCORE,
-    BUBBLE_MIN_LIFETIME_SEC, BUBBLE_MAX_LIFETIME_SEC,
-    BUBBLE_MIN_VALUE, BUBBLE_MAX_VALUE,
-    BUBBLE_MAX_RADIUS, BUBBLE_MIN_RADIUS,
-    POOL_WIDTH, POOL_HEIGHT)
+    SESSION_FLUSH_WINDOW_MS,
+    SESSION_MAX_QUEUE_MESSAGES, SESSION_MAX_QUEUE_BYTES, SESSION_QUEUE_POLICY,
+    SESSION_COMPRESS_MIN_BYTES, SESSION_COMPRESS_LEVEL,
+    SERVER_TICK_HZ, SERVER_UDP_PORT, BUBBLE_BATCH_SIZE,
+    SERVER_MAX_SESSIONS, SERVER_ACCEPT_RATE, SERVER_ACCEPT_BURST, SERVER_LISTEN_BACKLOG,
+    SESSION_LOGIN_TIMEOUT_S, SESSION_KEEPALIVE_S, SERVER_JOIN_WINDOW_MS)
 
 class BubbleManager:
     '''
     bubble manager to create, expire, and consume bubbles
+
+    owned by the server's game loop, every method runs on the loop thread
+    so the bubbles and locks need no locking.
+    the same seed and clock readings give the same bubbles, a seed is
+    picked when none is given and kept in seed
     '''
     #initialize the bubble manager
-    def __init__(self, server):
+    def __init__(self, server, seed=None, clock=time.time):
         self.is_active = False
-        self._next_id = 0
-        self.bubbles = {}
+        self.seed = seed if seed is not None else random.randrange(1 << 32)
+        # spawn times and bubble fields come from here, never from the random module
+        self.random = random.Random(self.seed)
+        # returns the current time in seconds
+        self.clock = clock
+        # one array per field, bubble ids come from the store
+        self.bubbles = BubbleStore()
+        # numpy generates a batch as fast as python generates one bubble
+        self.batch_size = BUBBLE_BATCH_SIZE if self.bubbles.use_numpy else 1
+        # fields of bubbles generated ahead, see random_bubbles()
+        self.spawn_batch = deque()
+        # player_id -> id of the bubble the player currently locks
+        self.locked_bubbles = {}
         self.server = server
-    #next id for a bubble
-    def next_id(self):
-        result = self._next_id
-        self._next_id += 1
-        return result
+        # spawn, expiry and hold completion deadlines and the server's login timeouts, run by the game loop
+        self.scheduler = Scheduler()
+        # seconds between a deadline and its broadcast
+        self.deadline_lag = METRICS.histogram('bubbles.deadline_lag_seconds')
+        self.lock_to_consume = METRICS.histogram('bubbles.lock_to_consume_seconds')
     # create a new bubble
     def create_new_bubble(self):
-        id = self.next_id()
-        position = random.randint(0, POOL_WIDTH), random.randint(0, POOL_HEIGHT)
-        value = random.randint(BUBBLE_MIN_VALUE, BUBBLE_MAX_VALUE)
-        radius = BUBBLE_MIN_RADIUS + ((value - BUBBLE_MIN_VALUE) / (BUBBLE_MAX_VALUE - BUBBLE_MIN_VALUE) * (BUBBLE_MAX_RADIUS - BUBBLE_MIN_RADIUS))
-        expire_time_s = time.time() + random.randint(BUBBLE_MIN_LIFETIME_SEC, BUBBLE_MAX_LIFETIME_SEC)
-        color = random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)
-        hold_time_ms = random.randint(100, 2000)
-        # DEFINE A BUBBLE
-        bubble = {
-            'id': id,
-            'position': position,
-            'radius': radius,
-            'color': color,
-            'expire_time_s': expire_time_s,
-            'locked_by': None,
-            'hold_time_ms': hold_time_ms,
-            'lock_time:': None,
-            'value': value,
-        }
-        self.bubbles[id] = bubble
-        self.server.bubble_added(bubble)
-    #create a new bubble
+        if not self.spawn_batch:
+            self.spawn_batch = deque(random_bubbles(self.batch_size, self.bubbles.use_numpy, self.random))
+        position, radius, color, lifetime_s, hold_time_ms, value = self.spawn_batch.popleft()
+        expire_time_s = self.clock() + lifetime_s
+        id = self.bubbles.add(position, radius, color, expire_time_s, hold_time_ms, value)
+        if not self.server.tick_s:
+            # ticking servers sweep the expiry times every tick instead
+            self.schedule(('expire', id), expire_time_s, functools.partial(self.expire_bubble, id))
+        self.server.bubble_added(self.bubbles.config(id))
+    #create a new bubble when players are there, then schedule the next one
     def create_bubble(self):
-        while self.is_active:
-            if self.server.has_sessions():
-                self.create_new_bubble()
-            time.sleep(random.randint(10, 20) / 10)
+        if not self.is_active:
+            return
+        if self.server.has_sessions():
+            self.create_new_bubble()
+        self.schedule('spawn', self.clock() + self.random.randint(10, 20) / 10, self.create_bubble)
+    #add a deadline, the server wakes its loop in case it is the earliest one
+    def schedule(self, key, deadline, callback):
+        self.scheduler.schedule(key, deadline, callback)
+        self.server.deadline_added(deadline)
+    def cancel(self, key):
+        self.scheduler.cancel(key)
+    #run every deadline due at now (default the current time) and return the next one, None if nothing is scheduled
+    def run_due(self, now=None):
+        if now is None:
+            now = self.clock()
+        for deadline, callback in self.scheduler.pop_due(now):
+            try:
+                callback()
+            except:
+                pass # logging.exception(f'exception raised by deadline callback {callback}')
+            self.deadline_lag.observe(self.clock() - deadline)
+        if self.server.tick_s:
+            for bubble_id in self.bubbles.expired(now):
+                self.expire_bubble(bubble_id)
+        return self.scheduler.next_deadline()
     #expire a bubble
-    def expire_bubble(self):
-        while self.is_active:
-            now = time.time()
-            expired_bubbles = []
-            for bubble_id in list(self.bubbles):
-                if self.bubbles[bubble_id]['expire_time_s'] <= now:
-                    expired_bubbles.append(bubble_id)
-            for bubble_id in expired_bubbles:
-                self.server.bubble_expired(bubble_id)
-                del self.bubbles[bubble_id]
-            time.sleep(0.1)
-    #start the thread to create bubbles
+    def expire_bubble(self, bubble_id):
+        if bubble_id not in self.bubbles:
+            return
+        self.cancel(('consume', bubble_id))
+        self.release(bubble_id)
+        self.bubbles.remove(bubble_id)
+        self.server.bubble_expired(bubble_id)
+    #start spawning bubbles, called on the game loop
     def start(self):
         self.is_active = True
-        self.create_bubble_thread = threading.Thread(target=self.create_bubble, args=(), daemon=True)
-        self.create_bubble_thread.start()
-        self.expire_bubble_thread = threading.Thread(target=self.expire_bubble, args=(), daemon=True)
-        self.expire_bubble_thread.start()
-        self.check_bubble_thread = threading.Thread(target=self.check_bubble, args=(), daemon=True)
-        self.check_bubble_thread.start()
-    #check if a bubble is expired ir active
-    def check_bubble(self):
-        while self.is_active:
-            now = time.time()
-            for bubble_id in list(self.bubbles):
-                bubble = self.bubbles.get(bubble_id)
-                if not bubble:
-                    continue
-                if bubble['locked_by'] is None:
-                    continue
-                if bubble['lock_time'] is None:
-                    continue
-                if now - bubble['lock_time'] >= bubble['hold_time_ms'] / 1000:
-                    player_id = bubble['locked_by']
-                    del self.bubbles[bubble_id]
-                    self.server.consume_bubble(player_id, bubble)
-                    pass # logging.debug(f'player {player_id} consumed bubble {bubble_id}')
+        self.create_bubble()
+    #the player held the lock long enough and consumes the bubble
+    def consume_bubble(self, bubble_id):
+        slot = self.bubbles.slot(bubble_id)
+        if slot is None:
+            return
+        self.cancel(('expire', bubble_id))
+        player_id = self.bubbles.locked_by[slot]
+        value, lock_time = self.bubbles.value[slot], self.bubbles.lock_time[slot]
+        self.release(bubble_id)
+        self.bubbles.remove(bubble_id)
+        self.server.consume_bubble(player_id, bubble_id, value)
+        self.lock_to_consume.observe(self.clock() - lock_time)
+        pass # logging.debug(f'player {player_id} consumed bubble {bubble_id}')
+    #forget the lock held on a bubble that is going away
+    def release(self, bubble_id):
+        player_id = self.bubbles.locked_by[self.bubbles.slot(bubble_id)]
+        if player_id is not None and self.locked_bubbles.get(player_id) == bubble_id:
+            del self.locked_bubbles[player_id]
+    #drop the lock of a player who left so the bubble is not consumed for nobody
+    def unlock(self, player_id):
+        bubble_id = self.locked_bubbles.pop(player_id, None)
+        if bubble_id is not None and bubble_id in self.bubbles:
+            self.bubbles.locked_by[self.bubbles.slot(bubble_id)] = None
+            self.cancel(('consume', bubble_id))
     #get the value for the bubble id
     def get_value(self, bubble_id):
-        return self.bubbles[bubble_id]['value']
+        return self.bubbles.value[self.bubbles.slot(bubble_id)]
 
     #try lock in the bubble
+    #lock the bubble for the player, return LOCK_ACCEPTED, LOCK_TAKEN or LOCK_GONE
     def try_lock(self, bubble_id, player_id):
-        if bubble_id not in self.bubbles:
+        slot = self.bubbles.slot(bubble_id)
+        if slot is None:
             # the bubble is expired
             # or is an invalid bubble does exist
             pass # logging.debug(f'bubble {bubble_id} does not exist')
-            return
+            return LOCK_GONE
         
-        locked_by = self.bubbles[bubble_id]['locked_by']
+        locked_by = self.bubbles.locked_by[slot]
         if locked_by:
-            return
+            # locking it again changes nothing
+            return LOCK_ACCEPTED if locked_by == player_id else LOCK_TAKEN
 
         assert locked_by is None
 
-        for id in list(self.bubbles):
-            if self.bubbles[id]['locked_by'] == player_id:
-                assert bubble_id != id
-                self.bubbles[id]['locked_by'] = None
-                # only one bubble can be locked by a player at a time
-                # so no need to continue searching
-                pass # logging.debug(f'release previously locked bubble {id}')
-                # TODO: send unlock message to clients?
-                break
-        
-        self.bubbles[bubble_id]['locked_by'] = player_id
-        self.bubbles[bubble_id]['lock_time'] = time.time()
+        # only one bubble can be locked by a player at a time
+        id = self.locked_bubbles.get(player_id)
+        if id is not None and id in self.bubbles:
+            assert bubble_id != id
+            self.bubbles.locked_by[self.bubbles.slot(id)] = None
+            # the lock moved, the previous bubble will not be consumed
+            self.cancel(('consume', id))
+            pass # logging.debug(f'release previously locked bubble {id}')
+            # TODO: send unlock message to clients?
+
+        self.locked_bubbles[player_id] = bubble_id
+        lock_time = self.clock()
+        self.bubbles.locked_by[slot] = player_id
+        self.bubbles.lock_time[slot] = lock_time
+        self.schedule(('consume', bubble_id), lock_time + self.bubbles.hold_time_ms[slot] / 1000,
+            functools.partial(self.consume_bubble, bubble_id))
         pass # logging.debug(f'player {player_id} locks bubble {bubble_id}')
         self.server.lock_bubble(bubble_id, player_id)
-        return True
+        return LOCK_ACCEPTED
 
 
+# actions of the messages Server._handle_message handles, metrics count the others as unknown
+# so a client cannot add counters. a tuple, an unhashable action compares instead of raising
+CLIENT_ACTIONS = ('ping', 'login', 'snapshot', 'lock', 'status')
+# the only action answered over the datagram channel
+DATAGRAM_ACTIONS = ('ping',)
+
+#name of the counter of the client's action, one name for every action we do not handle
+def counter_name(prefix, action, known):
+    return f'{prefix}.{action if action in known else "unknown"}'
+
+# replies that a newer one of the same action makes useless while they wait to be sent,
+# the login and snapshot ones are also never dropped, see PINNED_KEYS in session.py
+COALESCED_ACTIONS = {'status', 'snapshot', 'login'}
+
+class ServerSession(Session):
+    '''
+    client session of a Server, leaves the server when it closes so its
+    threads and buffers go away with the connection
+    '''
+    def __init__(self, server, *args, **kwargs):
+        self.server = server
+        super().__init__(*args, **kwargs)
+
+    def close(self):
+        was_active = self.is_active
+        super().close()
+        if was_active:
+            self.server.post(self.server.remove_session, self)
+
 class Server:
     #initialize the server from the cient
-    def __init__(self, port):
+    def __init__(self, port, flush_window_ms=SESSION_FLUSH_WINDOW_MS,
+            max_queue_messages=SESSION_MAX_QUEUE_MESSAGES, max_queue_bytes=SESSION_MAX_QUEUE_BYTES,
+            queue_policy=SESSION_QUEUE_POLICY, tick_hz=SERVER_TICK_HZ, udp_port=SERVER_UDP_PORT,
+            compress_min_bytes=SESSION_COMPRESS_MIN_BYTES, seed=None, clock=time.time, event_log=None,
+            max_sessions=SERVER_MAX_SESSIONS, accept_rate=SERVER_ACCEPT_RATE, backlog=SERVER_LISTEN_BACKLOG,
+            login_timeout_s=SESSION_LOGIN_TIMEOUT_S, keepalive_s=SESSION_KEEPALIVE_S):
         self.port = port
-        self.listen_socket = socket.socket()
-        self.listen_socket.bind(('0.0.0.0', port))
-        self.listen_socket.listen()
-        
+        # admission of new connections, see admission.py, 0 turns a limit off
+        self.max_sessions = max_sessions
+        self.accept_limiter = AcceptLimiter(accept_rate, SERVER_ACCEPT_BURST)
+        self.backlog = backlog
+        self.login_timeout_s = login_timeout_s
+        self.keepalive_s = keepalive_s
+        # the game loop and the bubble manager read the time from clock
+        self.clock = clock
+        # path of the event log, see event_log.py, opened when the game starts
+        self.event_log_path = event_log
+        self.event_log = None
+        # 0 when frames are never compressed
+        self.compress_min_bytes = compress_min_bytes
+        # None when no datagram channel is offered
+        self.udp_port = udp_port
+        self.datagram_socket = None
+        # token -> DatagramPeer of the sessions that opened a datagram channel, and session -> token
+        self.datagram_peers = {}
+        self.datagram_tokens = {}
+        # the scores changed during this tick and are sent as a datagram at its end
+        self.datagram_status_due = False
+        self.flush_window_ms = flush_window_ms
+        self.max_queue_messages = max_queue_messages
+        self.max_queue_bytes = max_queue_bytes
+        self.queue_policy = queue_policy
+        # seconds between ticks, 0 when events are sent as they happen
+        self.tick_s = 1 / tick_hz if tick_hz else 0
+        # broadcasts of the current tick, sent together at its end
+        self.pending_broadcasts = []
+        # session -> None of the sessions whose snapshot goes out after the broadcasts of this tick
+        self.pending_snapshots = {}
+        # codec -> encoded snapshot, dropped on every broadcast since the snapshot changes with it
+        self.snapshot_frames = {}
+        # remote address -> session, changed through register_session() and unregister_session() only
         self.sessions = {}
+        # a new number after every change of sessions, the broadcast tuple is rebuilt when it moved.
+        # numbers are never reused so a change made by another thread cannot look like the cached one
+        self._versions = itertools.count(1)
+        self.sessions_version = 0
+        self._session_tuple = ()
+        self._session_tuple_version = 0
+        self.players = {}
+        # session -> player_id of the sessions that logged in, players[player_id]['session'] is the other way
+        self.session_players = {}
+        # player_id -> None of the players logged in but not announced yet, a login storm is one delta
+        self.pending_joins = {}
+        # (function, args) commands for the game loop, the only thread touching players and bubbles
+        self.commands = queue.SimpleQueue()
+        self.bubble_manager = BubbleManager(self, seed, clock)
+        # every score change is broadcast as a delta numbered by status_seq
+        self.status_seq = 0
+        self.handle_seconds = METRICS.histogram('server.handle_message_seconds')
+        self.broadcast_seconds = METRICS.histogram('server.broadcast_seconds')
+
+    #listen on the port and start all server threads, daemon threads let an embedding program exit,
+    #status=False leaves out the status line, for programs printing their own output
+    def start(self, daemon=False, status=True):
+        self.listen_socket = socket.socket()
+        self.listen_socket.bind(('0.0.0.0', self.port))
+        self.listen_socket.listen(self.backlog)
+        # the real port when started on port 0
+        self.port = self.listen_socket.getsockname()[1]
 
         # start a thread to accept clients
-        self.messages_from_clients = deque()
         self._accept_client_thread = threading.Thread(target=self._accept_client, args=(), daemon=True)
         self._accept_client_thread.start()
 
-        self.bubble_manager = BubbleManager(self)
+        if status:
+            self._status_thread = threading.Thread(target=self._status, args=(), daemon=True)
+            self._status_thread.start()
+        self.register_gauges()
+
+        if self.udp_port is not None:
+            self.start_datagrams()
+        self.start_game(daemon)
+
+    #bind the datagram socket and read it in a thread, datagrams are handled on the game loop
+    def start_datagrams(self):
+        self.datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.datagram_socket.bind(('0.0.0.0', self.udp_port))
+        # the real port when bound to port 0
+        self.udp_port = self.datagram_socket.getsockname()[1]
+        self._datagram_thread = threading.Thread(target=self._read_datagrams, args=(), daemon=True)
+        self._datagram_thread.start()
+
+    def _read_datagrams(self):
+        while True:
+            data, address = self.datagram_socket.recvfrom(65536)
+            try:
+                token, seq, message = decode_datagram(data)
+            except:
+                continue # not one of ours
+            self.post(self.handle_datagram, token, seq, message, address)
+
+    #start the game loop thread, it starts the bubble manager
+    def start_game(self, daemon=False):
+        self.post(self.start_bubbles)
+        self._game_loop_thread = threading.Thread(target=self._run_game, args=(), daemon=daemon)
+        self._game_loop_thread.start()
+
+    #open the event log with what replay.py needs to rebuild the game, then start spawning bubbles
+    def start_bubbles(self):
+        if self.event_log_path:
+            self.event_log = EventLog(self.event_log_path, self.clock)
+            self.event_log.start({
+                'seed': self.bubble_manager.seed,
+                'tick_hz': 1 / self.tick_s if self.tick_s else 0,
+                'use_numpy': self.bubble_manager.bubbles.use_numpy,
+                'batch_size': self.bubble_manager.batch_size,
+                'compress_min_bytes': self.compress_min_bytes,
+                'login_timeout_s': self.login_timeout_s,
+            })
         self.bubble_manager.start()
 
-        self._status_thread = threading.Thread(target=self._status, args=(), daemon=True)
-        self._status_thread.start()
+    #start the server and block until the game loop exits
+    def serve_forever(self):
+        try:
+            self.start()
+            self._game_loop_thread.join()
+        finally:
+            self.close_event_log()
 
-        # start a thread to handle client messages    
-        self.players = {}
-        self._handle_messages_thread = threading.Thread(target=self._handle_messages, args=())
-        self._handle_messages_thread.start()
-        self._handle_messages_thread.join()
+    #write out what the event log buffered, the server may be going away
+    def close_event_log(self):
+        if self.event_log is not None:
+            self.event_log.close()
 
     def _status(self):
         while True:
-            print(f'#sessions: {len(self.sessions)}, #bubbles: {len(self.bubble_manager.bubbles)}, #messages: {len(self.messages_from_clients)}\r', end='')
+            lag_ms = self.bubble_manager.deadline_lag.quantile(0.99) * 1000
+            queue_depth, dropped = self.output_queue_stats()
+            print(f'#sessions: {len(self.sessions)}, #bubbles: {len(self.bubble_manager.bubbles)}, #commands: {self.commands.qsize()}, '
+                  f'max queue depth: {queue_depth}, dropped: {dropped}, p99 deadline lag: {lag_ms:.1f}ms\r', end='')
+            if self.event_log is not None:
+                self.event_log.flush()
             time.sleep(0.5)
 
+    #deepest output queue and total frames dropped or coalesced away over current sessions
+    def output_queue_stats(self):
+        queue_depth, dropped = 0, 0
+        for session in list(self.sessions.values()):
+            queue_depth = max(queue_depth, len(session.output_messages))
+            dropped += session.output_messages.dropped + session.output_messages.coalesced
+        return queue_depth, dropped
+
+    #expose the queue depths and pool size of this server in METRICS
+    def register_gauges(self):
+        METRICS.gauge('server.sessions', lambda: len(self.sessions))
+        METRICS.gauge('server.players', lambda: len(self.players))
+        METRICS.gauge('server.bubbles', lambda: len(self.bubble_manager.bubbles))
+        METRICS.gauge('server.commands', self.commands.qsize)
+        METRICS.gauge('server.max_output_queue', lambda: self.output_queue_stats()[0])
+        METRICS.gauge('server.output_queue_dropped', lambda: self.output_queue_stats()[1])
+
+    #compress the frames sent to the session from now on, the client reads both kinds
+    def start_compression(self, session):
+        session.compressor = FrameCompressor(self.compress_min_bytes, SESSION_COMPRESS_LEVEL)
+
+    def create_output_queue(self):
+        return OutputQueue(self.max_queue_messages, self.max_queue_bytes, self.queue_policy)
+
     def has_sessions(self):
         return len(self.sessions) > 0
 
@@ -185,30 +395,265 @@ class Server:
     def remove_session(self, session):
         # do not throw exceptions here!
         pass # logging.debug(f'remove {session}')
-        self.sessions.pop(session.remote_address, None)
-        for player_id in list(self.players):
-            if self.players[player_id]['session'] == session:
-                pass # logging.debug(f'remove player {player_id}')
-                self.players.pop(player_id, None)
+        self.bubble_manager.cancel(('login', session.remote_address))
+        if self.event_log is not None:
+            self.event_log.close_connection(session.remote_address)
+        self.unregister_session(session)
+        self.close_datagrams(session)
+        player_id = self.session_players.pop(session, None)
+        if player_id is not None and self.players.get(player_id, {}).get('session') is session:
+            pass # logging.debug(f'remove player {player_id}')
+            del self.players[player_id]
+            self.bubble_manager.unlock(player_id)
+            if player_id in self.pending_joins:
+                # nobody heard of the player yet, only the snapshot has its unlocked bubble
+                del self.pending_joins[player_id]
+                self.snapshot_frames.clear()
+            else:
+                self.publish_scores({}, [player_id])
+
+    #let broadcasts reach the session, may be called from any thread
+    def register_session(self, session):
+        self.sessions[session.remote_address] = session
+        # after the change, so a tuple built while it happens is rebuilt on the next broadcast
+        self.sessions_version = next(self._versions)
+
+    #stop broadcasting to the session, unless another one took its address since
+    def unregister_session(self, session):
+        if self.sessions.get(session.remote_address) is session:
+            del self.sessions[session.remote_address]
+            self.sessions_version = next(self._versions)
+
+    #the sessions as a tuple shared by every broadcast until they change, iterating it copies nothing
+    def session_tuple(self):
+        version = self.sessions_version
+        if version != self._session_tuple_version:
+            self._session_tuple = tuple(self.sessions.values())
+            self._session_tuple_version = version
+        return self._session_tuple
+
+    #forget the datagram channel of the session
+    def close_datagrams(self, session):
+        token = self.datagram_tokens.pop(session, None)
+        if token is not None:
+            del self.datagram_peers[token]
+
+    #a datagram from a client, only pings are answered, what changes the game comes over the stream
+    def handle_datagram(self, token, seq, message, address):
+        peer = self.datagram_peers.get(token)
+        if peer is None or not peer.accept(seq):
+            return
+        # answer where the client sends from
+        peer.address = address
+        action = message.get('action')
+        METRICS.counter(counter_name('server.datagrams_in', action, DATAGRAM_ACTIONS)).inc()
+        if action == 'ping':
+            peer.send(message)
+
+    #every score as one datagram to each client with a datagram channel, a lost one is replaced by the next
+    def send_datagram_status(self):
+        self.datagram_status_due = False
+        message = {
+            'action': 'status',
+            'seq': self.status_seq,
+            'players': self.published_scores(),
+        }
+        bodies = {}
+        for peer in list(self.datagram_peers.values()):
+            if peer.address is None:
+                # the client did not send its first datagram yet
+                continue
+            body = bodies.get(peer.codec)
+            if body is None:
+                body = bodies[peer.codec] = encode_body(message, peer.codec)
+            if peer.send_body(body):
+                METRICS.counter('server.datagrams_out.status').inc()
     #client side server write message
     def write_message(self, session, messasge):
+        action = messasge.get('action')
+        METRICS.counter(f'server.messages_out.{action}').inc()
         try:
-            session.write_message(messasge)
+            session.write_message(messasge, action if action in COALESCED_ACTIONS else None)
         except SessionException:
             self.remove_session(session)
+            return
+        self.check_frames_lost(session, action)
+
+    def write_frame(self, session, frame, key=None):
+        try:
+            session.write_frame(frame, key)
+        except SessionException:
+            self.remove_session(session)
+            return
+        self.check_frames_lost(session, key)
+
+    #a full queue dropped frames, bubble events among them are only repaired by a snapshot.
+    #a snapshot just queued is newer than what it pushed out
+    def check_frames_lost(self, session, key):
+        if session.frames_lost() and key != 'snapshot' and session in self.session_players:
+            METRICS.counter('server.lost_frame_snapshots').inc()
+            self.send_snapshot(session)
 
 
+    #accept at the limiter's rate, connections over it wait in the listen backlog
     def _accept_client(self):
         while True:
+            delay = self.accept_limiter.take()
+            if delay:
+                time.sleep(delay)
             socket, client_address = self.listen_socket.accept()
-            session = Session(socket, client_address,
-                lambda session, message: self.messages_from_clients.append((session, message)))
-            self.sessions[client_address] = session
+            if self.is_full():
+                self.refuse(socket)
+                continue
+            configure_socket(socket, self.keepalive_s)
+            self.add_session(socket, client_address)
             pass # logging.info(f'{client_address} connected')
-    #broadcast message to all clients
+
+    #True when a new connection would go over max_sessions
+    def is_full(self):
+        return self.max_sessions and len(self.sessions) >= self.max_sessions
+
+    #close a connection the server has no room for, the client sees it closed before any reply
+    def refuse(self, socket):
+        METRICS.counter('server.connections_refused').inc()
+        try:
+            socket.close()
+        except:
+            pass
+
+    #wrap a connected socket in a session whose messages go to the handle thread
+    def add_session(self, socket, client_address):
+        # before the session reads, its first message may be logged as soon as it starts
+        if self.event_log is not None:
+            self.event_log.open(client_address)
+        session = ServerSession(self, socket, client_address,
+            lambda session, message: self.post(self.handle_client_message, session, message),
+            self.flush_window_ms / 1000,
+            self.max_queue_messages, self.max_queue_bytes, self.queue_policy)
+        self.register_session(session)
+        if not session.is_active:
+            # closed before it was registered, the removal posted by close() may already have run
+            self.post(self.remove_session, session)
+        self.post(self.start_login_timer, session)
+        return session
+
+    #close the session unless it logs in within login_timeout_s, called on the game loop
+    def start_login_timer(self, session):
+        if self.login_timeout_s:
+            self.bubble_manager.schedule(('login', session.remote_address), self.clock() + self.login_timeout_s,
+                functools.partial(self.login_timed_out, session))
+
+    #the timer is posted after the session starts reading, a login may have been handled before it was armed
+    def login_timed_out(self, session):
+        if session in self.session_players:
+            return
+        METRICS.counter('server.login_timeouts').inc()
+        session.close()
+        self.remove_session(session)
+    #broadcast message to all clients, at the end of the tick when ticking
     def broadcast(self, message):
-        for session in list(self.sessions.values()):
-            self.write_message(session, message)
+        self.snapshot_frames.clear()
+        if self.event_log is not None:
+            self.event_log.broadcast(message)
+        if self.tick_s:
+            self.pending_broadcasts.append(message)
+        else:
+            self.send_to_all(message)
+
+    #send the broadcasts of the tick, as one batch message when there are several
+    def flush_broadcasts(self):
+        self.publish_joins()
+        if self.datagram_status_due:
+            self.send_datagram_status()
+        if self.pending_broadcasts:
+            messages, self.pending_broadcasts = self.pending_broadcasts, []
+            if len(messages) == 1:
+                self.send_to_all(messages[0])
+            else:
+                METRICS.counter('server.batched_messages').inc(len(messages))
+                self.send_to_all({
+                    'action': 'batch',
+                    'messages': messages,
+                })
+        # after the tick's events, the snapshot already includes them
+        sessions, self.pending_snapshots = self.pending_snapshots, {}
+        for session in sessions:
+            self.write_snapshot(session)
+
+    def send_to_all(self, message):
+        started = time.perf_counter()
+        # encode once per codec and share the immutable frame between sessions
+        frames = {}
+        sessions = self.session_tuple()
+        for session in sessions:
+            frame = frames.get(session.codec)
+            if frame is None:
+                frame = frames[session.codec] = encode_message(message, session.codec)
+            self.write_frame(session, frame)
+        METRICS.counter(f'server.messages_out.{message["action"]}').inc(len(sessions))
+        self.broadcast_seconds.observe(time.perf_counter() - started)
+
+    #broadcast the scores that changed and the players that left as the next delta
+    def publish_scores(self, players, removed=()):
+        self.status_seq += 1
+        message = {
+            'action': 'status_delta',
+            'seq': self.status_seq,
+            'players': {player_id: {'score': score} for player_id, score in players.items()},
+            'removed': list(removed),
+        }
+        self.broadcast(message)
+        # the stream stays the reliable path, the datagram only gets the scores there sooner
+        if self.datagram_peers:
+            if self.tick_s:
+                self.datagram_status_due = True
+            else:
+                self.send_datagram_status()
+
+    #announce the player with the others logging in within SERVER_JOIN_WINDOW_MS, ticks announce them at their end
+    def announce_join(self, player_id):
+        self.pending_joins[player_id] = None
+        if self.tick_s:
+            return
+        if not SERVER_JOIN_WINDOW_MS:
+            self.publish_joins()
+        elif len(self.pending_joins) == 1:
+            self.bubble_manager.schedule(('joins',), self.clock() + SERVER_JOIN_WINDOW_MS / 1000, self.publish_joins)
+
+    #one delta for the players logged in since the last one, with the scores they have by now
+    def publish_joins(self):
+        if not self.pending_joins:
+            return
+        joins, self.pending_joins = self.pending_joins, {}
+        self.bubble_manager.cancel(('joins',))
+        self.publish_scores({player_id: self.players[player_id]['score'] for player_id in joins})
+
+    #scores of the players the clients were told about
+    def published_scores(self):
+        return {player_id: {'score': player['score']} for player_id, player in self.players.items()
+            if player_id not in self.pending_joins}
+
+    #send the current bubbles and scores, deltas after status_seq follow it
+    def send_snapshot(self, session):
+        if self.tick_s:
+            # events the snapshot already includes must not arrive after it
+            self.pending_snapshots[session] = None
+        else:
+            self.write_snapshot(session)
+
+    #the snapshot is encoded once per codec until the next broadcast changes it
+    def write_snapshot(self, session):
+        frame = self.snapshot_frames.get(session.codec)
+        if frame is None:
+            message = {
+                'action': 'snapshot',
+                'seq': self.status_seq,
+                'bubbles': self.bubble_manager.bubbles.configs(),
+                'players': self.published_scores(),
+            }
+            frame = self.snapshot_frames[session.codec] = encode_message(message, session.codec)
+        METRICS.counter('server.messages_out.snapshot').inc()
+        self.write_frame(session, frame, 'snapshot')
 
     def lock_bubble(self, bubble_id, player_id):
         # we do not need to broadcast the unlock message
@@ -220,14 +665,20 @@ class Server:
         }
         self.broadcast(message)
 
-    def consume_bubble(self, player_id, bubble):
-        self.players[player_id]['score'] += bubble['value']
+    def consume_bubble(self, player_id, bubble_id, value):
+        if player_id not in self.players:
+            # the player left, unlock() should have cancelled the hold.
+            # the bubble is gone from the store all the same, clients must drop it too
+            self.bubble_expired(bubble_id)
+            return
+        self.players[player_id]['score'] += value
         message = {
             'action': 'bubble_consumed',
-            'bubble_id': bubble['id'],
+            'bubble_id': bubble_id,
             'player_id': player_id,
         }
         self.broadcast(message)
+        self.publish_scores({player_id: self.players[player_id]['score']})
         # end the game if the player has reached the WIN_SCORE
         if self.players[player_id]['score'] >= WIN_SCORE:
             message = {
@@ -238,7 +689,7 @@ class Server:
 
     def try_lock(self, bubble_id, player_id):
         pass # logging.debug(f'{player_id} try_lock {bubble_id}')
-        self.bubble_manager.try_lock(bubble_id, player_id)
+        return self.bubble_manager.try_lock(bubble_id, player_id)
 
     def create_player(self, session):
         return ':'.join(map(str, session.remote_address))
@@ -248,26 +699,68 @@ class Server:
         if action == 'ping':
             self.write_message(session, message)
         elif action == 'login':
+            self.bubble_manager.cancel(('login', session.remote_address))
+            # the session reads before add_session() registers it, make sure broadcasts reach it
+            self.register_session(session)
             player_id = self.create_player(session)
             if player_id in self.players:
                 old_session = self.players[player_id]['session']
+                # the player moves to the new session, closing the old one must not remove it
+                self.session_players.pop(old_session, None)
                 old_session.close()
-                for client_address in list(self.sessions):
-                    if self.sessions[client_address] == old_session:
-                        del self.sessions[client_address]
-                        break
+                self.close_datagrams(old_session)
+                self.unregister_session(old_session)
             self.players[player_id] = {}
             self.players[player_id]['session'] = session
             self.players[player_id]['score'] = 0
+            self.session_players[session] = player_id
+            codecs = message.get('codecs', ())
+            datagram = message.get('datagram') and self.datagram_socket is not None
+            compression = self.compress_min_bytes and COMPRESSION in message.get('compression', ())
             message = {
                 'action': 'login',
                 'player_id': player_id,
             }
+            if BINARY_CODEC in codecs:
+                message['codec'] = BINARY_CODEC
+            if compression:
+                message['compression'] = COMPRESSION
+            if datagram:
+                # the client opens the channel by sending a datagram with the token
+                self.close_datagrams(session)
+                token = secrets.randbits(32)
+                while not token or token in self.datagram_peers:
+                    token = secrets.randbits(32)
+                self.datagram_peers[token] = DatagramPeer(self.datagram_socket, None, 0, message.get('codec'))
+                self.datagram_tokens[session] = token
+                message['udp_port'] = self.udp_port
+                message['udp_token'] = token
             self.write_message(session, message)
+            # readers detect the codec of every message, so switching after the reply is safe
+            session.codec = message.get('codec')
+            if compression:
+                self.start_compression(session)
+            # late joiners get the current state, then the delta announcing them
+            self.send_snapshot(session)
+            self.announce_join(player_id)
+        elif action == 'snapshot':
+            # the client missed a delta and resyncs
+            self.send_snapshot(session)
         elif action == 'lock':
             bubble_id = message['bubble_id']
-            player_id = message['player_id']
-            self.try_lock(bubble_id, player_id)
+            # the player is the one the session logged in as, whatever player_id the client sends
+            player_id = self.session_players.get(session)
+            if player_id is None:
+                return
+            result = self.try_lock(bubble_id, player_id)
+            # clients that number their locks show them before the server answers, tell them how it went
+            if 'seq' in message:
+                self.write_message(session, {
+                    'action': 'lock_result',
+                    'seq': message['seq'],
+                    'bubble_id': bubble_id,
+                    'result': result,
+                })
         elif action == 'status':
             message = {
                 'action': 'status',
@@ -278,16 +771,132 @@ class Server:
                 message['players'][player_id]['score'] = self.players[player_id]['score']
             self.write_message(session, message)
 
-    def _handle_messages(self):
+    #count and time one client message
+    def handle_client_message(self, session, message):
+        METRICS.counter(counter_name('server.messages_in', message.get('action'), CLIENT_ACTIONS)).inc()
+        if self.event_log is not None:
+            self.event_log.message(session.remote_address, message)
+        started = time.perf_counter()
+        self._handle_message(session, message)
+        self.handle_seconds.observe(time.perf_counter() - started)
+
+    #run fn(*args) on the game loop, may be called from any thread
+    def post(self, fn, *args):
+        self.commands.put((fn, args))
+
+    #called when a deadline is scheduled, the threaded loop recomputes its timeout after every command anyway
+    def deadline_added(self, deadline):
+        pass
+
+    #the game loop, runs the posted commands and the bubble deadlines one at a time
+    def _run_game(self):
+        if self.tick_s:
+            self._run_ticks()
+            return
+        deadline = None
+        while True:
+            # sleep until a command arrives or the next deadline is due instead of spinning
+            timeout = None if deadline is None else max(0, deadline - self.clock())
+            try:
+                fn, args = self.commands.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                try:
+                    fn(*args)
+                except:
+                    pass # logging.exception(f'exception raised by command {fn}')
+            deadline = self.bubble_manager.run_due()
+
+    #the game loop at a fixed rate, commands run as they arrive, deadlines and broadcasts once per tick
+    def _run_ticks(self):
+        tick = self.clock()
         while True:
-            while self.messages_from_clients:
-                session, message = self.messages_from_clients.popleft()
-                self._handle_message(session, message)
+            tick += self.tick_s
+            while True:
+                timeout = tick - self.clock()
+                if timeout <= 0:
+                    break
+                try:
+                    fn, args = self.commands.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                try:
+                    fn(*args)
+                except:
+                    pass # logging.exception(f'exception raised by command {fn}')
+            self.bubble_manager.run_due(tick)
+            self.flush_broadcasts()
+            if self.clock() - tick > self.tick_s:
+                # fell behind, skip the missed ticks instead of running them back to back
+                tick = self.clock()
 #handle client message from the Terminal
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=80)
+    parser.add_argument('--asyncio', action='store_true', help='serve clients from an asyncio event loop')
+    parser.add_argument('--flush-window-ms', type=float, default=SESSION_FLUSH_WINDOW_MS,
+        help='how long sessions wait for more messages before sending')
+    parser.add_argument('--max-queue-messages', type=int, default=SESSION_MAX_QUEUE_MESSAGES,
+        help='most messages waiting to be sent to one client, 0 for no limit')
+    parser.add_argument('--max-queue-bytes', type=int, default=SESSION_MAX_QUEUE_BYTES,
+        help='most bytes waiting to be sent to one client, 0 for no limit')
+    parser.add_argument('--queue-policy', choices=QUEUE_POLICIES, default=SESSION_QUEUE_POLICY,
+        help='what to do when a client falls behind')
+    parser.add_argument('--metrics-port', type=int, default=0,
+        help='serve /metrics and /metrics.json on this local port')
+    parser.add_argument('--metrics-dump', help='append a json metrics snapshot to this file periodically')
+    parser.add_argument('--metrics-interval', type=float, default=10, help='seconds between metrics dumps')
+    parser.add_argument('--tick-hz', type=float, default=SERVER_TICK_HZ,
+        help='run the game at this fixed rate and batch each tick\'s broadcasts, 0 to send every event right away')
+    parser.add_argument('--compress-min-bytes', type=int, default=SESSION_COMPRESS_MIN_BYTES,
+        help='compress frames of at least this many bytes for clients that support it, 0 to never compress')
+    parser.add_argument('--udp-port', type=int, default=SERVER_UDP_PORT,
+        help='offer clients a datagram channel for pings and scores on this port')
+    parser.add_argument('--seed', type=int, help='seed of the bubbles, random when not given')
+    parser.add_argument('--event-log', help='append every client message and broadcast to this file, see replay.py')
+    parser.add_argument('--max-sessions', type=int, default=SERVER_MAX_SESSIONS,
+        help='close connections beyond this many sessions, 0 for no limit')
+    parser.add_argument('--accept-rate', type=float, default=SERVER_ACCEPT_RATE,
+        help='connections accepted per second, the others wait in the backlog, 0 for no limit')
+    parser.add_argument('--backlog', type=int, default=SERVER_LISTEN_BACKLOG,
+        help='connections the kernel queues until they are accepted')
+    parser.add_argument('--login-timeout', type=float, default=SESSION_LOGIN_TIMEOUT_S,
+        help='seconds a connection has to log in, 0 to wait forever')
+    parser.add_argument('--workers', type=int, default=0,
+        help='spread rooms over this many worker processes, 0 to run one game in this process')
     args = parser.parse_args()
-    Server(args.port)
+    if args.workers:
+        # the rooms of the worker processes do not have these yet, fail instead of ignoring them
+        ignored = [flag for flag, given in (
+            ('--asyncio', args.asyncio),
+            ('--udp-port', args.udp_port != SERVER_UDP_PORT),
+            ('--compress-min-bytes', args.compress_min_bytes != SESSION_COMPRESS_MIN_BYTES),
+            ('--seed', args.seed is not None),
+            ('--event-log', args.event_log is not None),
+        ) if given]
+        if ignored:
+            parser.error(f'{", ".join(ignored)} cannot be used with --workers')
+    if args.metrics_port:
+        METRICS.serve_http(args.metrics_port)
+    if args.metrics_dump:
+        METRICS.dump_periodically(args.metrics_dump, args.metrics_interval)
+    admission = dict(max_sessions=args.max_sessions, accept_rate=args.accept_rate, backlog=args.backlog)
+    if args.workers:
+        from rooms import ShardedServer
+        ShardedServer(args.port, args.workers, args.flush_window_ms,
+            args.max_queue_messages, args.max_queue_bytes, args.queue_policy, args.tick_hz,
+            login_timeout_s=args.login_timeout, **admission).serve_forever()
+    elif args.asyncio:
+        from async_server import AsyncServer
+        AsyncServer(args.port, max_queue_messages=args.max_queue_messages,
+            max_queue_bytes=args.max_queue_bytes, queue_policy=args.queue_policy, tick_hz=args.tick_hz,
+            udp_port=args.udp_port, compress_min_bytes=args.compress_min_bytes,
+            seed=args.seed, event_log=args.event_log, login_timeout_s=args.login_timeout, **admission).serve_forever()
+    else:
+        Server(args.port, args.flush_window_ms,
+            args.max_queue_messages, args.max_queue_bytes, args.queue_policy, args.tick_hz,
+            args.udp_port, args.compress_min_bytes, args.seed, event_log=args.event_log,
+            login_timeout_s=args.login_timeout, **admission).serve_forever()
@@ -1,24 +1,136 @@
 import logging
 import socket
 import threading
+import time
 from collections import deque
 
-from protocol import read_message, write_message
+from protocol import FrameReader, decode_message, encode_message
+
+# most buffers one sendmsg() call accepts
+IOV_MAX = 1024
+
+# what a full output queue does with one more frame
+QUEUE_POLICY_DROP_OLDEST = 'drop_oldest'
+QUEUE_POLICY_COALESCE = 'coalesce'
+QUEUE_POLICY_DISCONNECT = 'disconnect'
+QUEUE_POLICIES = (QUEUE_POLICY_DROP_OLDEST, QUEUE_POLICY_COALESCE, QUEUE_POLICY_DISCONNECT)
+# keys of the frames a full queue never drops, a client missing them ignores every delta after.
+# they can only be replaced by a newer frame of the same key
+PINNED_KEYS = {'login', 'snapshot'}
 
 class SessionException(Exception):
     '''
     Session exception
     '''
 
+class OutputQueue:
+    '''
+    frames waiting to be sent, bounded in messages and bytes (0 for no bound)
+
+    drop_oldest makes room by dropping the oldest frames but the ones with a
+    key in PINNED_KEYS, coalesce also lets a frame replace the pending frame
+    pushed with the same key, disconnect refuses the frame so the session can
+    be closed. a pinned frame always replaces the pending one of its key, so
+    at most one of each waits. after a drop lost is True until the session
+    reads it, the client may have missed bubble events only a snapshot repairs.
+    not thread safe, the session provides the locking
+    '''
+    def __init__(self, max_messages=0, max_bytes=0, policy=QUEUE_POLICY_DROP_OLDEST):
+        assert policy in QUEUE_POLICIES
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        # [frame, key] entries, the frame of a superseded entry is set to None
+        self.entries = deque()
+        # key -> pending entry, for coalescing
+        self.pending = {}
+        self.messages = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.lost = False
+
+    def __len__(self):
+        return self.messages
+
+    def _is_full(self):
+        return ((self.max_messages and self.messages > self.max_messages)
+            or (self.max_bytes and self.bytes > self.max_bytes))
+
+    def _forget(self, entry):
+        self.messages -= 1
+        self.bytes -= len(entry[0])
+        if entry[1] is not None and self.pending.get(entry[1]) is entry:
+            del self.pending[entry[1]]
+        entry[0] = None
+
+    #queue the frame, False if the queue is full and the session should be disconnected
+    def push(self, frame, key=None):
+        if key is not None and (self.policy == QUEUE_POLICY_COALESCE or key in PINNED_KEYS):
+            previous = self.pending.get(key)
+            if previous is not None:
+                self._forget(previous)
+                self.coalesced += 1
+                if len(self.entries) > 2 * self.messages + 64:
+                    # superseded entries only leave the deque when sent or dropped, compact them away
+                    self.entries = deque(entry for entry in self.entries if entry[0] is not None)
+        entry = [frame, key]
+        self.entries.append(entry)
+        if key is not None:
+            self.pending[key] = entry
+        self.messages += 1
+        self.bytes += len(frame)
+        if not self._is_full():
+            return True
+        if self.policy == QUEUE_POLICY_DISCONNECT:
+            return False
+        # never drop the frame just pushed, pinned frames go back to the front in order
+        pinned = []
+        while self._is_full() and len(self.entries) > 1:
+            entry = self.entries.popleft()
+            if entry[0] is None:
+                continue
+            if entry[1] in PINNED_KEYS:
+                pinned.append(entry)
+                continue
+            self._forget(entry)
+            self.dropped += 1
+            self.lost = True
+        self.entries.extendleft(reversed(pinned))
+        return True
+
+    #remove and return every pending frame in order
+    def take(self):
+        frames = [frame for frame, _ in self.entries if frame is not None]
+        self.entries.clear()
+        self.pending.clear()
+        self.messages = 0
+        self.bytes = 0
+        return frames
+
 class Session:
 
     def __str__(self):
         return f'Session {self.remote_address}'
 
-    def __init__(self, socket, remote_address, handle_message):
+    def __init__(self, socket, remote_address, handle_message, flush_window_s=0,
+            max_queue_messages=0, max_queue_bytes=0, queue_policy=QUEUE_POLICY_DROP_OLDEST):
         self.socket = socket
         self.remote_address = remote_address
-        self.output_messages = deque() # deque is thread safe for append() and popleft()
+        # codec negotiated at login, None for json
+        self.codec = None
+        # FrameCompressor once compression is negotiated, frames are compressed in the order they are sent
+        self.compressor = None
+        # encoded frames waiting to be sent, broadcasts share one frame between sessions
+        self.output_messages = OutputQueue(max_queue_messages, max_queue_bytes, queue_policy)
+        # the write thread sleeps on this condition until there is something to send
+        self.output_ready = threading.Condition()
+        # how long the write thread waits for more frames before sending, 0 to send right away
+        self.flush_window_s = flush_window_s
+        # totals of what went out, bytes and frames per syscall are these divided by send_calls
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.send_calls = 0
         self.handle_message = handle_message
         self.lock = threading.Lock()
         self.is_active = True
@@ -31,16 +143,68 @@ class Session:
     def _write(self):
         try:
             while self.is_active:
-                while self.output_messages:
-                    message = self.output_messages.popleft()
-                    write_message(self.socket.send, message)
+                with self.output_ready:
+                    while self.is_active and not self.output_messages:
+                        self.output_ready.wait()
+                if self.flush_window_s:
+                    # let a burst build up so it goes out in fewer syscalls
+                    time.sleep(self.flush_window_s)
+                with self.output_ready:
+                    # take everything queued so far in one wakeup
+                    frames = self.output_messages.take()
+                # compressed only now, a frame dropped or coalesced in the queue never reached the compressor
+                compressor = self.compressor
+                if compressor is not None:
+                    frames = [compressor.compress(frame) for frame in frames]
+                if frames:
+                    self._send_frames(frames)
         except:
             pass # logging.warning(f'{self} disconnected with exception in write')
             self.close()
     
-    def write_message(self, message):
+    #send the frames with as few syscalls as possible, resuming after partial sends
+    def _send_frames(self, frames):
+        buffers = frames
+        while buffers:
+            sent = self._send(buffers[:IOV_MAX])
+            self.send_calls += 1
+            self.bytes_sent += sent
+            # drop the buffers that went out completely and cut the one that went out partially
+            done = 0
+            while done < len(buffers) and sent >= len(buffers[done]):
+                sent -= len(buffers[done])
+                done += 1
+            buffers = buffers[done:]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+        self.frames_sent += len(frames)
+
+    #one scatter-gather send, platforms without sendmsg() join the buffers instead
+    def _send(self, buffers):
+        if hasattr(self.socket, 'sendmsg'):
+            return self.socket.sendmsg(buffers)
+        return self.socket.send(b''.join(buffers))
+
+    #key lets a newer message replace this one while it waits, see OutputQueue
+    def write_message(self, message, key=None):
+        self.write_frame(encode_message(message, self.codec), key)
+
+    #True once after the output queue dropped frames to make room, the server then sends a snapshot
+    def frames_lost(self):
+        with self.output_ready:
+            lost, self.output_messages.lost = self.output_messages.lost, False
+        return lost
+
+    #queue a frame already encoded with encode_message() for this session's codec
+    def write_frame(self, frame, key=None):
         if self.is_active:
-            self.output_messages.append(message)
+            with self.output_ready:
+                queued = self.output_messages.push(frame, key)
+                self.output_ready.notify()
+            if not queued:
+                # the client does not keep up, disconnect it rather than grow without limit
+                self.close()
+                raise SessionException(f'{self} is too slow, output queue is full')
         else:
             # if you think caller should check is_active() first before calling write_message,
             # it is not guaranteed the session is still active when you write message to it after the check.
@@ -51,12 +215,15 @@ class Session:
 
     def _read(self):
         try:
+            reader = FrameReader(self.socket.recv_into)
             while self.is_active:
-                message = read_message(self.socket.recv)
-                try:
-                    self.handle_message(self, message)
-                except:
-                    pass # logging.exception(f'exception raised when caller is handling {message} from {self}')
+                # one recv can deliver many messages
+                for body in reader.read_frames():
+                    message = decode_message(body)
+                    try:
+                        self.handle_message(self, message)
+                    except:
+                        pass # logging.exception(f'exception raised when caller is handling {message} from {self}')
         except:
             pass # logging.warning(f'{self} disconnected with exception in read')
             self.close()
@@ -75,6 +242,9 @@ class Session:
                         self.socket.close()
                     except:
                         pass
+                # wake up the write thread so it can exit
+                with self.output_ready:
+                    self.output_ready.notify_all()
 
                 # since the threads are daemon threads, no need to block the caller by joining them
                 #self.read_thread.join()
@@ -0,0 +1,62 @@
+from config import POOL_WIDTH, POOL_HEIGHT, BUBBLE_MAX_RADIUS
+
+#check if the position is inside the bubble
+def in_bubble(position, bubble):
+    pos1 = position
+    pos2 = bubble.position
+    radius = bubble.radius
+    return (pos1[0] - pos2[0]) ** 2 + (pos1[1] - pos2[1]) ** 2 <= radius ** 2
+
+class BubbleGrid:
+    '''
+    uniform grid over the pool to find the bubble under a position
+
+    every bubble is registered in each cell its bounding box overlaps,
+    so a lookup only tests the bubbles of a single cell
+    '''
+    def __init__(self, width=POOL_WIDTH, height=POOL_HEIGHT, cell_size=BUBBLE_MAX_RADIUS):
+        self.cell_size = cell_size
+        self.columns = int(width // cell_size) + 1
+        self.rows = int(height // cell_size) + 1
+        # each cell maps bubble id to bubble, dicts keep the insertion order of bubbles
+        self.cells = [{} for _ in range(self.columns * self.rows)]
+
+    #clamp a coordinate to a valid cell index
+    def _cell(self, value, count):
+        return min(max(int(value // self.cell_size), 0), count - 1)
+
+    #indexes of all the cells overlapped by the bubble
+    def _cells_of(self, bubble):
+        x, y = bubble.position
+        r = bubble.radius
+        x0, x1 = self._cell(x - r, self.columns), self._cell(x + r, self.columns)
+        y0, y1 = self._cell(y - r, self.rows), self._cell(y + r, self.rows)
+        for row in range(y0, y1 + 1):
+            for column in range(x0, x1 + 1):
+                yield row * self.columns + column
+
+    def insert(self, bubble):
+        for index in self._cells_of(bubble):
+            self.cells[index][bubble.id] = bubble
+
+    def remove(self, bubble):
+        for index in self._cells_of(bubble):
+            self.cells[index].pop(bubble.id, None)
+
+    #get the oldest bubble containing the position, None if there is no such bubble
+    def at(self, position):
+        cell = self.cells[self._cell(position[1], self.rows) * self.columns + self._cell(position[0], self.columns)]
+        for bubble in cell.values():
+            if in_bubble(position, bubble):
+                return bubble
+        return None
+
+    #bubbles registered in the cells overlapped by the box, a superset of the bubbles overlapping it
+    def overlapping(self, left, top, right, bottom):
+        x0, x1 = self._cell(left, self.columns), self._cell(right, self.columns)
+        y0, y1 = self._cell(top, self.rows), self._cell(bottom, self.rows)
+        found = {}
+        for row in range(y0, y1 + 1):
+            for column in range(x0, x1 + 1):
+                found.update(self.cells[row * self.columns + column])
+        return found